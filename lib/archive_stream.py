@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Archive Stream: incremental & safe extraction of uploaded archives
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import queue
+import shutil
+import asyncio
+import logging
+import tarfile
+import threading
+
+# ------------------------------------------------------------------------------
+# Archive helpers
+# ------------------------------------------------------------------------------
+
+# Tar archives can be extracted in a single pass (stream mode)
+TAR_MODES = ((".tar.bz2", "r|bz2"), (".tar.gz", "r|gz"), (".tar.xz", "r|xz"), (".tgz", "r|gz"))
+
+# Prefix of the directories holding archives extracted while uploading
+STAGING_PREFIX = "staging_"
+
+
+def get_tar_mode(fname):
+    """Get (name without extension, stream mode) for a tar archive. Otherwise (None, None)"""
+    lfname = fname.lower()
+    for ext, mode in TAR_MODES:
+        if lfname.endswith(ext):
+            return fname[:-len(ext)], mode
+    return None, None
+
+
+def check_member_path(dpath, name):
+    path = os.path.normpath(os.path.join(dpath, name))
+    if path != dpath and not path.startswith(dpath + os.sep):
+        raise ValueError("Wrong path in archive: '{}'".format(name))
+
+
+def extract_tar(fileobj, dpath, mode, check_cancelled=None):
+    """Extract a tar archive from a file object, reading it only once."""
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for member in tar:
+            if check_cancelled:
+                check_cancelled()
+            check_member_path(dpath, member.name)
+            if not (member.isfile() or member.isdir()):
+                # Don't trust links & devices from uploaded archives
+                continue
+            tar.extract(member, dpath, set_attrs=False)
+
+
+def unroll_dir(dpath):
+    if not os.path.isdir(dpath):
+        return
+    # Unroll nested dir
+    ddpath = os.path.join(dpath, os.path.basename(dpath))
+    if os.path.isdir(ddpath):
+        # Rename subdir to avoid existing filename issues when moving up
+        tmp_subdir = dpath + "/zyn_tmp_subdir"
+        os.rename(ddpath, tmp_subdir)
+        # Move up nested dir content
+        with os.scandir(tmp_subdir) as it:
+            for entry in it:
+                os.rename(entry.path, os.path.join(dpath, entry.name))
+        # Remove empty nested dir
+        shutil.rmtree(tmp_subdir, ignore_errors=True)
+    # Remove thrash ...
+    shutil.rmtree(dpath + "/__MACOSX", ignore_errors=True)
+
+
+def remove_path(path):
+    """Remove a file, or a staged directory with its staging parent."""
+    if not path:
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        parent = os.path.dirname(path)
+        if os.path.basename(parent).startswith(STAGING_PREFIX):
+            shutil.rmtree(parent, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# ------------------------------------------------------------------------------
+# Stream Extractor
+# ------------------------------------------------------------------------------
+
+
+class StreamExtractor(object):
+    """
+    Extract a tar archive while its data is being received.
+
+    Data chunks are fed from the event loop & consumed by an extraction thread.
+    feed() never blocks. The receiver awaits wait_ready() before reading more data,
+    so when extraction is slower than the network, only that upload waits & memory
+    usage is limited to a few chunks.
+    """
+
+    MAX_CHUNKS = 16
+
+    def __init__(self, dpath, mode):
+        self.dpath = dpath
+        self.mode = mode
+        self.chunks = queue.SimpleQueue()
+        self.buffer = b""
+        self.error = None
+        self.closed = False
+        self.done = False
+        # Future resolved by the extraction thread when it consumes data
+        self.ready = None
+        self.loop = asyncio.get_event_loop()
+        self.thread = threading.Thread(target=self.run, name="extract", daemon=True)
+        self.thread.start()
+
+    def feed(self, data):
+        # After a failure, data is just discarded
+        if self.error is None and not self.closed and data:
+            self.chunks.put(data)
+
+    async def wait_ready(self):
+        """Wait until the extraction thread has room for more data."""
+        while not self.done and self.chunks.qsize() >= self.MAX_CHUNKS:
+            self.ready = self.loop.create_future()
+            # Check again, the thread could have consumed data meanwhile
+            if self.done or self.chunks.qsize() < self.MAX_CHUNKS:
+                break
+            await self.ready
+        self.ready = None
+
+    def wake_up(self):
+        ready = self.ready
+        if ready is not None:
+            self.loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+    def close(self):
+        """No more data. Doesn't wait for the extraction."""
+        if not self.closed:
+            self.closed = True
+            self.chunks.put(None)
+
+    def finish(self):
+        """Wait for the extraction to end. Raises the extraction error, if any. Blocking!"""
+        self.close()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        unroll_dir(self.dpath)
+
+    def get_chunk(self):
+        data = self.chunks.get()
+        self.wake_up()
+        return data
+
+    def read(self, size=-1):
+        # Called by tarfile from the extraction thread
+        while self.buffer is not None and (size < 0 or len(self.buffer) < size):
+            data = self.get_chunk()
+            if data is None:
+                res = self.buffer
+                self.buffer = None
+                return res
+            self.buffer += data
+        if self.buffer is None:
+            return b""
+        if size < 0:
+            size = len(self.buffer)
+        res = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return res
+
+    def run(self):
+        try:
+            os.makedirs(self.dpath, exist_ok=True)
+            extract_tar(self, self.dpath, self.mode)
+        except Exception as e:
+            logging.error("Can't extract '{}': {}".format(self.dpath, e))
+            self.error = e
+        finally:
+            self.done = True
+            self.wake_up()
+            # Drain the queue until the end, discarding data
+            while self.buffer is not None:
+                if self.chunks.get() is None:
+                    self.buffer = None
+
+# ------------------------------------------------------------------------------
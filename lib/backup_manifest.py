@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Backup Manifest: file states for incremental backups
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.upload_handler import CACHE_DIR
+
+# ------------------------------------------------------------------------------
+# File hashing, run in worker threads
+# ------------------------------------------------------------------------------
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# hashlib releases the GIL while hashing big chunks, so threads run in parallel
+hash_pool = None
+
+
+def get_hash_pool():
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="hash")
+    return hash_pool
+
+
+def hash_file(fpath):
+    h = hashlib.sha256()
+    try:
+        with open(fpath, "rb") as f:
+            while True:
+                data = f.read(HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+    except OSError as e:
+        logging.error("Can't hash '{}': {}".format(fpath, e))
+        return None
+    return h.hexdigest()
+
+
+# ------------------------------------------------------------------------------
+# Backup Manifest
+# ------------------------------------------------------------------------------
+
+class BackupManifest(object):
+    """
+    Path, size, mtime & content hash of every file in a backup.
+
+    The manifest of the last incremental backup is kept on the device, so the
+    next one only contains the files whose content changed since then. Every
+    incremental archive includes its own manifest (MEMBER_NAME), with the files
+    deleted since the base backup and the files whose content is already in the
+    chain (links), so restoring a chain of archives in order rebuilds the last state.
+    """
+
+    VERSION = 1
+    MEMBER_NAME = "zynthian_backup_manifest.json"
+    MANIFESTS_DIR = CACHE_DIR + "/backup_manifests"
+
+    def __init__(self, name, backup_id=None, base_id=None, files=None):
+        self.name = name
+        self.backup_id = backup_id
+        self.base_id = base_id
+        # path => [size, mtime_ns, sha256]
+        self.files = files or {}
+        self.deleted = []
+        # path => path of a file with the same content, restored before
+        self.links = {}
+
+    @classmethod
+    def get_fpath(cls, name):
+        return "{}/{}.json".format(cls.MANIFESTS_DIR, name)
+
+    @classmethod
+    def load(cls, name):
+        """Load the manifest of the last incremental backup, or an empty one."""
+        try:
+            with open(cls.get_fpath(name)) as f:
+                return cls.from_dict(name, json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load backup manifest '{}': {}".format(name, e))
+        return cls(name)
+
+    @classmethod
+    def from_dict(cls, name, data):
+        if data.get('version') != cls.VERSION:
+            raise ValueError("Unsupported manifest version {}".format(data.get('version')))
+        manifest = cls(name, data['id'], data['base'], data['files'])
+        manifest.deleted = data.get('deleted', [])
+        manifest.links = data.get('links', {})
+        return manifest
+
+    def to_dict(self):
+        return {
+            'version': self.VERSION,
+            'id': self.backup_id,
+            'base': self.base_id,
+            'files': self.files,
+            'deleted': self.deleted,
+            'links': self.links
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def save(self):
+        fpath = self.get_fpath(self.name)
+        try:
+            os.makedirs(self.MANIFESTS_DIR, exist_ok=True)
+            with open(fpath + ".tmp", "w") as f:
+                f.write(self.to_json())
+            os.replace(fpath + ".tmp", fpath)
+        except Exception as e:
+            logging.error("Can't save backup manifest '{}': {}".format(self.name, e))
+
+    async def get_changes(self, backup_id, fpaths):
+        """
+        Compare the given files with this manifest.
+        Returns the manifest for the new backup & the list of files to include in it.
+        Only files with a different size or mtime are hashed, in a thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        stats = await loop.run_in_executor(None, self.stat_files, fpaths)
+
+        candidates = []
+        for fpath, (size, mtime) in stats.items():
+            old = self.files.get(fpath)
+            if not old or old[0] != size or old[1] != mtime:
+                candidates.append(fpath)
+        pool = get_hash_pool()
+        hashes = await loop.run_in_executor(None, lambda: list(pool.map(hash_file, candidates)))
+        hashes = dict(zip(candidates, hashes))
+
+        manifest = BackupManifest(self.name, backup_id, self.backup_id)
+        new_files = []
+        # Contents already in the chain: unchanged files & files stored in this archive
+        sources = {}
+        for fpath, (size, mtime) in stats.items():
+            old = self.files.get(fpath)
+            digest = hashes[fpath] if fpath in hashes else old[2]
+            if digest is None:
+                # Unreadable now => keep the last known state
+                if old:
+                    manifest.files[fpath] = old
+                continue
+            manifest.files[fpath] = [size, mtime, digest]
+            if old and old[2] == digest:
+                sources.setdefault(digest, fpath)
+            else:
+                new_files.append(fpath)
+
+        changed = []
+        for fpath in new_files:
+            digest = manifest.files[fpath][2]
+            if digest in sources:
+                manifest.links[fpath] = sources[digest]
+            else:
+                sources[digest] = fpath
+                changed.append(fpath)
+        manifest.deleted = [fpath for fpath in self.files if fpath not in manifest.files]
+
+        logging.info("Backup '{}': {} files, {} hashed, {} changed, {} deduplicated, {} deleted".format(
+            self.name, len(stats), len(candidates), len(changed), len(manifest.links), len(manifest.deleted)))
+        return manifest, changed
+
+    @staticmethod
+    def stat_files(fpaths):
+        res = {}
+        for fpath in fpaths:
+            try:
+                st = os.stat(fpath)
+                res[fpath] = (st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                logging.error("Can't stat '{}': {}".format(fpath, e))
+        return res
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Capture Index: cached file info & audio metadata of captures
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import json
+import mutagen
+import logging
+import threading
+
+from lib.upload_handler import CACHE_DIR
+
+# ------------------------------------------------------------------------------
+# Capture Index
+# ------------------------------------------------------------------------------
+
+CAPTURES_CACHE_DIR = CACHE_DIR + "/captures"
+
+
+class CaptureIndex(object):
+    """
+    Size, mtime & audio metadata (duration, sample rate, channels) of every file
+    in the captures directory, persisted to disk.
+
+    The directory is listed in a single scan and files are bucketed by extension.
+    Audio metadata is only read again for files whose mtime or size changed.
+    """
+
+    VERSION = 1
+    AUDIO_EXTENSIONS = ("wav", "ogg", "mp3", "flac")
+
+    def __init__(self, dpath, fpath):
+        self.dpath = dpath
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        # fname => {size, mtime, duration, sample_rate, channels}
+        self.files = {}
+        self.buckets = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.fpath) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load capture index '{}': {}".format(self.fpath, e))
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+            with open(self.fpath + ".tmp", "w") as f:
+                json.dump({'version': self.VERSION, 'files': self.files}, f)
+            os.replace(self.fpath + ".tmp", self.fpath)
+        except Exception as e:
+            logging.error("Can't save capture index '{}': {}".format(self.fpath, e))
+
+    @staticmethod
+    def get_fext(fname):
+        return os.path.splitext(fname)[1][1:].lower()
+
+    def update(self):
+        """Scan the captures directory & refresh changed files. Returns the buckets."""
+        with self.lock:
+            files = {}
+            buckets = {}
+            changed = False
+            try:
+                with os.scandir(self.dpath) as it:
+                    for entry in it:
+                        try:
+                            if not entry.is_file():
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        info = self.files.get(entry.name)
+                        if not info or info['mtime'] != st.st_mtime_ns or info['size'] != st.st_size:
+                            info = self.get_file_info(entry.path, st)
+                            changed = True
+                        files[entry.name] = info
+                        buckets.setdefault(self.get_fext(entry.name), []).append(entry.name)
+            except OSError as e:
+                logging.warning("Can't list captures directory '{}': {}".format(self.dpath, e))
+            if changed or len(files) != len(self.files):
+                self.files = files
+                self.save()
+            for fnames in buckets.values():
+                fnames.sort()
+            self.buckets = buckets
+            return buckets
+
+    def get_file_info(self, fpath, st):
+        info = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'duration': None,
+            'sample_rate': None,
+            'channels': None
+        }
+        if self.get_fext(fpath) in self.AUDIO_EXTENSIONS:
+            try:
+                audio_info = mutagen.File(fpath).info
+                info['duration'] = audio_info.length
+                info['sample_rate'] = getattr(audio_info, 'sample_rate', None)
+                info['channels'] = getattr(audio_info, 'channels', None)
+            except Exception as e:
+                logging.warning("Can't read audio info from '{}': {}".format(fpath, e))
+        return info
+
+    def get_info(self, fname):
+        return self.files.get(fname)
+
+    def get_fnames(self, fext):
+        return self.buckets.get(fext.lower(), [])
+
+
+capture_index = CaptureIndex("/zynthian/zynthian-my-data/capture", CAPTURES_CACHE_DIR + "/index.json")
+
+# ------------------------------------------------------------------------------
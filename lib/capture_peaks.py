@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Capture Peaks: cached waveform peaks of audio captures
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import sys
+import wave
+import array
+import struct
+import mutagen
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from lib.capture_index import CAPTURES_CACHE_DIR, capture_index
+
+# ------------------------------------------------------------------------------
+# Peak levels
+# ------------------------------------------------------------------------------
+
+
+class PeakLevels(object):
+    """
+    Min/max peaks of an audio stream, as signed 8 bits values, at several resolutions.
+
+    The base level is calculated block by block from 16 bits interleaved samples,
+    vectorised with numpy if available. Every next level is BASE_SAMPLES_PER_PEAK times
+    LEVEL_FACTOR samples per peak, calculated from the previous one.
+    """
+
+    BASE_SAMPLES_PER_PEAK = 256
+    LEVEL_FACTOR = 4
+    NUM_LEVELS = 5
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.frame_size = 2 * channels
+        self.pending = b""
+        # Peak data: [min_ch0, max_ch0, min_ch1, max_ch1, ...] for every peak
+        self.base = bytearray()
+        self.levels = []
+
+    def add_samples(self, data):
+        data = self.pending + data
+        block_size = self.BASE_SAMPLES_PER_PEAK * self.frame_size
+        n = len(data) - len(data) % block_size
+        self.pending = data[n:]
+        if n:
+            self.base += self.calc_peaks(data[:n], self.BASE_SAMPLES_PER_PEAK)
+
+    def finish(self):
+        n = len(self.pending) - len(self.pending) % self.frame_size
+        if n:
+            self.base += self.calc_peaks(self.pending[:n], n // self.frame_size)
+        self.pending = b""
+        self.levels = [(self.BASE_SAMPLES_PER_PEAK, bytes(self.base))]
+        for i in range(1, self.NUM_LEVELS):
+            spp, data = self.levels[-1]
+            self.levels.append((spp * self.LEVEL_FACTOR, self.reduce_peaks(data, self.LEVEL_FACTOR)))
+        return self.levels
+
+    def calc_peaks(self, data, samples_per_peak):
+        ch = self.channels
+        if np is not None:
+            samples = np.frombuffer(data, dtype='<i2').reshape(-1, samples_per_peak, ch)
+            peaks = np.empty((samples.shape[0], ch, 2), dtype=np.int8)
+            # Arithmetic shift => 16 to 8 bits
+            peaks[:, :, 0] = samples.min(axis=1) >> 8
+            peaks[:, :, 1] = samples.max(axis=1) >> 8
+            return peaks.tobytes()
+        samples = array.array('h')
+        samples.frombytes(data)
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        res = array.array('b')
+        block_len = samples_per_peak * ch
+        for i in range(0, len(samples), block_len):
+            block = samples[i:i + block_len]
+            for c in range(ch):
+                chan = block[c::ch]
+                res.append(min(chan) >> 8)
+                res.append(max(chan) >> 8)
+        return res.tobytes()
+
+    def reduce_peaks(self, data, factor):
+        row = 2 * self.channels
+        if np is not None:
+            peaks = np.frombuffer(data, dtype=np.int8).reshape(-1, self.channels, 2)
+            n = len(peaks)
+            if n % factor:
+                # Pad with the last peak, so it doesn't change min/max
+                peaks = np.concatenate([peaks, np.repeat(peaks[-1:], factor - n % factor, axis=0)])
+            peaks = peaks.reshape(-1, factor, self.channels, 2)
+            res = np.empty((peaks.shape[0], self.channels, 2), dtype=np.int8)
+            res[:, :, 0] = peaks[:, :, :, 0].min(axis=1)
+            res[:, :, 1] = peaks[:, :, :, 1].max(axis=1)
+            return res.tobytes()
+        peaks = array.array('b')
+        peaks.frombytes(data)
+        res = array.array('b')
+        group_len = factor * row
+        for i in range(0, len(peaks), group_len):
+            group = peaks[i:i + group_len]
+            for c in range(self.channels):
+                res.append(min(group[2 * c::row]))
+                res.append(max(group[2 * c + 1::row]))
+        return res.tobytes()
+
+
+# ------------------------------------------------------------------------------
+# Capture Peaks
+# ------------------------------------------------------------------------------
+
+class CapturePeaks(object):
+    """
+    Waveform peaks of audio captures, generated on demand and cached in the capture cache.
+
+    16 bits PCM WAV files are read with the wave module. Other formats (24/32 bits
+    & float WAV, OGG, MP3, FLAC) are decoded to 16 bits PCM by ffmpeg. Audio is read
+    in chunks, so memory usage doesn't depend on the capture length.
+    Peak files store the size & mtime of the source file, so they are regenerated if it changes.
+    """
+
+    MAGIC = b"ZPK1"
+    HEADER = struct.Struct("<4sIIQqI")
+    LEVEL_HEADER = struct.Struct("<II")
+    CHUNK_FRAMES = 65536
+
+    def __init__(self, dpath, cache_dpath):
+        self.dpath = dpath
+        self.cache_dpath = cache_dpath
+        self.pending = {}
+
+    def get_peaks_fpath(self, fname):
+        return "{}/{}.peaks".format(self.cache_dpath, fname)
+
+    async def get_peaks(self, fname):
+        """
+        Returns (sample_rate, channels, levels), levels being a list of (samples_per_peak, data).
+        Peaks are generated in a worker thread if needed. Concurrent requests share the work.
+        """
+        fpath = os.path.join(self.dpath, fname)
+        future = self.pending.get(fpath)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.load_or_generate, fname)
+            self.pending[fpath] = future
+            future.add_done_callback(lambda f: self.pending.pop(fpath, None))
+        return await future
+
+    def load_or_generate(self, fname):
+        fpath = os.path.join(self.dpath, fname)
+        st = os.stat(fpath)
+        peaks = self.load(fname, st)
+        if peaks:
+            return peaks
+        sample_rate, channels, levels = self.generate(fpath)
+        self.save(fname, st, sample_rate, channels, levels)
+        return sample_rate, channels, levels
+
+    def load(self, fname, st):
+        try:
+            with open(self.get_peaks_fpath(fname), "rb") as f:
+                magic, sample_rate, channels, size, mtime, nlevels = self.HEADER.unpack(f.read(self.HEADER.size))
+                if magic != self.MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+                    return None
+                level_headers = [self.LEVEL_HEADER.unpack(f.read(self.LEVEL_HEADER.size)) for i in range(nlevels)]
+                levels = []
+                for samples_per_peak, npeaks in level_headers:
+                    levels.append((samples_per_peak, f.read(npeaks * channels * 2)))
+                return sample_rate, channels, levels
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load peaks of '{}': {}".format(fname, e))
+        return None
+
+    def save(self, fname, st, sample_rate, channels, levels):
+        fpath = self.get_peaks_fpath(fname)
+        try:
+            os.makedirs(self.cache_dpath, exist_ok=True)
+            with open(fpath + ".tmp", "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, sample_rate, channels, st.st_size, st.st_mtime_ns, len(levels)))
+                for samples_per_peak, data in levels:
+                    f.write(self.LEVEL_HEADER.pack(samples_per_peak, len(data) // (2 * channels)))
+                for samples_per_peak, data in levels:
+                    f.write(data)
+            os.replace(fpath + ".tmp", fpath)
+        except Exception as e:
+            logging.error("Can't save peaks of '{}': {}".format(fname, e))
+
+    def remove(self, fname):
+        try:
+            os.remove(self.get_peaks_fpath(fname))
+        except OSError:
+            pass
+
+    def rename(self, src_fname, dest_fname):
+        try:
+            os.replace(self.get_peaks_fpath(src_fname), self.get_peaks_fpath(dest_fname))
+        except OSError:
+            # Don't keep peaks of a previous file with the same name
+            self.remove(dest_fname)
+
+    def generate(self, fpath):
+        logging.info("Generating waveform peaks for '{}'".format(fpath))
+        try:
+            with wave.open(fpath, "rb") as wf:
+                if wf.getsampwidth() == 2:
+                    channels = wf.getnchannels()
+                    peaks = PeakLevels(channels)
+                    while True:
+                        data = wf.readframes(self.CHUNK_FRAMES)
+                        if not data:
+                            break
+                        peaks.add_samples(data)
+                    return wf.getframerate(), channels, peaks.finish()
+        except (wave.Error, EOFError):
+            # Not a 16 bits PCM WAV file
+            pass
+        return self.generate_ffmpeg(fpath)
+
+    def generate_ffmpeg(self, fpath):
+        sample_rate, channels = self.get_audio_format(fpath)
+        cmd = ["ffmpeg", "-v", "error", "-i", fpath, "-f", "s16le", "-acodec", "pcm_s16le", "-"]
+        peaks = PeakLevels(channels)
+        # Errors go to a file, so a full stderr pipe can't block ffmpeg while reading stdout
+        with tempfile.TemporaryFile() as errf:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errf)
+            try:
+                while True:
+                    data = proc.stdout.read(self.CHUNK_FRAMES * peaks.frame_size)
+                    if not data:
+                        break
+                    peaks.add_samples(data)
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            if proc.returncode != 0:
+                errf.seek(0)
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output=errf.read())
+        return sample_rate, channels, peaks.finish()
+
+    @staticmethod
+    def get_audio_format(fpath):
+        info = capture_index.get_info(os.path.basename(fpath))
+        if info and info['sample_rate'] and info['channels']:
+            return info['sample_rate'], info['channels']
+        audio_info = mutagen.File(fpath).info
+        return audio_info.sample_rate, audio_info.channels
+
+    @staticmethod
+    def select_level(levels, samples_per_peak):
+        """Get the most detailed level with at least samples_per_peak samples per peak."""
+        res = levels[0]
+        for level in levels:
+            if level[0] <= samples_per_peak:
+                res = level
+        return res
+
+
+capture_peaks = CapturePeaks(capture_index.dpath, CAPTURES_CACHE_DIR + "/peaks")
+
+# ------------------------------------------------------------------------------
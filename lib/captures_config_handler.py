@@ -25,17 +25,24 @@
 import os
 import re
 import json
+import array
+import struct
 import shutil
-import mutagen
+import asyncio
 import fnmatch
 import logging
 import jsonpickle
-import subprocess
+import urllib.parse
 import tornado.web
+import tornado.websocket
 from zipfile import ZipFile
 
-from lib.upload_handler import TMP_DIR
+from lib.zip_stream import ZipStreamWriter
+from lib.capture_index import capture_index
+from lib.capture_peaks import capture_peaks
+from lib.transcode_queue import transcode_queue
 from lib.zynthian_config_handler import ZynthianBasicHandler
+from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
 # ------------------------------------------------------------------------------
 # Soundfont Configuration
@@ -51,15 +58,18 @@ class CapturesConfigHandler(ZynthianBasicHandler):
     maxTreeNodeIndex = 0
 
     @tornado.web.authenticated
-    def get(self, errors=None):
+    async def get(self, errors=None):
         config = {}
         self.maxTreeNodeIndex = 0
         if self.get_argument('stream', None, True):
-            self.do_download(self.get_argument('stream').replace("%27", "'"))
+            await self.do_download(self.get_argument('stream').replace("%27", "'"), False)
         else:
+            # Single directory scan. Audio info is only read for new/changed files.
+            capture_index.update()
             captures = []
             captures.append(self.create_node('wav'))
             captures.append(self.create_node('ogg'))
+            captures.append(self.create_node('flac'))
             captures.append(self.create_node('mp3'))
             captures.append(self.create_node('mid'))
             captures.append(self.create_node('log'))
@@ -70,7 +80,7 @@ class CapturesConfigHandler(ZynthianBasicHandler):
 
             super().get("captures.html", "Captures", config, errors)
 
-    def post(self):
+    async def post(self):
         action = self.get_argument('ZYNTHIAN_CAPTURES_ACTION', None)
         if not action and self.get_argument('INSTALL_FPATH', None):
             action = 'UPLOAD'
@@ -85,9 +95,11 @@ class CapturesConfigHandler(ZynthianBasicHandler):
                 'UPLOAD': lambda: self.do_install_file(),
                 'SAVE_LOG': lambda: self.do_save_log()
             }[action]()
+            if asyncio.iscoroutine(errors):
+                errors = await errors
 
         if (action not in ('DOWNLOAD', 'SAVE_LOG')):
-            self.get(errors)
+            await self.get(errors)
 
     def do_remove(self):
         logging.info("Removing {}".format(self.selected_full_path))
@@ -96,6 +108,7 @@ class CapturesConfigHandler(ZynthianBasicHandler):
                 shutil.rmtree(self.selected_full_path)
             else:
                 os.remove(self.selected_full_path)
+                capture_peaks.remove(os.path.basename(self.selected_full_path))
                 fparts = os.path.splitext(self.selected_full_path)
                 if fparts[1] == ".log":
                     video_fpath = fparts[0] + ".mp4"
@@ -136,6 +149,7 @@ class CapturesConfigHandler(ZynthianBasicHandler):
             logging.info("Renaming capture: {} => {}".format(
                 src_fpath, dest_fpath))
             shutil.move(src_fpath, dest_fpath)
+            capture_peaks.rename(os.path.basename(src_fpath), os.path.basename(dest_fpath))
             self.selected_full_path = dest_fpath
             # When renaming log files, change title inside log file and rename associated video file (mp4)
             if fext == ".log":
@@ -146,40 +160,39 @@ class CapturesConfigHandler(ZynthianBasicHandler):
                     src_fpath, dest_fpath))
                 shutil.move(src_fpath, dest_fpath)
 
-    def do_download(self, fullpath):
+    async def do_download(self, fullpath, attachment=True):
         if fullpath:
             fparts = os.path.split(fullpath)
             dirpath = fparts[0]
             filename = fparts[1]
 
-            # If file is a capture log, generate download package with log + video
+            # Capture files are served by CaptureStreamHandler, with range & cache validation support
             fparts = os.path.splitext(filename)
-            if fparts[1] == ".log":
-                filename = fparts[0] + ".zip"
-                fullpath = TMP_DIR + "/" + filename
-                with ZipFile(fullpath, 'w') as tmpzip:
-                    tmpzip.write(dirpath + "/" +
-                                 fparts[0] + ".log", fparts[0] + ".log")
-                    tmpzip.write(dirpath + "/" +
-                                 fparts[0] + ".mp4", fparts[0] + ".mp4")
-
-            with open(fullpath, 'rb') as f:
-                try:
-                    while True:
-                        data = f.read(4096)
-                        if not data:
-                            break
-                        self.write(data)
-
-                    self.set_header(
-                        'Content-Type', self.get_content_type(filename))
-                    self.set_header('Content-Disposition',
-                                    'attachment; filename="%s"' % filename)
-                    self.finish()
-                except Exception as exc:
-                    logging.error(exc)
-                    self.set_header('Content-Type', 'application/json')
-                    self.write(jsonpickle.encode({'data': format(exc)}))
+            if fparts[1] != ".log":
+                url = CaptureStreamHandler.get_stream_url(fullpath, attachment)
+                if not url:
+                    raise tornado.web.HTTPError(403)
+                self.redirect(url)
+                return
+
+            # If file is a capture log, stream a zip package with log + video
+            filename = fparts[0] + ".zip"
+            log_fpath = dirpath + "/" + fparts[0] + ".log"
+            video_fpath = dirpath + "/" + fparts[0] + ".mp4"
+            if not os.path.isfile(log_fpath) or not os.path.isfile(video_fpath):
+                self.set_header('Content-Type', 'application/json')
+                self.write(jsonpickle.encode({'data': "Capture log or video not found"}))
+                return
+            self.set_header('Content-Type', self.get_content_type(filename))
+            self.set_header('Content-Disposition',
+                            'attachment; filename="%s"' % filename)
+            # Send headers right now. It can't fail nicely after here
+            await self.flush()
+            zs = ZipStreamWriter(self)
+            await zs.write_file(log_fpath, fparts[0] + ".log")
+            await zs.write_file(video_fpath, fparts[0] + ".mp4")
+            await zs.close()
+            await self.finish()
 
     def do_install_file(self):
         result = {}
@@ -195,15 +208,11 @@ class CapturesConfigHandler(ZynthianBasicHandler):
         return result
 
     def do_convert_ogg(self):
-        ogg_file_name = os.path.splitext(self.selected_full_path)[0]+'.ogg'
-        cmd = 'oggenc "{}" -o "{}"'.format(
-            self.selected_full_path, ogg_file_name)
+        # Encoded in background. Progress is shown by TranscodeMessageHandler
         try:
-            logging.info(cmd)
-            subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
+            transcode_queue.submit(self.selected_full_path, 'ogg')
         except Exception as e:
-            return e.output
-        return
+            return "Can't convert to ogg: {}".format(e)
 
     def do_save_log(self):
         capture_log = self.get_argument('ZYNTHIAN_CAPTURES_LOG_CONTENT')
@@ -259,7 +268,8 @@ class CapturesConfigHandler(ZynthianBasicHandler):
         except:
             logging.error("Can't write capture log file")
 
-    def get_content_type(self, filename):
+    @staticmethod
+    def get_content_type(filename):
         fext = os.path.splitext(filename)[1].lower()
         if fext == '.mid':
             return 'audio/midi'
@@ -267,6 +277,8 @@ class CapturesConfigHandler(ZynthianBasicHandler):
             return 'audio/ogg'
         elif fext == '.mp3':
             return 'audio/mp3'
+        elif fext == '.flac':
+            return 'audio/flac'
         elif fext == '.wav':
             return 'application/wav'
         elif fext == '.mp4':
@@ -313,21 +325,9 @@ class CapturesConfigHandler(ZynthianBasicHandler):
         captures = []
         logging.info("Getting {} filelist from {}".format(
             file_extension, directory))
-        for f in sorted(os.listdir(directory)):
-            fname, fext = os.path.splitext(f)
-            if len(fext) > 0:
-                fext = fext[1:]
-
-            # logging.debug("{} => {}".format(fname,fext))
-            if fext.lower() != file_extension.lower():
-                continue
-
+        for f in capture_index.get_fnames(file_extension):
+            fext = os.path.splitext(f)[1][1:]
             fullPath = os.path.join(directory, f)
-            logging.debug(fullPath)
-            # m = re.match('.*/(.*)', fullPath, re.M | re.I | re.S)
-            # text = ''
-            # if m:
-            # text = m.group(1)
 
             try:
                 if self.selected_full_path == fullPath:
@@ -335,13 +335,12 @@ class CapturesConfigHandler(ZynthianBasicHandler):
             except:
                 pass
 
+            info = capture_index.get_info(f)
             text = f.replace("'", "&#39;")
-            try:
-                l = mutagen.File(fullPath).info.length
+            if info['duration'] is not None:
+                l = info['duration']
                 text = "{} [{}:{:02d}]".format(
                     f.replace("'", "&#39;"), int(l/60), int(l % 60))
-            except Exception as e:
-                logging.warning(e)
 
             capture = {
                 'text': text,
@@ -349,12 +348,211 @@ class CapturesConfigHandler(ZynthianBasicHandler):
                 'fext': fext,
                 'fullpath': fullPath.replace("'", "&#39;"),
                 'icon': icon,
-                'id': self.maxTreeNodeIndex
+                'id': self.maxTreeNodeIndex,
+                'size': info['size'],
+                'duration': info['duration'],
+                'sample_rate': info['sample_rate'],
+                'channels': info['channels'],
+                'stream_url': CaptureStreamHandler.get_stream_url(fullPath),
+                'peaks_url': CapturePeaksHandler.get_peaks_url(fullPath) if fext in capture_index.AUDIO_EXTENSIONS else None
             }
             self.maxTreeNodeIndex += 1
-            if os.path.isdir(fullPath):
-                capture['nodes'] = self.walk_directory(
-                    os.path.join(directory, f), icon)
             captures.append(capture)
 
         return captures
+
+
+# ------------------------------------------------------------------------------
+# Capture streaming
+# ------------------------------------------------------------------------------
+
+class CaptureStreamHandler(tornado.web.StaticFileHandler):
+    """
+    Serve capture files in chunks, flushing each one, so memory usage is constant.
+    Range requests (206 Partial Content), ETag & If-Modified-Since validation
+    are handled by StaticFileHandler, so the audio player can seek.
+    """
+
+    @classmethod
+    def get_stream_url(cls, fullpath, attachment=False):
+        relpath = os.path.relpath(os.path.realpath(fullpath), os.path.realpath(CapturesConfigHandler.CAPTURES_DIRECTORY))
+        if relpath.startswith(".."):
+            return None
+        url = "/lib-captures/stream/" + urllib.parse.quote(relpath)
+        if attachment:
+            url += "?download=1"
+        return url
+
+    def initialize(self, path=CapturesConfigHandler.CAPTURES_DIRECTORY, default_filename=None):
+        super().initialize(path, default_filename)
+
+    def get_current_user(self):
+        return self.get_secure_cookie("user")
+
+    @tornado.web.authenticated
+    async def get(self, path, include_body=True):
+        await super().get(path, include_body)
+
+    @tornado.web.authenticated
+    async def head(self, path):
+        await super().get(path, include_body=False)
+
+    def compute_etag(self):
+        # StaticFileHandler hashes the whole file content & caches it forever. Captures
+        # may be big and rewritten, so size & mtime are used instead.
+        try:
+            st = os.stat(self.absolute_path)
+        except OSError:
+            return None
+        return '"{:x}-{:x}"'.format(st.st_size, st.st_mtime_ns)
+
+    def get_content_type(self):
+        content_type = super().get_content_type()
+        if content_type == "application/octet-stream":
+            content_type = CapturesConfigHandler.get_content_type(self.absolute_path) or content_type
+        return content_type
+
+    def set_extra_headers(self, path):
+        # Always revalidate, as captures can be replaced
+        self.set_header('Cache-Control', 'no-cache')
+        if self.get_argument('download', None):
+            self.set_header('Content-Disposition',
+                            'attachment; filename="%s"' % os.path.basename(path))
+
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Capture waveform peaks
+# ------------------------------------------------------------------------------
+
+class CapturePeaksHandler(tornado.web.RequestHandler):
+    """
+    Serve the waveform peaks of an audio capture, at the resolution nearest to the requested one:
+      ?pixels=N => about N peaks for the whole capture
+      ?samples_per_peak=N => the most detailed level with at least N samples per peak
+      ?format=bin => audiowaveform binary format (.dat v2, 8 bits) instead of JSON
+    """
+
+    @classmethod
+    def get_peaks_url(cls, fullpath):
+        if os.path.dirname(os.path.realpath(fullpath)) != os.path.realpath(CapturesConfigHandler.CAPTURES_DIRECTORY):
+            return None
+        return "/lib-captures/peaks/" + urllib.parse.quote(os.path.basename(fullpath))
+
+    def get_current_user(self):
+        return self.get_secure_cookie("user")
+
+    @tornado.web.authenticated
+    async def get(self, fname):
+        fpath = os.path.join(CapturesConfigHandler.CAPTURES_DIRECTORY, fname)
+        if "/" in fname or capture_index.get_fext(fname) not in capture_index.AUDIO_EXTENSIONS or not os.path.isfile(fpath):
+            raise tornado.web.HTTPError(404)
+        try:
+            sample_rate, channels, levels = await capture_peaks.get_peaks(fname)
+        except Exception as e:
+            logging.error("Can't get waveform peaks of '{}': {}".format(fname, e))
+            raise tornado.web.HTTPError(500)
+
+        try:
+            pixels = int(self.get_argument('pixels', 0))
+            samples_per_peak = int(self.get_argument('samples_per_peak', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if pixels > 0:
+            base_spp, base_data = levels[0]
+            nsamples = base_spp * len(base_data) // (2 * channels)
+            samples_per_peak = nsamples // pixels
+        samples_per_peak, data = capture_peaks.select_level(levels, samples_per_peak)
+        length = len(data) // (2 * channels)
+
+        self.set_header('Cache-Control', 'no-cache')
+        if self.get_argument('format', 'json') == 'bin':
+            self.set_header('Content-Type', 'application/octet-stream')
+            # version, flags (8 bits), sample rate, samples per pixel, length, channels
+            self.write(struct.pack("<iIiiIi", 2, 1, sample_rate, samples_per_peak, length, channels))
+            self.write(data)
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({
+                'version': 2,
+                'channels': channels,
+                'sample_rate': sample_rate,
+                'samples_per_pixel': samples_per_peak,
+                'bits': 8,
+                'length': length,
+                'data': list(array.array('b', data))
+            }))
+
+# ------------------------------------------------------------------------------
+
+
+# ------------------------------------------------------------------------------
+# Capture transcoding
+# ------------------------------------------------------------------------------
+
+class TranscodeMessageHandler(ZynthianWebSocketMessageHandler):
+    """
+    Websocket API for the transcode queue. Messages are dicts with an "action":
+      SUBSCRIBE: receive the list of jobs & then every job update.
+      CONVERT: queue a job for every capture in "files", to "format" (ogg, flac, mp3), with optional "quality".
+      CANCEL: cancel the job with "job_id".
+    """
+
+    subscribers = set()
+
+    @classmethod
+    def is_registered_for(cls, handler_name):
+        return handler_name == 'TranscodeMessageHandler'
+
+    def on_websocket_message(self, data):
+        action = data.get('action')
+        if action == 'SUBSCRIBE':
+            cls = TranscodeMessageHandler
+            if not cls.subscribers:
+                transcode_queue.add_listener(cls.on_job_update)
+            cls.subscribers.add(self.websocket)
+            self.send({'jobs': transcode_queue.get_jobs()})
+        elif action == 'CONVERT':
+            errors = []
+            for fpath in data.get('files', []):
+                try:
+                    if not self.is_capture_file(fpath):
+                        raise ValueError("Not a capture file")
+                    transcode_queue.submit(fpath, data.get('format', 'ogg'), data.get('quality'))
+                except Exception as e:
+                    errors.append("{}: {}".format(os.path.basename(fpath), e))
+            if errors:
+                self.send({'errors': errors})
+        elif action == 'CANCEL':
+            transcode_queue.cancel(str(data.get('job_id')))
+
+    @staticmethod
+    def is_capture_file(fpath):
+        captures_dir = os.path.realpath(CapturesConfigHandler.CAPTURES_DIRECTORY)
+        fpath = os.path.realpath(fpath)
+        return os.path.dirname(fpath) == captures_dir and os.path.isfile(fpath)
+
+    def send(self, data):
+        message = ZynthianWebSocketMessage('TranscodeMessageHandler', data)
+        self.websocket.write_message(jsonpickle.encode(message))
+
+    @classmethod
+    def on_job_update(cls, job):
+        encoded = jsonpickle.encode(ZynthianWebSocketMessage('TranscodeMessageHandler', {'job': job.to_dict()}))
+        for websocket in list(cls.subscribers):
+            try:
+                websocket.write_message(encoded)
+            except tornado.websocket.WebSocketClosedError:
+                cls.remove_subscriber(websocket)
+
+    @classmethod
+    def remove_subscriber(cls, websocket):
+        cls.subscribers.discard(websocket)
+        if not cls.subscribers:
+            transcode_queue.remove_listener(cls.on_job_update)
+
+    def on_close(self):
+        TranscodeMessageHandler.remove_subscriber(self.websocket)
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Command Runner: non-blocking execution of external commands
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import re
+import signal
+import asyncio
+import logging
+import subprocess
+
+# ------------------------------------------------------------------------------
+# Command Runner
+# ------------------------------------------------------------------------------
+
+
+class ZynthianCommandRunner(object):
+    """
+    Run external commands from the IOLoop without blocking it.
+
+    Commands given as a list are executed directly. Commands given as a string
+    are executed by "/bin/sh -c", so pipes & redirections keep working.
+    Errors are reported with the same exceptions used by subprocess.check_output:
+    CalledProcessError for non-zero exit codes and TimeoutExpired for timeouts.
+
+    Long commands (no timeout or longer than the default) have their own concurrency
+    limit, so they can't take the slots of short commands, i.e. dashboard sampling.
+    """
+
+    DEFAULT_TIMEOUT = 60
+    MAX_CONCURRENCY = 4
+    MAX_LONG_CONCURRENCY = 4
+    STREAM_LIMIT = 1024 * 1024
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, timeout=DEFAULT_TIMEOUT, max_long_concurrency=MAX_LONG_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.max_long_concurrency = max_long_concurrency
+        self.timeout = timeout
+        self.semaphores = {}
+        self.semaphore_loop = None
+        self.tasks = set()
+
+    def get_semaphore(self, long=False):
+        # Created lazily, so they are bound to the running loop
+        loop = asyncio.get_running_loop()
+        if self.semaphore_loop is not loop:
+            self.semaphores = {
+                False: asyncio.Semaphore(self.max_concurrency),
+                True: asyncio.Semaphore(self.max_long_concurrency)
+            }
+            self.semaphore_loop = loop
+        return self.semaphores[long]
+
+    def is_long(self, timeout):
+        return timeout is None or timeout > self.timeout
+
+    async def run(self, cmd, timeout=-1, cwd=None, stderr=None, check=True, on_output=None, split_cr=False):
+        """
+        Run a command and return its output as a string.
+
+        timeout: seconds before the command is killed. -1 => default timeout, None => no timeout.
+        stderr: None (inherited), subprocess.STDOUT (merged into output) or subprocess.DEVNULL.
+        check: raise CalledProcessError if the command exits with non-zero code.
+        on_output: callback called with every line of output, as soon as it's read.
+        split_cr: lines passed to on_output are also split on carriage returns, i.e. progress indicators.
+        """
+        if timeout == -1:
+            timeout = self.timeout
+
+        if isinstance(cmd, str):
+            args = ["/bin/sh", "-c", cmd]
+        else:
+            args = [str(arg) for arg in cmd]
+
+        async with self.get_semaphore(self.is_long(timeout)):
+            logging.debug("Running command: {}".format(cmd))
+            proc = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+                                                        stdin=subprocess.DEVNULL,
+                                                        stdout=subprocess.PIPE,
+                                                        stderr=stderr,
+                                                        start_new_session=True,
+                                                        limit=self.STREAM_LIMIT)
+            chunks = []
+            try:
+                await asyncio.wait_for(self.read_output(proc, chunks, on_output, split_cr), timeout)
+            except asyncio.TimeoutError:
+                self.kill(proc)
+                await proc.wait()
+                raise subprocess.TimeoutExpired(cmd, timeout, output=self.decode(chunks))
+            finally:
+                # Don't leave orphan processes if the task is cancelled
+                if proc.returncode is None:
+                    self.kill(proc)
+                    await proc.wait()
+
+        output = self.decode(chunks)
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=output)
+        return output
+
+    @classmethod
+    async def read_output(cls, proc, chunks, on_output, split_cr=False):
+        if split_cr:
+            await cls.read_output_cr(proc, chunks, on_output)
+        else:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                chunks.append(line)
+                cls.call_on_output(on_output, line)
+        await proc.wait()
+
+    @classmethod
+    async def read_output_cr(cls, proc, chunks, on_output):
+        pending = b""
+        while True:
+            data = await proc.stdout.read(4096)
+            if not data:
+                break
+            chunks.append(data)
+            lines = re.split(b"[\r\n]", pending + data)
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    cls.call_on_output(on_output, line)
+        if pending:
+            cls.call_on_output(on_output, pending)
+
+    @staticmethod
+    def call_on_output(on_output, line):
+        if on_output:
+            try:
+                on_output(line.decode("utf-8", "replace"))
+            except Exception as e:
+                logging.warning("Command output callback failed: {}".format(e))
+
+    @staticmethod
+    def decode(chunks):
+        return b"".join(chunks).decode("utf-8", "replace")
+
+    @staticmethod
+    def kill(proc):
+        # Kill the whole process group, so "sh -c" children die too
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            logging.error("Can't kill process {}: {}".format(proc.pid, e))
+
+    def spawn(self, coro):
+        """
+        Run a coroutine in background, from sync code running on the IOLoop.
+        Exceptions are logged, as nobody is awaiting the result.
+        """
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.on_task_done)
+        return task
+
+    def on_task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error("Background task failed: {}".format(task.exception()))
+
+
+command_runner = ZynthianCommandRunner()
+
+# ------------------------------------------------------------------------------
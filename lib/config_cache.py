@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Config Cache: reload config files only when they change
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import logging
+import threading
+
+import zynconf
+import zyngine.zynthian_lv2 as zynthian_lv2
+
+# ------------------------------------------------------------------------------
+# Config Cache Entry
+# ------------------------------------------------------------------------------
+
+
+class ConfigCacheEntry(object):
+    """
+    A loader function bound to the list of files it reads. The loader is
+    only called again when any of the files changes its mtime, size or inode.
+    """
+
+    def __init__(self, name, loader, get_fpaths):
+        self.name = name
+        self.loader = loader
+        self.get_fpaths = get_fpaths
+        self.signature = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def stat_signature(fpath):
+        try:
+            st = os.stat(fpath)
+            return fpath, st.st_mtime_ns, st.st_size, st.st_ino
+        except OSError:
+            return fpath, None, None, None
+
+    def get_signature(self):
+        return tuple(self.stat_signature(fpath) for fpath in self.get_fpaths())
+
+    def check(self):
+        signature = self.get_signature()
+        if signature == self.signature:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self.loader()
+        self.signature = signature
+        logging.debug("Config cache '{}' reloaded".format(self.name))
+        return True
+
+    def invalidate(self):
+        self.signature = None
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+# ------------------------------------------------------------------------------
+# Config Cache
+# ------------------------------------------------------------------------------
+
+
+class ZynthianConfigCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def register(self, name, loader, get_fpaths):
+        self.entries[name] = ConfigCacheEntry(name, loader, get_fpaths)
+
+    def refresh(self):
+        """Reload every entry whose files changed since the last refresh."""
+        with self.lock:
+            for entry in self.entries.values():
+                try:
+                    entry.check()
+                except Exception as e:
+                    entry.invalidate()
+                    logging.error("Can't reload config '{}': {}".format(entry.name, e))
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name:
+                self.entries[name].invalidate()
+            else:
+                for entry in self.entries.values():
+                    entry.invalidate()
+
+    def get_stats(self):
+        return {name: entry.get_stats() for name, entry in self.entries.items()}
+
+
+# ------------------------------------------------------------------------------
+# Zynthian config files
+# ------------------------------------------------------------------------------
+
+def get_config_dir():
+    return os.environ.get('ZYNTHIAN_CONFIG_DIR', "/zynthian/config")
+
+
+def get_envars_fpaths():
+    return [getattr(zynconf, 'envars_fpath', get_config_dir() + "/zynthian_envars.sh")]
+
+
+def get_midi_config_fpaths():
+    # The MIDI profile path is itself a config envar, so it's resolved after envars are loaded
+    return [os.environ.get('ZYNTHIAN_SCRIPT_MIDI_PROFILE', get_config_dir() + "/midi-profiles/default.sh")]
+
+
+def get_engines_fpaths():
+    return [getattr(zynthian_lv2, 'ENGINES_FPATH', get_config_dir() + "/engines.json")]
+
+
+config_cache = ZynthianConfigCache()
+config_cache.register('envars', zynconf.load_config, get_envars_fpaths)
+config_cache.register('midi', zynconf.load_midi_config, get_midi_config_fpaths)
+config_cache.register('engines', zynthian_lv2.load_engines, get_engines_fpaths)
+
+# ------------------------------------------------------------------------------
@@ -22,15 +22,17 @@
 #
 # ********************************************************************
 
-import zynconf
 import os
-import re
 import sys
 import logging
+import jsonpickle
 import tornado.web
+import tornado.websocket
 from distutils import util
-from subprocess import check_output, DEVNULL
+from lib.command_runner import command_runner
+from lib.system_metrics import system_metrics
 from lib.zynthian_config_handler import ZynthianBasicHandler
+from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
 sys.path.append(os.environ.get('ZYNTHIAN_UI_DIR'))
 
@@ -42,20 +44,24 @@ sys.path.append(os.environ.get('ZYNTHIAN_UI_DIR'))
 class DashboardHandler(ZynthianBasicHandler):
 
     @tornado.web.authenticated
-    def get(self):
-        # Get git info
-        git_info_zyncoder = self.get_git_info("/zynthian/zyncoder")
-        git_info_ui = self.get_git_info("/zynthian/zynthian-ui")
-        git_info_sys = self.get_git_info("/zynthian/zynthian-sys")
-        git_info_webconf = self.get_git_info("/zynthian/zynthian-webconf")
-        git_info_data = self.get_git_info("/zynthian/zynthian-data")
-
-        # Get Memory & SD Card info
-        ram_info = self.get_ram_info()
-        sd_info = self.get_sd_info()
+    async def get(self):
+        metrics = await system_metrics.get_snapshot()
+        config = self.get_dashboard_config(metrics)
+        super().get("dashboard_block.html", "Dashboard", config, None)
+
+    @classmethod
+    def get_dashboard_config(cls, metrics):
+        ram_info = metrics['ram']
+        sd_info = metrics['sd']
+        git_info_zyncoder = metrics['git']['zyncoder']
+        git_info_ui = metrics['git']['zynthian-ui']
+        git_info_sys = metrics['git']['zynthian-sys']
+        git_info_webconf = metrics['git']['zynthian-webconf']
+        git_info_data = metrics['git']['zynthian-data']
+        library = metrics['library']
 
         # get I2C chips info
-        i2c_chips = self.get_i2c_chips()
+        i2c_chips = metrics['i2c_chips']
         if len(i2c_chips) > 0:
             i2c_info = ", ".join(map(str, i2c_chips))
         else:
@@ -96,11 +102,11 @@ class DashboardHandler(ZynthianBasicHandler):
                 'icon': 'glyphicon glyphicon-tasks',
                         'info': {
                             'OS_INFO': {
-                                'title': "{}".format(self.get_os_info())
+                                'title': "{}".format(metrics['os_info'])
                             },
                             'BUILD_DATE': {
                                 'title': 'Build Date',
-                                'value': self.get_build_info()['Timestamp'],
+                                'value': metrics['build_info'].get('Timestamp', '???'),
                             },
                             'RAM': {
                                 'title': 'Memory',
@@ -112,7 +118,7 @@ class DashboardHandler(ZynthianBasicHandler):
                             },
                             'TEMPERATURE': {
                                 'title': 'Temperature',
-                                'value': self.get_temperature()
+                                'value': metrics['temperature']
                             },
                             'OVERCLOCKING': {
                                 'title': 'Overclock',
@@ -131,17 +137,17 @@ class DashboardHandler(ZynthianBasicHandler):
                     },
                     'MASTER_CHANNEL': {
                         'title': 'Master Channel',
-                        'value': self.get_midi_master_chan(),
+                        'value': cls.get_midi_master_chan(),
                         'url': "/ui-midi-options"
                     },
                     'PRELOAD_PRESETS': {
                         'title': 'Preload Presets',
-                        'value': self.bool2onoff(os.environ.get('ZYNTHIAN_MIDI_PRESET_PRELOAD_NOTEON', '1')),
+                        'value': cls.bool2onoff(os.environ.get('ZYNTHIAN_MIDI_PRESET_PRELOAD_NOTEON', '1')),
                         'url': "/ui-midi-options"
                     },
                     'ZS3_SUBSNAPSHOTS': {
                         'title': 'ZS3 (SubSnapShots)',
-                        'value': self.bool2onoff(os.environ.get('ZYNTHIAN_MIDI_PROG_CHANGE_ZS3', '1')),
+                        'value': cls.bool2onoff(os.environ.get('ZYNTHIAN_MIDI_PROG_CHANGE_ZS3', '1')),
                         'url': "/ui-midi-options"
                     },
                     'POWER_SAVE_DELAY': {
@@ -151,7 +157,7 @@ class DashboardHandler(ZynthianBasicHandler):
                     },
                     'AUDIO_LEVELS_SNAPSHOT': {
                         'title': 'Audio Levels on Snapshots',
-                        'value': self.bool2onoff(os.environ.get('ZYNTHIAN_UI_SNAPSHOT_MIXER_SETTINGS', '0')),
+                        'value': cls.bool2onoff(os.environ.get('ZYNTHIAN_UI_SNAPSHOT_MIXER_SETTINGS', '0')),
                         'url': "/ui-options"
                     }
                 }
@@ -191,27 +197,27 @@ class DashboardHandler(ZynthianBasicHandler):
                 'info': {
                     'SNAPSHOTS': {
                         'title': 'Snapshots',
-                        'value': str(self.get_num_of_files(os.environ.get('ZYNTHIAN_MY_DATA_DIR')+"/snapshots")),
+                        'value': str(library['snapshots']),
                         'url': "/lib-snapshot"
                     },
                     'USER_PRESETS': {
                         'title': 'User Presets',
-                        'value': str(self.get_num_of_presets(os.environ.get('ZYNTHIAN_MY_DATA_DIR')+"/presets")),
+                        'value': str(library['presets']),
                         'url': "/lib-presets"
                     },
                     'USER_SOUNDFONTS': {
                         'title': 'User Soundfonts',
-                        'value': str(self.get_num_of_files(os.environ.get('ZYNTHIAN_MY_DATA_DIR')+"/soundfonts")),
+                        'value': str(library['soundfonts']),
                         'url': "/lib-soundfont"
                     },
                     'AUDIO_CAPTURES': {
                         'title': 'Audio Captures',
-                        'value': str(self.get_num_of_files(os.environ.get('ZYNTHIAN_MY_DATA_DIR')+"/capture", "*.wav")),
+                        'value': str(library['audio_captures']),
                         'url': "/lib-captures"
                     },
                     'MIDI_CAPTURES': {
                         'title': 'MIDI Captures',
-                        'value': str(self.get_num_of_files(os.environ.get('ZYNTHIAN_MY_DATA_DIR')+"/capture", "*.mid")),
+                        'value': str(library['midi_captures']),
                         'url': "/lib-captures"
                     }
                 }
@@ -221,27 +227,27 @@ class DashboardHandler(ZynthianBasicHandler):
                 'info': {
                     'HOSTNAME': {
                         'title': 'Hostname',
-                        'value': self.get_host_name(),
+                        'value': metrics['host_name'],
                         'url': "/sys-security"
                     },
                     'WIFI': {
                         'title': 'Wifi',
-                        'value': zynconf.get_nwdev_status_string("wlan0"),
+                        'value': metrics['wifi'],
                         # 'url': "/sys-wifi"
                     },
                     'IP': {
                         'title': 'IP',
-                        'value': self.get_ip(),
+                        'value': metrics['ip'],
                         # 'url': "/sys-wifi"
                     },
                     'VNC': {
                         'title': 'VNC',
-                        'value': self.bool2onoff(os.environ.get('ZYNTHIAN_VNCSERVER_ENABLED', '0')),
+                        'value': cls.bool2onoff(os.environ.get('ZYNTHIAN_VNCSERVER_ENABLED', '0')),
                         'url': "/ui-options"
                     },
                     'MIDI': {
                         'title': 'MIDI Services',
-                        'value': self.get_midi_network_services()
+                        'value': cls.get_midi_network_services(metrics['services'])
                     }
                 }
             }
@@ -254,219 +260,133 @@ class DashboardHandler(ZynthianBasicHandler):
                 'url': "/hw-wiring"
             }
 
-        ex_data_basedir = os.environ.get('ZYNTHIAN_EX_DATA_DIR', "/media/root")
-        ex_data_dirs = zynconf.get_external_storage_dirs(ex_data_basedir)
-        for exdir in ex_data_dirs:
-            media_info = self.get_media_info(exdir)
+        for dname, media_info in metrics['media'].items():
             if media_info:
-                dname = os.path.basename(exdir)
                 config['SYSTEM']['info']['MEDIA_' + dname] = {
                     'title': "USB/" + dname,
                     'value': "{} ({}/{})".format(media_info['usage'], media_info['used'], media_info['total']),
                     'url': "/lib-captures"
                 }
 
-        if self.is_service_active("touchosc2midi"):
+        if metrics['services']['touchosc2midi']:
             config['NETWORK']['info']['TOUCHOSC'] = {
                 'title': 'TouchOSC',
                 'value': 'on',
                 'url': "/ui-midi-options"
             }
 
-        super().get("dashboard_block.html", "Dashboard", config, None)
+        return config
 
     @staticmethod
-    def get_git_info(path, check_updates=False):
-        branch = check_output("cd %s; git branch | grep '*'" %
-                              path, shell=True).decode()[2:-1]
-        gitid = check_output("cd %s; git rev-parse HEAD" %
-                             path, shell=True).decode()[:-1]
-        if check_updates:
-            update = check_output(
-                "cd %s; git remote update; git status --porcelain -bs | grep behind | wc -l" % path, shell=True).decode()
+    def get_midi_master_chan():
+        mmc = os.environ.get('ZYNTHIAN_MIDI_MASTER_CHANNEL', "16")
+        if int(mmc) == 0:
+            return "Off"
         else:
-            update = None
-        return {"branch": branch, "gitid": gitid, "update": update}
+            return mmc
 
     @staticmethod
-    def get_host_name():
-        with open("/etc/hostname") as f:
-            hostname = f.readline()
-            return hostname
+    def get_midi_network_services(services):
+        res = []
+        if services["jacknetumpd"]:
+            res.append("UMP")
+        if services["jackrtpmidid"]:
+            res.append("RTP")
+        if services["qmidinet"]:
+            res.append("QMidiNet")
+        return ", ".join(res)
 
     @staticmethod
-    def get_os_info():
-        return check_output("lsb_release -ds", shell=True).decode()
+    def bool2onoff(b):
+        if (isinstance(b, str) and util.strtobool(b)) or (isinstance(b, bool) and b):
+            return "On"
+        else:
+            return "Off"
 
-    @staticmethod
-    def get_build_info():
-        info = {}
-        try:
-            zynthian_dir = os.environ.get('ZYNTHIAN_DIR', "/zynthian")
-            with open(zynthian_dir + "/build_info.txt", 'r') as f:
-                rows = f.read().split("\n")
-                f.close()
-                for row in rows:
-                    try:
-                        k, v = row.split(": ")
-                        info[k] = v
-                        logging.debug("Build info => {}: {}".format(k, v))
-                    except:
-                        pass
-        except Exception as e:
-            logging.warning("Can't get build info! => {}".format(e))
-            info['Timestamp'] = '???'
-
-        return info
 
-    @staticmethod
-    def get_ip():
-        # out=check_output("hostname -I | cut -f1 -d' '", shell=True).decode()
-        ips = []
-        for ip in check_output("hostname -I", shell=True).decode().split(" "):
-            # Filter ip6 addresses
-            if '.' in ip:
-                ips.append(ip)
-        return " ".join(ips)
+# ------------------------------------------------------------------------------
+# Dashboard live updates
+# ------------------------------------------------------------------------------
 
-    @staticmethod
-    def get_i2c_chips():
-        res = []
-        out = check_output("i2cdetect -y 1", shell=True).decode().split("\n")
-        if len(out) > 3:
-            for i in range(1, 8):
-                for adr in out[i][4:].split(" "):
-                    try:
-                        adr = int(adr, 16)
-                        if 0x20 <= adr <= 0x27:
-                            out1 = check_output(
-                                "i2cget -y 1 {} 0x01".format(adr), shell=True).decode().strip()
-                            out2 = check_output(
-                                "i2cget -y 1 {} 0x10".format(adr), shell=True).decode().strip()
-                            if out1 == '0x00' and out2 == '0x00':
-                                res.append("MCP23008@0x{:02X}".format(adr))
-                            else:
-                                res.append("MCP23017@0x{:02X}".format(adr))
-                        elif 0x48 <= adr <= 0x4B:
-                            res.append("ADS1115@0x{:02X}".format(adr))
-                        elif 0x61 <= adr <= 0x67:
-                            res.append("MCP4728@0x{:02X}".format(adr))
-                    except:
-                        pass
-        return res
+class DashboardMessageHandler(ZynthianWebSocketMessageHandler):
+    """
+    Push dashboard changes to subscribed clients.
 
-    @staticmethod
-    def get_ram_info():
-        out = check_output("free -m | grep 'Mem'", shell=True).decode()
-        parts = re.split('\s+', out)
-        return {'total': parts[1]+"M", 'used': parts[2]+"M", 'free': parts[3]+"M", 'usage': "{}%".format(int(100*float(parts[2])/float(parts[1])))}
+    The dashboard values are built & diffed once per metrics sample, no matter how
+    many clients are subscribed, and the same encoded message is sent to all of them.
+    Only the fields that changed are sent. If fields were added or removed (i.e. an
+    USB stick was mounted), the client is told to reload the page.
+    """
 
-    @staticmethod
-    def get_temperature():
-        try:
-            return check_output("vcgencmd measure_temp", shell=True).decode()[5:-3] + "ºC"
-        except:
-            return "???"
+    subscribers = set()
+    values = None
 
-    @staticmethod
-    def get_volume_info(volume=None):
-        if volume is None:
-            volume = "/dev/mmcblk0p2\|/dev/root"
-        try:
-            out = check_output(
-                "df -h | grep '{}'".format(volume), shell=True).decode()
-            parts = re.split('\s+', out)
-            return {'total': parts[1], 'used': parts[2], 'free': parts[3], 'usage': parts[4]}
-        except:
-            return {'total': 'NA', 'used': 'NA', 'free': 'NA', 'usage': 'NA'}
+    @classmethod
+    def is_registered_for(cls, handler_name):
+        return handler_name == 'DashboardMessageHandler'
 
     @staticmethod
-    def get_sd_info():
-        return DashboardHandler.get_volume_info("/dev/mmcblk0p2\|/dev/root")
+    def get_dashboard_values(metrics):
+        values = {}
+        for group, group_config in DashboardHandler.get_dashboard_config(metrics).items():
+            for tag, info in group_config['info'].items():
+                values[group + "/" + tag] = info.get('value', info['title'])
+        return values
 
-    @staticmethod
-    def get_media_info(mpath="/media/usb0"):
-        try:
-            out = check_output("mountpoint '{}'".format(
-                mpath), shell=True).decode()
-            if out.startswith("{} is a mountpoint".format(mpath)):
-                return DashboardHandler.get_volume_info(mpath)
-            else:
-                return None
-        except Exception as e:
-            # logging.error("Can't get info for '{}' => {}".format(mpath,e))
-            pass
+    def on_websocket_message(self, action):
+        if action == 'SUBSCRIBE':
+            command_runner.spawn(self.subscribe())
+        elif action == 'UNSUBSCRIBE':
+            self.unsubscribe()
 
-    @staticmethod
-    def get_num_of_files(path, pattern=None):
-        if pattern:
-            pattern = "-name \"{}\"".format(pattern)
-        else:
-            pattern = ""
-        try:
-            n = int(check_output("find {} -type f -follow {} | wc -l".format(path,
-                    pattern), shell=True, stderr=DEVNULL).decode())
-        except Exception as e:
-            logging.error(
-                "Can't get num of files for '{}' => {}".format(path, e))
-            n = 0
-        return n
+    async def subscribe(self):
+        metrics = await system_metrics.get_snapshot()
+        cls = DashboardMessageHandler
+        if not cls.subscribers:
+            cls.values = cls.get_dashboard_values(metrics)
+            system_metrics.add_listener(cls.on_metrics)
+        cls.subscribers.add(self.websocket)
+        # New subscribers get all values, so they are in sync with the others
+        cls.send(self.websocket, cls.encode({'fields': cls.values}))
+        logging.debug("Dashboard subscribers: {}".format(len(cls.subscribers)))
 
-    @staticmethod
-    def get_num_of_presets(path):
-        # LV2 presets
-        n1 = int(check_output(
-            "find {}/lv2 -type f -prune -name manifest.ttl | wc -l".format(path), shell=True).decode())
-        logging.debug("LV2 presets => {}".format(n1))
-        # Pianoteq presets
-        n2 = int(check_output(
-            "find {}/pianoteq -type f -prune | wc -l".format(path), shell=True).decode())
-        logging.debug("Pianoteq presets => {}".format(n2))
-        # Puredata presets
-        n3 = int(check_output("find {}/puredata/*/* -type d -prune | wc -l".format(path),
-                 shell=True, stderr=DEVNULL).decode())
-        logging.debug("Puredata presets => {}".format(n3))
-        # ZynAddSubFX presets
-        n4 = int(check_output(
-            "find {}/zynaddsubfx -type f -name *.xiz | wc -l".format(path), shell=True).decode())
-        logging.debug("ZynAddSubFX presets => {}".format(n4))
-        return n1 + n2 + n3 + n4
+    def unsubscribe(self):
+        DashboardMessageHandler.remove_subscriber(self.websocket)
 
-    @staticmethod
-    def get_midi_master_chan():
-        mmc = os.environ.get('ZYNTHIAN_MIDI_MASTER_CHANNEL', "16")
-        if int(mmc) == 0:
-            return "Off"
-        else:
-            return mmc
+    @classmethod
+    def remove_subscriber(cls, websocket):
+        cls.subscribers.discard(websocket)
+        if not cls.subscribers:
+            system_metrics.remove_listener(cls.on_metrics)
+            cls.values = None
 
     @staticmethod
-    def get_midi_network_services():
-        res = []
-        if DashboardHandler.is_service_active("jacknetumpd"):
-            res.append("UMP")
-        if DashboardHandler.is_service_active("jackrtpmidid"):
-            res.append("RTP")
-        if DashboardHandler.is_service_active("qmidinet"):
-            res.append("QMidiNet")
-        return ", ".join(res)
+    def encode(data):
+        return jsonpickle.encode(ZynthianWebSocketMessage('DashboardMessageHandler', data))
 
-    @staticmethod
-    def is_service_active(service):
-        cmd = "systemctl is-active %s" % service
+    @classmethod
+    def send(cls, websocket, encoded):
         try:
-            result = check_output(cmd, shell=True).decode('utf-8', 'ignore')
-        except Exception as e:
-            result = "ERROR: %s" % e
-        # print("Is service "+str(service)+" active? => "+str(result))
-        if result.strip() == 'active':
-            return True
-        else:
-            return False
+            websocket.write_message(encoded)
+        except tornado.websocket.WebSocketClosedError:
+            cls.remove_subscriber(websocket)
 
-    @staticmethod
-    def bool2onoff(b):
-        if (isinstance(b, str) and util.strtobool(b)) or (isinstance(b, bool) and b):
-            return "On"
+    @classmethod
+    def on_metrics(cls, metrics):
+        values = cls.get_dashboard_values(metrics)
+        if cls.values is not None and values.keys() != cls.values.keys():
+            data = {'reload': True}
         else:
-            return "Off"
+            old_values = cls.values or {}
+            data = {'fields': {k: v for k, v in values.items() if old_values.get(k) != v}}
+        cls.values = values
+        if not data.get('fields') and not data.get('reload'):
+            return
+        encoded = cls.encode(data)
+        for websocket in list(cls.subscribers):
+            cls.send(websocket, encoded)
+
+    def on_close(self):
+        self.unsubscribe()
+
+# ------------------------------------------------------------------------------
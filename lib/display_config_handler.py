@@ -23,9 +23,9 @@
 # ********************************************************************
 
 import os
+import shutil
 import logging
 import tornado.web
-from subprocess import check_output
 
 from lib.zynthian_config_handler import ZynthianConfigHandler
 
@@ -511,8 +511,7 @@ class DisplayConfigHandler(ZynthianConfigHandler):
     @classmethod
     def delete_fb_splash(cls):
         try:
-            cmd = "rm -rf %s/img" % os.environ.get('ZYNTHIAN_CONFIG_DIR')
-            check_output(cmd, shell=True)
+            shutil.rmtree("%s/img" % os.environ.get('ZYNTHIAN_CONFIG_DIR'), ignore_errors=True)
         except Exception as e:
             logging.error("Deleting FrameBuffer Splash Screens: %s" % e)
 
@@ -26,12 +26,14 @@ import os
 import sys
 import glob
 import shutil
+import asyncio
 import logging
 import pexpect
 import tornado.web
-from subprocess import check_output, STDOUT
+from subprocess import STDOUT
 
 import zynconf
+from lib.command_runner import command_runner
 from lib.zynthian_config_handler import ZynthianBasicHandler
 import zyngine.zynthian_lv2 as zynthian_lv2
 
@@ -60,7 +62,7 @@ class dsp56300Handler(ZynthianBasicHandler):
         super().get("dsp56300.html", "DSP56300", config, errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         errors = None
         try:
             action = self.get_argument('ZYNTHIAN_DSP56300_ACTION')
@@ -69,7 +71,7 @@ class dsp56300Handler(ZynthianBasicHandler):
             logging.error(f"No action!")
         if action:
             try:
-                errors = {
+                errors = await {
                     'INSTALL_OSIRUS_ROMFILE': lambda: self.do_install_romfile("Osirus"),
                     'INSTALL_OSTIRUS_ROMFILE': lambda: self.do_install_romfile("OsTIrus"),
                 }[action]()
@@ -77,7 +79,7 @@ class dsp56300Handler(ZynthianBasicHandler):
                 logging.error(err)
         self.get(errors)
 
-    def do_install_romfile(self, gear_name):
+    async def do_install_romfile(self, gear_name):
         plugin_bundle_dpath = self.plugins_dpath + "/" + gear_name + ".lv2"
         if not os.path.isdir(plugin_bundle_dpath):
             errors = f"Can't find a LV2 bundle dir for device '{gear_name}'"
@@ -97,14 +99,14 @@ class dsp56300Handler(ZynthianBasicHandler):
             try:
                 # Remove existing ROM files
                 logging.info(f"Remove existing ROM files from {plugin_bundle_dpath} ...")
-                res = check_output(f"cd {plugin_bundle_dpath}; rm -f *.bin; rm -f *.BIN",
-                                   shell=True, stderr=STDOUT).decode("utf-8")
+                for rom_fpath in glob.glob(plugin_bundle_dpath + "/*.bin") + glob.glob(plugin_bundle_dpath + "/*.BIN"):
+                    os.remove(rom_fpath)
                 # Copy uploaded file
                 fname = os.path.basename(fpath)
                 logging.info(f"Moving {fname} to {plugin_bundle_dpath} ...")
                 shutil.move(fpath, plugin_bundle_dpath + "/" + fname)
                 # Generate presets
-                errors = self.generate_presets(plugin_uri)
+                errors = await self.generate_presets(plugin_uri)
             except Exception as e:
                 errors = f"ROM file install failed: {e}"
                 logging.error(errors)
@@ -127,15 +129,20 @@ class dsp56300Handler(ZynthianBasicHandler):
                 logging.warning(f"No ROM file found for {gname} ({dpath}).")
         return config
 
-    def generate_presets(self, plugin_uri):
-        errors = None
+    @staticmethod
+    def run_plugin_once(plugin_uri):
         command = f"jalv -n dsp53600_webconf \"{plugin_uri}\""
+        proc = pexpect.spawn(command, timeout=10)
+        proc.delaybeforesend = 0
+        proc.expect("\n> ")
+        proc.terminate(True)
+
+    async def generate_presets(self, plugin_uri):
+        errors = None
         try:
-            proc = pexpect.spawn(command, timeout=10)
-            proc.delaybeforesend = 0
-            proc.expect("\n> ")
-            proc.terminate(True)
-            res = check_output(f"regenerate_lv2_presets.sh {plugin_uri}", shell=True, stderr=STDOUT).decode("utf-8")
+            # pexpect is blocking => run it in a worker thread
+            await asyncio.get_running_loop().run_in_executor(None, self.run_plugin_once, plugin_uri)
+            res = await command_runner.run(["regenerate_lv2_presets.sh", plugin_uri], stderr=STDOUT, timeout=300)
         except Exception as e:
             errors = f"Can't generate presets for '{plugin_uri}': {e}"
             logging.error(errors)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# File Count Index: incrementally maintained file stats for the dashboard
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import json
+import time
+import fnmatch
+import logging
+import threading
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+from lib.upload_handler import CACHE_DIR
+
+# ------------------------------------------------------------------------------
+# File Count Index
+# ------------------------------------------------------------------------------
+
+
+class FileCountIndex(object):
+    """
+    Keep the listing (files & subdirs) of every directory below some roots,
+    keyed by directory path, and the resulting counts for a set of named
+    counters, so getting a count is a dict lookup.
+
+    The index is persisted to disk. On update, directories are re-listed only
+    if they changed: using inotify events when available, or comparing the
+    directory mtime otherwise. Symlinks are followed, like "find -follow".
+    """
+
+    VERSION = 1
+    INOTIFY_MASK = 0
+    if INotify:
+        INOTIFY_MASK = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_FROM |
+                        inotify_flags.MOVED_TO | inotify_flags.DELETE_SELF | inotify_flags.MOVE_SELF)
+    # Directory mtimes this recent can't be trusted (i.e. FAT has 2 seconds resolution)
+    MTIME_GUARD = 2
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.counters = {}
+        self.counts = {}
+        self.scanned = False
+        self.changed = False
+        self.inotify = None
+        self.wds = {}
+        self.watched = set()
+        self.dirty = set()
+        if INotify:
+            try:
+                self.inotify = INotify()
+            except Exception as e:
+                logging.warning("Can't use inotify, falling back to mtime checks: {}".format(e))
+        self.load()
+
+    @property
+    def watching(self):
+        return self.inotify is not None
+
+    def add_counter(self, name, root, pattern=None, depth=None, count_dirs=False):
+        """
+        name: counter name, used for getting the count.
+        root: base directory.
+        pattern: count only entries matching this fnmatch pattern.
+        depth: count only entries at this depth. Entries in root have depth 1. None => all depths.
+        count_dirs: count directories instead of files.
+        """
+        self.counters[name] = (root, pattern, depth, count_dirs)
+
+    def get_count(self, name):
+        return self.counts.get(name, 0)
+
+    def get_counts(self):
+        return dict(self.counts)
+
+    # --------------------------------------------------------------------------
+    # Persistence
+    # --------------------------------------------------------------------------
+
+    def load(self):
+        try:
+            with open(self.fpath) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.dirs = data['dirs']
+                self.counts = data['counts']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load file count index '{}': {}".format(self.fpath, e))
+
+    def save(self):
+        data = {
+            'version': self.VERSION,
+            'dirs': self.dirs,
+            'counts': self.counts
+        }
+        try:
+            tmp_fpath = self.fpath + ".tmp"
+            with open(tmp_fpath, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_fpath, self.fpath)
+        except Exception as e:
+            logging.error("Can't save file count index '{}': {}".format(self.fpath, e))
+
+    # --------------------------------------------------------------------------
+    # Update
+    # --------------------------------------------------------------------------
+
+    def update(self):
+        """
+        Re-list changed directories & recalculate the counters if needed.
+        It may take a while the first time, so better call it from a worker thread.
+        """
+        with self.lock:
+            t0 = time.monotonic()
+            if self.scanned and self.watching:
+                self.read_events()
+                dirty = self.dirty
+                self.dirty = set()
+                for dpath in dirty:
+                    self.scan_dir(dpath, set(), force=True)
+            else:
+                # Full walk, comparing mtimes
+                for root in self.get_roots():
+                    self.scan_dir(root, set())
+                self.scanned = True
+
+            if self.changed:
+                self.recount()
+                self.save()
+                self.changed = False
+                logging.debug("File count index updated in {:.1f} ms".format(1000 * (time.monotonic() - t0)))
+
+    def get_roots(self):
+        return sorted(set(counter[0] for counter in self.counters.values()))
+
+    def scan_dir(self, dpath, ancestors, force=False):
+        try:
+            st = os.stat(dpath)
+        except OSError:
+            if self.dirs.pop(dpath, None) is not None:
+                self.changed = True
+            return
+        # Avoid symlink loops, like find does
+        dir_id = (st.st_dev, st.st_ino)
+        if dir_id in ancestors:
+            return
+
+        mtime = st.st_mtime_ns
+        record = self.dirs.get(dpath)
+        if force or record is None or record[0] != mtime:
+            files, subdirs = self.list_dir(dpath)
+            if mtime > (time.time() - self.MTIME_GUARD) * 1e9:
+                mtime = None
+            record = [mtime, files, subdirs]
+            self.dirs[dpath] = record
+            self.changed = True
+        if self.watching and dpath not in self.watched:
+            self.watch(dpath)
+
+        ancestors.add(dir_id)
+        for subdir in record[2]:
+            self.scan_dir(os.path.join(dpath, subdir), ancestors)
+        ancestors.discard(dir_id)
+
+    @staticmethod
+    def list_dir(dpath):
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dpath) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            files.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError as e:
+            logging.warning("Can't list '{}': {}".format(dpath, e))
+        return sorted(files), sorted(subdirs)
+
+    # --------------------------------------------------------------------------
+    # Inotify
+    # --------------------------------------------------------------------------
+
+    def watch(self, dpath):
+        try:
+            wd = self.inotify.add_watch(dpath, self.INOTIFY_MASK)
+            self.wds[wd] = dpath
+            self.watched.add(dpath)
+        except OSError as e:
+            # Usually, max_user_watches has been reached
+            logging.warning("Can't watch '{}', falling back to mtime checks: {}".format(dpath, e))
+            self.inotify.close()
+            self.inotify = None
+            self.wds = {}
+            self.watched = set()
+
+    def read_events(self):
+        for event in self.inotify.read(timeout=0):
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                # Events were lost => full walk
+                self.scanned = False
+                continue
+            dpath = self.wds.get(event.wd)
+            if dpath is None:
+                continue
+            if event.mask & inotify_flags.IGNORED:
+                del self.wds[event.wd]
+                self.watched.discard(dpath)
+            self.dirty.add(dpath)
+        if not self.scanned:
+            for root in self.get_roots():
+                self.scan_dir(root, set())
+            self.scanned = True
+
+    # --------------------------------------------------------------------------
+    # Counters
+    # --------------------------------------------------------------------------
+
+    def recount(self):
+        reachable = set()
+        for name, (root, pattern, depth, count_dirs) in self.counters.items():
+            self.counts[name] = self.count(root, pattern, depth, count_dirs, reachable)
+        # Forget removed directories
+        for dpath in list(self.dirs):
+            if dpath not in reachable:
+                del self.dirs[dpath]
+
+    def count(self, root, pattern, depth, count_dirs, reachable):
+        n = 0
+        seen = set()
+        stack = [(root, 0)]
+        while stack:
+            dpath, level = stack.pop()
+            record = self.dirs.get(dpath)
+            if record is None or dpath in seen:
+                continue
+            seen.add(dpath)
+            reachable.add(dpath)
+            if depth is None or level + 1 == depth:
+                names = record[2] if count_dirs else record[1]
+                if pattern:
+                    n += len(fnmatch.filter(names, pattern))
+                else:
+                    n += len(names)
+            # Walk the whole tree anyway, so deeper directories are kept in the index
+            for subdir in record[2]:
+                stack.append((os.path.join(dpath, subdir), level + 1))
+        return n
+
+
+# ------------------------------------------------------------------------------
+# Zynthian library stats
+# ------------------------------------------------------------------------------
+
+def create_library_index():
+    my_data_dir = os.environ.get('ZYNTHIAN_MY_DATA_DIR', "/zynthian/zynthian-my-data")
+    index = FileCountIndex(CACHE_DIR + "/file_count_index.json")
+    index.add_counter("snapshots", my_data_dir + "/snapshots")
+    index.add_counter("presets_lv2", my_data_dir + "/presets/lv2", "manifest.ttl")
+    index.add_counter("presets_pianoteq", my_data_dir + "/presets/pianoteq")
+    index.add_counter("presets_puredata", my_data_dir + "/presets/puredata", depth=2, count_dirs=True)
+    index.add_counter("presets_zynaddsubfx", my_data_dir + "/presets/zynaddsubfx", "*.xiz")
+    index.add_counter("soundfonts", my_data_dir + "/soundfonts")
+    index.add_counter("audio_captures", my_data_dir + "/capture", "*.wav")
+    index.add_counter("midi_captures", my_data_dir + "/capture", "*.mid")
+    return index
+
+
+library_index = create_library_index()
+
+# ------------------------------------------------------------------------------
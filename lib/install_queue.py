@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Install Queue: background download, extraction & install of archives
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import time
+import shutil
+import asyncio
+import logging
+import zipfile
+import requests
+import tempfile
+import itertools
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.upload_handler import TMP_DIR
+from lib.archive_stream import get_tar_mode, check_member_path, extract_tar, unroll_dir, remove_path
+
+# ------------------------------------------------------------------------------
+# Install Job
+# ------------------------------------------------------------------------------
+
+
+class InstallCancelled(Exception):
+    pass
+
+
+class InstallJob(object):
+
+    QUEUED = "queued"
+    DOWNLOADING = "downloading"
+    EXTRACTING = "extracting"
+    INSTALLING = "installing"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job_id, install_func, bank_fullpath, fpath=None, url=None, eng_code=None):
+        self.job_id = job_id
+        self.install_func = install_func
+        self.bank_fullpath = bank_fullpath
+        self.fpath = fpath
+        self.url = url
+        self.eng_code = eng_code
+        if url:
+            self.name = os.path.basename(urllib.parse.urlparse(url).path) or "download"
+        else:
+            self.name = os.path.basename(fpath)
+        self.state = self.QUEUED
+        self.progress = 0
+        self.error = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise InstallCancelled()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'engine': self.eng_code,
+            'state': self.state,
+            'progress': self.progress,
+            'error': self.error
+        }
+
+
+class ProgressReader(object):
+    """File wrapper counting the bytes read, for streamed extraction."""
+
+    def __init__(self, f, on_read):
+        self.f = f
+        self.on_read = on_read
+        self.pos = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.pos += len(data)
+        self.on_read(self.pos)
+        return data
+
+
+# ------------------------------------------------------------------------------
+# Install Queue
+# ------------------------------------------------------------------------------
+
+class ZynthianInstallQueue(object):
+    """
+    Download, extract & install preset/soundfont archives in background.
+
+    Jobs run in a dedicated thread pool, so big libraries don't block the server.
+    Downloads are streamed to disk in chunks & archives are extracted member by
+    member. Jobs can be cancelled while queued or running. Listeners are called
+    in the event loop with the job on every state change & progress update (throttled).
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    DOWNLOAD_TIMEOUT = 30
+    PROGRESS_INTERVAL = 0.5
+    MAX_FINISHED_JOBS = 50
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('ZYNTHIAN_WEBCONF_INSTALL_WORKERS', 1))
+        self.max_workers = max_workers
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        self.queue = None
+        self.loop = None
+        self.executor = None
+        self.workers = []
+        self.listeners = []
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, job):
+        for callback in list(self.listeners):
+            try:
+                callback(job)
+            except Exception as e:
+                logging.error("Install listener failed: {}".format(e))
+
+    def notify_threadsafe(self, job):
+        self.loop.call_soon_threadsafe(self.notify, job)
+
+    def start(self):
+        if self.workers:
+            return
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="install")
+        self.workers = [asyncio.ensure_future(self.worker()) for i in range(self.max_workers)]
+
+    def submit(self, install_func, bank_fullpath, fpath=None, url=None, eng_code=None):
+        """
+        Queue an install job for a local file (fpath) or a remote one (url).
+        install_func(dpath, bank_fullpath) is called in a worker thread with the extracted dir/file.
+        Returns the job.
+        """
+        self.start()
+        job = InstallJob(str(next(self.job_ids)), install_func, bank_fullpath, fpath, url, eng_code)
+        self.jobs[job.job_id] = job
+        self.queue.put_nowait(job)
+        self.purge()
+        logging.info("Install job {} queued: {}".format(job.job_id, url or fpath))
+        self.notify(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.finished:
+            return False
+        job.cancel_event.set()
+        if job.state == InstallJob.QUEUED:
+            job.state = InstallJob.CANCELLED
+            remove_path(job.fpath)
+            self.notify(job)
+        return True
+
+    def get_jobs(self):
+        return [job.to_dict() for job in self.jobs.values()]
+
+    def purge(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:-self.MAX_FINISHED_JOBS]:
+            del self.jobs[job_id]
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.state != InstallJob.QUEUED:
+                continue
+            try:
+                await self.loop.run_in_executor(self.executor, self.run_job, job)
+            except Exception as e:
+                logging.error("Install job {} failed: {}".format(job.job_id, e))
+            self.notify(job)
+
+    # --------------------------------------------------------------------------
+    # Running in a worker thread
+    # --------------------------------------------------------------------------
+
+    def run_job(self, job):
+        tmp_dpath = None
+        fpath = job.fpath
+        try:
+            os.makedirs(TMP_DIR, exist_ok=True)
+            tmp_dpath = tempfile.mkdtemp(prefix="install_", dir=TMP_DIR)
+            if job.url:
+                fpath = self.download(job, tmp_dpath)
+            dpath = self.extract(job, fpath, tmp_dpath)
+            job.check_cancelled()
+            self.set_state(job, InstallJob.INSTALLING, 0)
+            logging.info("Installing '{}' => '{}' ...".format(dpath, job.bank_fullpath))
+            job.install_func(dpath, job.bank_fullpath)
+            job.state = InstallJob.DONE
+            job.progress = 100
+        except InstallCancelled:
+            job.state = InstallJob.CANCELLED
+        except Exception as e:
+            job.state = InstallJob.FAILED
+            job.error = str(e)
+            logging.error("Install job {} failed: {}".format(job.job_id, e))
+        finally:
+            # Always clean temporal files & dirs
+            remove_path(job.fpath)
+            if tmp_dpath:
+                shutil.rmtree(tmp_dpath, ignore_errors=True)
+            logging.info("Install job {} {}".format(job.job_id, job.state))
+
+    def set_state(self, job, state, progress):
+        job.state = state
+        job.progress = progress
+        self.notify_threadsafe(job)
+
+    def get_progress_callback(self, job, total):
+        last_notify = [0]
+
+        def on_progress(pos):
+            job.check_cancelled()
+            if total:
+                job.progress = min(int(100 * pos / total), 100)
+                now = time.monotonic()
+                if now - last_notify[0] >= self.PROGRESS_INTERVAL:
+                    last_notify[0] = now
+                    self.notify_threadsafe(job)
+
+        return on_progress
+
+    def download(self, job, tmp_dpath):
+        logging.info("Downloading '{}' ...".format(job.url))
+        self.set_state(job, InstallJob.DOWNLOADING, 0)
+        fpath = os.path.join(tmp_dpath, job.name)
+        with requests.get(job.url, stream=True, verify=False, timeout=self.DOWNLOAD_TIMEOUT) as res:
+            res.raise_for_status()
+            on_progress = self.get_progress_callback(job, int(res.headers.get('content-length', 0)))
+            pos = 0
+            with open(fpath, "wb") as f:
+                for data in res.iter_content(chunk_size=self.CHUNK_SIZE):
+                    f.write(data)
+                    pos += len(data)
+                    on_progress(pos)
+        return fpath
+
+    def extract(self, job, fpath, tmp_dpath):
+        """
+        Extract an archive into a directory named as the archive.
+        Other files & directories (i.e. archives extracted while uploading) are returned as is.
+        """
+        fname = os.path.basename(fpath)
+        name, mode = get_tar_mode(fname)
+        if mode:
+            dpath = os.path.join(tmp_dpath, name)
+            self.extract_tar(job, fpath, dpath, mode)
+        elif fname.lower().endswith(".zip"):
+            dpath = os.path.join(tmp_dpath, fname[:-4])
+            self.extract_zip(job, fpath, dpath)
+        else:
+            return fpath
+        unroll_dir(dpath)
+        return dpath
+
+    def extract_tar(self, job, fpath, dpath, mode):
+        logging.info("Unpacking '{}' ...".format(fpath))
+        self.set_state(job, InstallJob.EXTRACTING, 0)
+        on_progress = self.get_progress_callback(job, os.path.getsize(fpath))
+        with open(fpath, "rb") as f:
+            # Stream mode: members are read & extracted in a single pass
+            extract_tar(ProgressReader(f, on_progress), dpath, mode, job.check_cancelled)
+
+    def extract_zip(self, job, fpath, dpath):
+        logging.info("Unpacking '{}' ...".format(fpath))
+        self.set_state(job, InstallJob.EXTRACTING, 0)
+        with zipfile.ZipFile(fpath, 'r') as zf:
+            members = zf.infolist()
+            on_progress = self.get_progress_callback(job, sum(zinfo.compress_size for zinfo in members))
+            pos = 0
+            for zinfo in members:
+                on_progress(pos)
+                check_member_path(dpath, zinfo.filename)
+                zf.extract(zinfo, dpath)
+                pos += zinfo.compress_size
+
+
+install_queue = ZynthianInstallQueue()
+
+# ------------------------------------------------------------------------------
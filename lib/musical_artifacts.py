@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Musical Artifacts: cached search of musical-artifacts.com
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import json
+import time
+import asyncio
+import logging
+import urllib.parse
+from tornado.httpclient import AsyncHTTPClient
+
+from lib.upload_handler import CACHE_DIR
+
+# ------------------------------------------------------------------------------
+# Musical Artifacts Search
+# ------------------------------------------------------------------------------
+
+
+class MusicalArtifactsSearch(object):
+    """
+    Search artifacts by formats & tags, with a query per format, run concurrently.
+
+    Results are cached on disk, keyed by (formats, tags). Fresh entries (younger than
+    TTL seconds) are served without querying. Stale entries are served when the remote
+    can't be reached, so previous searches work offline. The remote URL can be changed
+    with ZYNTHIAN_WEBCONF_MUSICAL_ARTIFACTS_URL, i.e. to use a local server for testing.
+    """
+
+    VERSION = 1
+    TTL = 3600
+    MAX_ENTRIES = 64
+    REQUEST_TIMEOUT = 20
+
+    def __init__(self, fpath, url=None):
+        self.fpath = fpath
+        if url is None:
+            url = os.environ.get('ZYNTHIAN_WEBCONF_MUSICAL_ARTIFACTS_URL', "https://musical-artifacts.com")
+        self.url = url.rstrip("/")
+        # key => {'time': timestamp, 'results': [artifact, ...]}
+        self.entries = None
+        # key => future, to share running searches
+        self.pending = {}
+
+    def load(self):
+        self.entries = {}
+        try:
+            with open(self.fpath) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.entries = data['entries']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load Musical Artifacts cache '{}': {}".format(self.fpath, e))
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+            with open(self.fpath + ".tmp", "w") as f:
+                json.dump({'version': self.VERSION, 'entries': self.entries}, f)
+            os.replace(self.fpath + ".tmp", self.fpath)
+        except Exception as e:
+            logging.error("Can't save Musical Artifacts cache '{}': {}".format(self.fpath, e))
+
+    @staticmethod
+    def get_key(formats, tags):
+        return json.dumps([formats, tags])
+
+    async def search(self, formats, tags):
+        """Get the artifacts matching a comma separated list of formats & tags."""
+        if self.entries is None:
+            self.load()
+        key = self.get_key(formats, tags)
+        entry = self.entries.get(key)
+        if entry and time.time() - entry['time'] < self.TTL:
+            return entry['results']
+        future = self.pending.get(key)
+        if future is None:
+            future = self.pending[key] = asyncio.ensure_future(self.query(formats, tags))
+            future.add_done_callback(lambda f: self.pending.pop(key, None))
+        try:
+            results = await asyncio.shield(future)
+        except Exception as e:
+            if not entry:
+                raise
+            logging.warning("Can't query Musical Artifacts, using cached results: {}".format(e))
+            return entry['results']
+        self.store(key, results)
+        return results
+
+    def store(self, key, results):
+        self.entries[key] = {'time': time.time(), 'results': results}
+        # Drop the oldest entries
+        if len(self.entries) > self.MAX_ENTRIES:
+            for k in sorted(self.entries, key=lambda k: self.entries[k]['time'])[:-self.MAX_ENTRIES]:
+                del self.entries[k]
+        self.save()
+
+    async def query(self, formats, tags):
+        fmts = [fmt.strip() for fmt in formats.split(',') if fmt.strip()] if formats else []
+        responses = await asyncio.gather(*[self.fetch(fmt, tags) for fmt in fmts or [None]])
+        result = []
+        ids = set()
+        for rows in responses:
+            for row in rows:
+                # An artifact can be found with several formats
+                if row.get('id') is not None:
+                    if row['id'] in ids:
+                        continue
+                    ids.add(row['id'])
+                if "file" not in row:
+                    if "mirrors" in row and len(row['mirrors']) > 0:
+                        row['file'] = row['mirrors'][0]
+                    else:
+                        row['file'] = None
+                result.append(row)
+        return result
+
+    async def fetch(self, fmt, tags):
+        params = {}
+        if fmt:
+            params['formats'] = fmt
+        if tags:
+            params['tags'] = tags
+        query_url = self.url + "/artifacts.json"
+        if params:
+            query_url += "?" + urllib.parse.urlencode(params)
+        # The client keeps a pool of connections, shared by every search
+        res = await AsyncHTTPClient().fetch(query_url, request_timeout=self.REQUEST_TIMEOUT, validate_cert=False)
+        return json.loads(res.body)
+
+
+musical_artifacts = MusicalArtifactsSearch(CACHE_DIR + "/musical_artifacts.json")
+
+# ------------------------------------------------------------------------------
@@ -29,10 +29,11 @@ import shutil
 import logging
 import tornado.web
 from xml.etree import ElementTree
-from subprocess import check_output, STDOUT
+from subprocess import STDOUT
 
 import zynconf
 from zyngine.zynthian_engine_pianoteq import *
+from lib.command_runner import command_runner
 from lib.zynthian_config_handler import ZynthianBasicHandler
 
 # sys.path.append(os.environ.get('ZYNTHIAN_UI_DIR'))
@@ -64,7 +65,7 @@ class PianoteqHandler(ZynthianBasicHandler):
         super().get("pianoteq.html", "Pianoteq", config, errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         errors = None
         try:
             action = self.get_argument('ZYNTHIAN_PIANOTEQ_ACTION')
@@ -74,7 +75,7 @@ class PianoteqHandler(ZynthianBasicHandler):
 
         if action:
             try:
-                errors = {
+                errors = await {
                     'INSTALL_PIANOTEQ': lambda: self.do_install_pianoteq(),
                     'ACTIVATE_LICENSE': lambda: self.do_activate_license(),
                     'SAVE_CONFIG': lambda: self.do_save_config()
@@ -84,7 +85,7 @@ class PianoteqHandler(ZynthianBasicHandler):
 
         self.get(errors)
 
-    def do_install_pianoteq(self):
+    async def do_install_pianoteq(self):
         errors = None
         filename = self.get_argument('ZYNTHIAN_PIANOTEQ_FILENAME')
         if filename:
@@ -94,7 +95,7 @@ class PianoteqHandler(ZynthianBasicHandler):
             filename_parts = os.path.splitext(filename)
             # Pianoteq binaries
             if filename_parts[1].lower() == '.7z':
-                errors = self.do_install_pianoteq_binary(filename)
+                errors = await self.do_install_pianoteq_binary(filename)
             # Pianoteq instruments
             elif filename_parts[1].lower() == '.ptq':
                 errors = self.do_install_pianoteq_ptq(filename)
@@ -107,10 +108,10 @@ class PianoteqHandler(ZynthianBasicHandler):
 
         return errors
 
-    def do_install_pianoteq_binary(self, filename):
+    async def do_install_pianoteq_binary(self, filename):
         # Install new binary package
         command = self.recipes_dir + "/install_pianoteq_binary.sh {}; exit 0".format(filename)
-        result = check_output(command, shell=True, stderr=STDOUT).decode("utf-8")
+        result = await command_runner.run(command, stderr=STDOUT, timeout=None)
         # TODO! if result is OK, return None!
         return result
 
@@ -126,14 +127,14 @@ class PianoteqHandler(ZynthianBasicHandler):
             logging.error("PTQ install failed: {}".format(e))
             return "PTQ install failed: {}".format(e)
 
-    def do_activate_license(self):
+    async def do_activate_license(self):
         license_serial = self.get_argument('ZYNTHIAN_PIANOTEQ_LICENSE')
         logging.info("Configuring Pianoteq License Key: {}".format(license_serial))
 
         # Activate the License Key by calling Pianoteq binary
         command = "{} --prefs {} --activate {}; exit 0".format(PIANOTEQ_BINARY, PIANOTEQ_CONFIG_FILE, license_serial)
         try:
-            result = check_output(command, shell=True, stderr=STDOUT).decode("utf-8")
+            result = await command_runner.run(command, stderr=STDOUT)
         except Exception as e:
             logging.error(format(e))
             result = format(e)
@@ -155,7 +156,7 @@ class PianoteqHandler(ZynthianBasicHandler):
             except Exception as e:
                 logging.error("Error parsing license: %s" % e)
 
-    def do_save_config(self):
+    async def do_save_config(self):
         config = {
             "ZYNTHIAN_PIANOTEQ_LIMIT_RATE": self.get_argument('ZYNTHIAN_PIANOTEQ_LIMIT_RATE'),
             "ZYNTHIAN_PIANOTEQ_VOICE_LIMIT": self.get_argument('ZYNTHIAN_PIANOTEQ_VOICE_LIMIT'),
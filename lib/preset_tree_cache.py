@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Preset Tree Cache: cached banks & presets of every engine
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import logging
+
+# ------------------------------------------------------------------------------
+# Preset Tree Cache
+# ------------------------------------------------------------------------------
+
+
+class PresetTreeCache(object):
+    """
+    Bank list & presets of every bank, as returned by the engine's zynapi, per engine.
+
+    The presets of a bank are only queried again when the bank is invalidated after
+    a mutation, or when the mtime of its file/directory changes. The bank list is
+    queried again when invalidated or when a directory containing banks changes.
+    Banks that are not files (i.e. LV2 URIs) are only refreshed when invalidated.
+    """
+
+    def __init__(self):
+        # engine code => {'banks': [bank, ...], 'banks_sig': ..., 'presets': {bank fullpath => (sig, [preset, ...])}}
+        self.engines = {}
+
+    def get_engine_cache(self, eng_code):
+        cache = self.engines.get(eng_code)
+        if cache is None:
+            cache = self.engines[eng_code] = {'banks': None, 'banks_sig': None, 'presets': {}}
+        return cache
+
+    def get_banks(self, eng_code, engine_cls):
+        cache = self.get_engine_cache(eng_code)
+        if cache['banks'] is None or cache['banks_sig'] != self.get_banks_signature(cache['banks']):
+            banks = engine_cls.zynapi_get_banks()
+            cache['banks'] = banks
+            cache['banks_sig'] = self.get_banks_signature(banks)
+            # Forget presets of removed banks
+            fullpaths = set(b['fullpath'] for b in banks)
+            for fullpath in list(cache['presets']):
+                if fullpath not in fullpaths:
+                    del cache['presets'][fullpath]
+            logging.debug("Preset tree cache: {} banks of '{}' queried".format(len(banks), eng_code))
+        return cache['banks']
+
+    def get_bank(self, eng_code, engine_cls, bank_fullpath):
+        for b in self.get_banks(eng_code, engine_cls):
+            if b['fullpath'] is not None and b['fullpath'] == bank_fullpath:
+                return b
+        return None
+
+    def get_presets(self, eng_code, engine_cls, bank):
+        cache = self.get_engine_cache(eng_code)
+        sig = self.get_signature(bank['fullpath'])
+        entry = cache['presets'].get(bank['fullpath'])
+        if entry is None or entry[0] != sig:
+            entry = (sig, engine_cls.zynapi_get_presets(bank))
+            cache['presets'][bank['fullpath']] = entry
+        return entry[1]
+
+    def get_preset_count(self, eng_code, bank):
+        """Get the number of presets of a bank, only if they are cached & fresh. Otherwise None."""
+        entry = self.get_engine_cache(eng_code)['presets'].get(bank['fullpath'])
+        if entry is None or entry[0] != self.get_signature(bank['fullpath']):
+            return None
+        return len(entry[1])
+
+    def invalidate_banks(self, eng_code):
+        """Query the bank list again next time. Cached presets are kept."""
+        self.get_engine_cache(eng_code)['banks'] = None
+
+    def invalidate_bank(self, eng_code, bank_fullpath):
+        """Query the presets of a bank again next time."""
+        self.get_engine_cache(eng_code)['presets'].pop(bank_fullpath, None)
+
+    def invalidate(self, eng_code=None):
+        if eng_code:
+            self.engines.pop(eng_code, None)
+        else:
+            self.engines = {}
+
+    @staticmethod
+    def get_signature(fullpath):
+        try:
+            st = os.stat(fullpath)
+            return st.st_mtime_ns, st.st_size
+        except (OSError, TypeError, ValueError):
+            return None
+
+    @classmethod
+    def get_banks_signature(cls, banks):
+        dpaths = set()
+        for b in banks:
+            if isinstance(b['fullpath'], str) and b['fullpath'].startswith("/"):
+                dpaths.add(os.path.dirname(b['fullpath']))
+        return tuple((dpath, cls.get_signature(dpath)) for dpath in sorted(dpaths))
+
+
+preset_tree_cache = PresetTreeCache()
+
+# ------------------------------------------------------------------------------
@@ -24,27 +24,48 @@
 
 import os
 import copy
-import glob
 import shutil
 import logging
-import zipfile
-import tarfile
-import requests
+import asyncio
+import functools
+import threading
+import jsonpickle
 import tornado.web
+import tornado.websocket
 
 from zyngui.zynthian_gui_engine import *
 from zyngine.zynthian_chain_manager import zynthian_chain_manager
 
 from lib.upload_handler import TMP_DIR
+from lib.install_queue import InstallJob, install_queue
+from lib.musical_artifacts import musical_artifacts
+from lib.preset_tree_cache import preset_tree_cache
 from lib.zynthian_config_handler import ZynthianBasicHandler
+from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
 # ------------------------------------------------------------------------------
 # Soundfont Configuration
 # ------------------------------------------------------------------------------
 
+# The jalv zynapi instance is shared by requests & install jobs (worker threads)
+jalv_zynapi_lock = threading.Lock()
+
+
+async def acquire_jalv_zynapi_lock():
+    # Don't block the IOLoop while an install job is using the instance
+    if not jalv_zynapi_lock.acquire(blocking=False):
+        await asyncio.get_running_loop().run_in_executor(None, jalv_zynapi_lock.acquire)
+
 
 class PresetsConfigHandler(ZynthianBasicHandler):
 
+    PRESETS_PAGE_SIZE = 256
+    PRESETS_PAGE_SIZE_MAX = 4096
+    # Actions using the engine's zynapi. Search locks it only to get the formats.
+    # Installs run in background jobs, that lock it by themselves.
+    ZYNAPI_ACTIONS = ('get_tree', 'get_bank', 'new_bank', 'remove_bank', 'rename_bank',
+                      'remove_preset', 'rename_preset', 'download')
+
     @tornado.web.authenticated
     def get(self):
         config = {
@@ -57,13 +78,14 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         super().get("presets.html", "Presets & Soundfonts", config, None)
 
     @tornado.web.authenticated
-    def post(self, action):
+    async def post(self, action):
+        locked = False
         try:
             self.eng_code = self.get_argument('ENGINE', 'ZY')
             self.eng_info = self.get_engine_info()[self.eng_code]
             self.engine_cls = self.eng_info['ENGINE']
-            if self.engine_cls == zynthian_engine_jalv:
-                self.engine_cls.init_zynapi_instance(self.eng_code)
+            if action in self.ZYNAPI_ACTIONS:
+                locked = await self.acquire_zynapi()
         except Exception as e:
             logging.error("Can't initialize engine '{}': {}\n{}".format(
                 self.eng_code, e, self.eng_info))
@@ -71,6 +93,7 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         try:
             result = {
                 'get_tree': lambda: self.do_get_tree(),
+                'get_bank': lambda: self.do_get_bank(),
                 'new_bank': lambda: self.do_new_bank(),
                 'remove_bank': lambda: self.do_remove_bank(),
                 'rename_bank': lambda: self.do_rename_bank(),
@@ -81,13 +104,29 @@ class PresetsConfigHandler(ZynthianBasicHandler):
                 'install': lambda: self.do_install_url(),
                 'upload': lambda: self.do_install_file()
             }[action]()
+            if asyncio.iscoroutine(result):
+                result = await result
 
         except:
             result = {}
+        finally:
+            if locked:
+                jalv_zynapi_lock.release()
         # JSON Ouput
         if result:
             self.write(result)
 
+    async def acquire_zynapi(self):
+        """Jalv engines share a zynapi instance => lock it & init it for this engine. Returns True if locked."""
+        if self.engine_cls != zynthian_engine_jalv:
+            return False
+        await acquire_jalv_zynapi_lock()
+        try:
+            self.engine_cls.init_zynapi_instance(self.eng_code)
+        except Exception as e:
+            logging.error("Can't initialize engine '{}': {}".format(self.eng_code, e))
+        return True
+
     def do_get_tree(self):
         result = {}
         try:
@@ -102,6 +141,45 @@ class PresetsConfigHandler(ZynthianBasicHandler):
             result['errors'] = "Can't get preset tree data: {}".format(e)
         return result
 
+    def do_get_bank(self):
+        """Get a page of the presets of a bank: BANK_FULLPATH, OFFSET & LIMIT arguments."""
+        result = {}
+        try:
+            bank_fullpath = self.get_argument('BANK_FULLPATH')
+            offset = max(int(self.get_argument('OFFSET', 0)), 0)
+            limit = min(max(int(self.get_argument('LIMIT', self.PRESETS_PAGE_SIZE)), 1), self.PRESETS_PAGE_SIZE_MAX)
+            b = preset_tree_cache.get_bank(self.eng_code, self.engine_cls, bank_fullpath)
+            if b is None:
+                raise ValueError("Bank not found")
+            # Only the rows of the requested page are built
+            brow = self.get_bank_data(b, offset, True, offset, limit)
+            total = brow.get('preset_count', 0)
+            result['bank_fullpath'] = bank_fullpath
+            result['total'] = total
+            result['offset'] = offset
+            result['presets'] = brow['nodes']
+            result['next_offset'] = offset + limit if offset + limit < total else None
+        except Exception as e:
+            logging.error(e)
+            result['errors'] = "Can't get bank presets: {}".format(e)
+        return result
+
+    def do_get_bank_tree(self):
+        """Re-query the selected bank only & return its subtree."""
+        result = {}
+        bank_fullpath = self.get_argument('SEL_BANK_FULLPATH')
+        preset_tree_cache.invalidate_bank(self.eng_code, bank_fullpath)
+        try:
+            b = preset_tree_cache.get_bank(self.eng_code, self.engine_cls, bank_fullpath)
+            if b:
+                result['bank'] = self.get_bank_data(b)
+            else:
+                result.update(self.do_get_tree())
+        except Exception as e:
+            logging.error(e)
+            result['errors'] = "Can't get bank data: {}".format(e)
+        return result
+
     def do_new_bank(self):
         result = {}
         try:
@@ -109,6 +187,7 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't create new bank: {}".format(e)
+        preset_tree_cache.invalidate_banks(self.eng_code)
         result.update(self.do_get_tree())
         return result
 
@@ -120,6 +199,8 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't rename bank: {}".format(e)
+        preset_tree_cache.invalidate_banks(self.eng_code)
+        preset_tree_cache.invalidate_bank(self.eng_code, self.get_argument('SEL_FULLPATH'))
         result.update(self.do_get_tree())
         return result
 
@@ -131,6 +212,8 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't remove bank: {}".format(e)
+        preset_tree_cache.invalidate_banks(self.eng_code)
+        preset_tree_cache.invalidate_bank(self.eng_code, self.get_argument('SEL_FULLPATH'))
         result.update(self.do_get_tree())
         return result
 
@@ -142,7 +225,7 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't rename preset: {}".format(e)
-        result.update(self.do_get_tree())
+        result.update(self.do_get_bank_tree())
         return result
 
     def do_remove_preset(self):
@@ -153,7 +236,7 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't remove preset: {}".format(e)
-        result.update(self.do_get_tree())
+        result.update(self.do_get_bank_tree())
         return result
 
     def do_download(self):
@@ -196,128 +279,62 @@ class PresetsConfigHandler(ZynthianBasicHandler):
                 os.remove(fpath)
         return result
 
-    def do_search(self):
+    async def do_search(self):
         result = {}
         try:
-            maformats = self.engine_cls.zynapi_martifact_formats()
-            result['search_results'] = self.search_artifacts(
+            locked = await self.acquire_zynapi()
+            try:
+                maformats = self.engine_cls.zynapi_martifact_formats()
+            finally:
+                if locked:
+                    jalv_zynapi_lock.release()
+            # Don't keep the zynapi locked while querying
+            result['search_results'] = await musical_artifacts.search(
                 maformats, self.get_argument('MUSICAL_ARTIFACT_TAGS'))
-        except OSError as e:
+        except Exception as e:
             logging.error(e)
             result['errors'] = "Can't search Musical Artifacts: {}".format(e)
         return result
 
     def do_install_file(self):
-        result = {}
+        result = {'jobs': []}
         try:
             for fpath in self.get_argument('INSTALL_FPATH').split(","):
                 fpath = fpath.strip()
                 if len(fpath) > 0:
-                    self.install_file(fpath)
+                    # Uploaded files & staged dirs are removed after installing
+                    if not os.path.realpath(fpath).startswith(os.path.realpath(TMP_DIR) + "/"):
+                        raise ValueError("'{}' is not an uploaded file".format(fpath))
+                    result['jobs'].append(self.submit_install(fpath=fpath).to_dict())
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't install file: {}".format(e)
-        result.update(self.do_get_tree())
         return result
 
     def do_install_url(self):
-        result = {}
+        result = {'jobs': []}
         try:
-            self.install_url(self.get_argument('INSTALL_URL'))
+            result['jobs'].append(self.submit_install(url=self.get_argument('INSTALL_URL')).to_dict())
         except Exception as e:
             logging.error(e)
             result['errors'] = "Can't install URL: {}".format(e)
-        result.update(self.do_get_tree())
-        return result
-
-    def search_artifacts(self, formats, tags):
-        result = []
-        for fmt in formats.split(','):
-            query_url = "https://musical-artifacts.com/artifacts.json"
-            sep = '?'
-            if formats:
-                query_url += sep + 'formats=' + fmt
-                sep = "&"
-            if tags:
-                query_url += sep + 'tags=' + tags
-                # query_url += sep + 'q=' + tags
-
-            result += requests.get(query_url, verify=False).json()
-
-        for row in result:
-            if "file" not in row:
-                if "mirrors" in row and len(row['mirrors']) > 0:
-                    row['file'] = row['mirrors'][0]
-                else:
-                    row['file'] = None
-
         return result
 
-    def install_file(self, fpath):
-        logging.info("Unpacking '{}' ...".format(fpath))
-        dpath = fpath
-        try:
-            if fpath.endswith('.tar.bz2'):
-                dpath = fpath[:-8]
-                tar = tarfile.open(fpath, "r:bz2")
-                tar.extractall(dpath)
-            elif fpath.endswith('.tar.gz'):
-                dpath = fpath[:-7]
-                tar = tarfile.open(fpath, "r:gz")
-                tar.extractall(dpath)
-            elif fpath.endswith('.tar.xz'):
-                dpath = fpath[:-7]
-                tar = tarfile.open(fpath, "r:xz")
-                tar.extractall(dpath)
-            elif fpath.endswith('.tgz'):
-                dpath = fpath[:-4]
-                tar = tarfile.open(fpath, "r:gz")
-                tar.extractall(dpath)
-            elif fpath.endswith('.zip'):
-                dpath = fpath[:-4]
-                with zipfile.ZipFile(fpath, 'r') as soundfontZip:
-                    soundfontZip.extractall(dpath)
-
-            if os.path.isdir(dpath):
-                # Unroll nested dir
-                head, tail = os.path.split(dpath)
-                ddpath = f"{dpath}/{tail}"
-                if os.path.isdir(ddpath):
-                    # Rename subdir to avoid existing filename issues when moving up
-                    tmp_subdir = dpath + "/zyn_tmp_subdir"
-                    os.rename(ddpath, tmp_subdir)
-                    # Move up nested dir content
-                    for f in glob.glob(tmp_subdir + "/*"):
-                        shutil.move(f, dpath)
-                    # Remove empty nested dir
-                    shutil.rmtree(tmp_subdir, ignore_errors=True)
-                # Remove thrash ...
-                shutil.rmtree(dpath + "/__MACOSX", ignore_errors=True)
-
-            bank_fullpath = self.get_argument('SEL_BANK_FULLPATH')
-            logging.info("Installing '{}' => '{}' ...".format(
-                dpath, bank_fullpath))
-
-            self.engine_cls.zynapi_install(dpath, bank_fullpath)
-
-        # Always clean temporal files & dirs
-        finally:
-            try:
-                os.remove(fpath)
-            except:
-                pass
-            shutil.rmtree(dpath, ignore_errors=True)
-            pass
-
-    def install_url(self, url):
-        logging.info("Downloading '{}' ...".format(url))
-        res = requests.get(url, verify=False)
-        head, tail = os.path.split(url)
-        fpath = TMP_DIR + "/" + tail
-        with open(fpath, "wb") as df:
-            df.write(res.content)
-            df.close()
-            self.install_file(fpath)
+    def submit_install(self, fpath=None, url=None):
+        """Queue a background install job. Progress is sent by InstallMessageHandler."""
+        install_func = functools.partial(self.install_dpath, self.eng_code, self.engine_cls)
+        return install_queue.submit(install_func, self.get_argument('SEL_BANK_FULLPATH'),
+                                    fpath=fpath, url=url, eng_code=self.eng_code)
+
+    @staticmethod
+    def install_dpath(eng_code, engine_cls, dpath, bank_fullpath):
+        # Called from an install worker thread
+        if engine_cls == zynthian_engine_jalv:
+            with jalv_zynapi_lock:
+                engine_cls.init_zynapi_instance(eng_code)
+                engine_cls.zynapi_install(dpath, bank_fullpath)
+        else:
+            engine_cls.zynapi_install(dpath, bank_fullpath)
 
     def get_engine_info(self):
         engine_info = copy.copy(zynthian_chain_manager.get_engine_info())
@@ -338,7 +355,7 @@ class PresetsConfigHandler(ZynthianBasicHandler):
         superbank_row = None
         banks_data = []
         try:
-            for b in self.engine_cls.zynapi_get_banks():
+            for b in preset_tree_cache.get_banks(self.eng_code, self.engine_cls):
                 if b['fullpath'] is None:
                     if banks_data and superbank_row:
                         superbank_row['nodes'] = banks_data
@@ -355,38 +372,9 @@ class PresetsConfigHandler(ZynthianBasicHandler):
                     }
                     continue
 
-                brow = {
-                    'id': i,
-                    'text': b['text'],
-                    'name': b['name'],
-                    'fullpath': b['fullpath'],
-                    'readonly': b['readonly'],
-                    'node_type': "BANK",
-                    'nodes': [],
-                    'icon': "glyphicon glyphicon-link" if b['readonly'] else None
-                }
+                # Presets are loaded on demand (get_bank)
+                brow = self.get_bank_data(b, i, False)
                 i += 1
-                try:
-                    presets_data = []
-                    for p in self.engine_cls.zynapi_get_presets(b):
-                        prow = {
-                            'id': i,
-                            'text': p['text'],
-                            'name': p['name'],
-                            'fullpath': p['fullpath'],
-                            'readonly': p['readonly'] or b['readonly'],
-                            'bank_fullpath': b['fullpath'],
-                            'node_type': 'PRESET',
-                            'icon': "glyphicon glyphicon-link" if p['readonly'] else None
-                        }
-                        i += 1
-                        presets_data.append(prow)
-
-                    brow['nodes'] = presets_data
-
-                except Exception as e:
-                    logging.error("PRESET NODE {} => {}".format(i, e))
-
                 banks_data.append(brow)
 
             if banks_data:
@@ -401,4 +389,107 @@ class PresetsConfigHandler(ZynthianBasicHandler):
 
         return superbanks_data
 
+    def get_bank_data(self, b, i=0, presets=True, offset=0, limit=None):
+        brow = {
+            'id': i,
+            'text': b['text'],
+            'name': b['name'],
+            'fullpath': b['fullpath'],
+            'readonly': b['readonly'],
+            'node_type': "BANK",
+            'nodes': [],
+            'icon': "glyphicon glyphicon-link" if b['readonly'] else None
+        }
+        if not presets:
+            brow['preset_count'] = preset_tree_cache.get_preset_count(self.eng_code, b)
+            brow['lazy'] = True
+            return brow
+        i += 1
+        try:
+            bank_presets = preset_tree_cache.get_presets(self.eng_code, self.engine_cls, b)
+            end = len(bank_presets) if limit is None else offset + limit
+            presets_data = []
+            for p in bank_presets[offset:end]:
+                prow = {
+                    'id': i,
+                    'text': p['text'],
+                    'name': p['name'],
+                    'fullpath': p['fullpath'],
+                    'readonly': p['readonly'] or b['readonly'],
+                    'bank_fullpath': b['fullpath'],
+                    'node_type': 'PRESET',
+                    'icon': "glyphicon glyphicon-link" if p['readonly'] else None
+                }
+                i += 1
+                presets_data.append(prow)
+
+            brow['nodes'] = presets_data
+            brow['preset_count'] = len(bank_presets)
+
+        except Exception as e:
+            logging.error("PRESET NODE {} => {}".format(i, e))
+
+        return brow
+
+
+def on_install_job_update(job):
+    # Installing can create new banks
+    if job.state == InstallJob.DONE:
+        preset_tree_cache.invalidate_banks(job.eng_code)
+        preset_tree_cache.invalidate_bank(job.eng_code, job.bank_fullpath)
+
+
+install_queue.add_listener(on_install_job_update)
+
+# ------------------------------------------------------------------------------
+# Install Jobs Websocket API
+# ------------------------------------------------------------------------------
+
+
+class InstallMessageHandler(ZynthianWebSocketMessageHandler):
+    """
+    Websocket API for the install queue. Messages are dicts with an "action":
+      SUBSCRIBE: receive the list of jobs & then every job update.
+      CANCEL: cancel the job with "job_id".
+    """
+
+    subscribers = set()
+
+    @classmethod
+    def is_registered_for(cls, handler_name):
+        return handler_name == 'InstallMessageHandler'
+
+    def on_websocket_message(self, data):
+        action = data.get('action')
+        if action == 'SUBSCRIBE':
+            cls = InstallMessageHandler
+            if not cls.subscribers:
+                install_queue.add_listener(cls.on_job_update)
+            cls.subscribers.add(self.websocket)
+            self.send({'jobs': install_queue.get_jobs()})
+        elif action == 'CANCEL':
+            install_queue.cancel(str(data.get('job_id')))
+
+    def send(self, data):
+        message = ZynthianWebSocketMessage('InstallMessageHandler', data)
+        self.websocket.write_message(jsonpickle.encode(message))
+
+    @classmethod
+    def on_job_update(cls, job):
+        encoded = jsonpickle.encode(ZynthianWebSocketMessage('InstallMessageHandler', {'job': job.to_dict()}))
+        for websocket in list(cls.subscribers):
+            try:
+                websocket.write_message(encoded)
+            except tornado.websocket.WebSocketClosedError:
+                cls.remove_subscriber(websocket)
+
+    @classmethod
+    def remove_subscriber(cls, websocket):
+        cls.subscribers.discard(websocket)
+        if not cls.subscribers:
+            install_queue.remove_listener(cls.on_job_update)
+
+    def on_close(self):
+        InstallMessageHandler.remove_subscriber(self.websocket)
+
 # ------------------------------------------------------------------------------
@@ -27,10 +27,11 @@ import re
 import logging
 import tornado.web
 from collections import OrderedDict
-from subprocess import check_output, call
 
 import zynconf
 
+from lib.command_runner import command_runner
+from lib.system_metrics import system_metrics
 from lib.zynthian_config_handler import ZynthianConfigHandler
 from lib.audio_config_handler import AudioConfigHandler
 from lib.display_config_handler import DisplayConfigHandler
@@ -55,11 +56,11 @@ class RepositoryHandler(ZynthianConfigHandler):
     ]
 
     @tornado.web.authenticated
-    def get(self, errors=None):
-        super().get("Repositories", self.get_config_info(), errors)
+    async def get(self, errors=None):
+        super().get("Repositories", await self.get_config_info(), errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         postedConfig = tornado.escape.recursive_unicode(self.request.arguments)
         logging.info(postedConfig)
         try:
@@ -81,14 +82,14 @@ class RepositoryHandler(ZynthianConfigHandler):
                 if branch:
                     if branch.startswith(self.stable_branch + "-"):
                         if branch == self.stable_branch + "-last":
-                            stags = self.get_repo_tag_list(repitem[0], filter=self.stable_branch + "-")
+                            stags = await self.get_repo_tag_list(repitem[0], filter=self.stable_branch + "-")
                             stag = stags[-1]
                         else:
                             stag = branch
-                        if self.set_repo_tag(repitem[0], stag):
+                        if await self.set_repo_tag(repitem[0], stag):
                             changed_repos += 1
                     else:
-                        if self.set_repo_branch(repitem[0], branch):
+                        if await self.set_repo_branch(repitem[0], branch):
                             changed_repos += 1
             except Exception as err:
                 logging.error(err)
@@ -106,20 +107,22 @@ class RepositoryHandler(ZynthianConfigHandler):
             "ZYNTHIAN_STABLE_TAG": stable_tag
         })
 
-        config = self.get_config_info(version)
+        config = await self.get_config_info(version)
         if changed_repos > 0:
             config['ZYNTHIAN_MESSAGE'] = {
                 'type': 'html',
                 'content': "<div class='alert alert-success'>Some repo changed its branch. You may want to <a href='/sw-update'>update the software</a> for getting the latest changes.</div>"
             }
             # self.reboot_flag = True
+            # Refresh git info shown in dashboard
+            command_runner.spawn(system_metrics.refresh_slow())
 
         super().get("Repositories", config, errors)
 
-    def get_config_info(self, version=None):
+    async def get_config_info(self, version=None):
         repo_branches = []
         for repitem in self.repository_list:
-            branch = self.get_repo_current_branch(repitem[0])
+            branch = await self.get_repo_current_branch(repitem[0])
             repo_branches.append(branch)
             if version is None and branch.split('.')[0] != repo_branches[0].split('.')[0]:
                 version = "custom"
@@ -130,7 +133,7 @@ class RepositoryHandler(ZynthianConfigHandler):
 
         version_options = {}
         # Get stable tag list => WARNING! zynthian-sys rules!
-        stags = self.get_repo_tag_list("zynthian-sys", filter=self.stable_branch + "-")
+        stags = await self.get_repo_tag_list("zynthian-sys", filter=self.stable_branch + "-")
         #for stag in stags:
         #    version_options[stag] = f"stable (FROZEN {stag} => no updates!)"
         version_options[self.stable_branch + "-last"] = f"stable ({stags[-1]})"
@@ -151,8 +154,8 @@ class RepositoryHandler(ZynthianConfigHandler):
         }
         if version == "custom":
             for i, repitem in enumerate(self.repository_list):
-                options = self.get_repo_tag_list(repitem[0])
-                options += self.get_repo_branch_list(repitem[0])
+                options = await self.get_repo_tag_list(repitem[0])
+                options += await self.get_repo_branch_list(repitem[0])
                 config[f"ZYNTHIAN_REPO_{repitem[0]}"] = {
                     'type': 'select',
                     'title': repitem[0],
@@ -167,21 +170,21 @@ class RepositoryHandler(ZynthianConfigHandler):
         }
         return config
 
-    def get_repo_tag_list(self, repo_name, filter=None):
+    async def get_repo_tag_list(self, repo_name, filter=None):
         result = []
         repo_dir = self.zynthian_base_dir + "/" + repo_name
-        check_output(f"git -C '{repo_dir}' remote update origin --prune", shell=True)
-        for byteLine in check_output(f"git -C '{repo_dir}' tag -l {filter}*", shell=True).splitlines():
-            result.append(byteLine.decode("utf-8").strip())
+        await command_runner.run(["git", "-C", repo_dir, "remote", "update", "origin", "--prune"])
+        for line in (await command_runner.run(f"git -C '{repo_dir}' tag -l {filter}*")).splitlines():
+            result.append(line.strip())
         result.sort()
         return result
 
-    def get_repo_branch_list(self, repo_name):
+    async def get_repo_branch_list(self, repo_name):
         result = []
         repo_dir = self.zynthian_base_dir + "/" + repo_name
-        check_output(f"git -C '{repo_dir}' remote update origin --prune", shell=True)
-        for byteLine in check_output(f"git -C '{repo_dir}' branch -a", shell=True).splitlines():
-            bname = byteLine.decode("utf-8").strip()
+        await command_runner.run(["git", "-C", repo_dir, "remote", "update", "origin", "--prune"])
+        for line in (await command_runner.run(["git", "-C", repo_dir, "branch", "-a"])).splitlines():
+            bname = line.strip()
             if bname.startswith("*"):
                 bname = bname[2:]
             if bname.startswith("remotes/origin/"):
@@ -193,30 +196,28 @@ class RepositoryHandler(ZynthianConfigHandler):
         result.sort()
         return result
 
-    def get_repo_current_branch(self, repo_name):
+    async def get_repo_current_branch(self, repo_name):
         repo_dir = self.zynthian_base_dir + "/" + repo_name
-        for byteLine in check_output(f"git -C '{repo_dir}' branch | grep \* | cut -d ' ' -f2",
-                                    shell=True).splitlines():
-            return byteLine.decode("utf-8")
+        for line in (await command_runner.run(f"git -C '{repo_dir}' branch | grep \\* | cut -d ' ' -f2")).splitlines():
+            return line
 
-    def set_repo_tag(self, repo_name, tag_name):
+    async def set_repo_tag(self, repo_name, tag_name):
         logging.info(f"Changing repository '{repo_name}' to tag '{tag_name}'")
         repo_dir = self.zynthian_base_dir + "/" + repo_name
-        current_branch = self.get_repo_current_branch(repo_name)
+        current_branch = await self.get_repo_current_branch(repo_name)
         if tag_name != current_branch:
             logging.info(f"... needs change: '{current_branch}' != '{tag_name}'")
-            check_output(
-                f"cd {repo_dir}; git checkout .; git branch -D {tag_name}; git checkout tags/{tag_name} -b {tag_name}",
-               shell=True)
+            await command_runner.run(
+                f"cd {repo_dir}; git checkout .; git branch -D {tag_name}; git checkout tags/{tag_name} -b {tag_name}")
             return True
 
-    def set_repo_branch(self, repo_name, branch_name):
+    async def set_repo_branch(self, repo_name, branch_name):
         logging.info(f"Changing repository '{repo_name}' to branch '{branch_name}'")
         repo_dir = self.zynthian_base_dir + "/" + repo_name
-        current_branch = self.get_repo_current_branch(repo_name)
+        current_branch = await self.get_repo_current_branch(repo_name)
         if branch_name != current_branch:
             logging.info(f"... needs change: '{current_branch}' != '{branch_name}'")
-            check_output(f"cd {repo_dir}; git checkout .; git checkout {branch_name}", shell=True)
+            await command_runner.run(f"cd {repo_dir}; git checkout .; git checkout {branch_name}")
             return True
 
 # -----------------------------------------------------------------------------
\ No newline at end of file
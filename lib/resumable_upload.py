@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Resumable Upload Handler: chunked uploads, tus protocol style
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import shutil
+import asyncio
+import hashlib
+import logging
+import tornado.web
+
+from lib.upload_handler import TMP_DIR, UPLOADS_DIR, MAX_STREAMED_SIZE
+
+# ------------------------------------------------------------------------------
+# Resumable Upload
+# ------------------------------------------------------------------------------
+
+
+class ResumableUploadError(Exception):
+    pass
+
+
+class ResumableUpload(object):
+    """
+    File being uploaded in chunks. Data is written at the current offset of a
+    preallocated file & hashed on the fly. The offset is saved after every chunk,
+    so an interrupted upload can be resumed, even after a restart.
+    """
+
+    def __init__(self, upload_id, fname, length, dest_dpath, checksum=None, offset=0):
+        self.upload_id = upload_id
+        self.fname = fname
+        self.length = length
+        self.dest_dpath = dest_dpath
+        # Expected SHA-256 of the whole file (hex), if known
+        self.checksum = checksum
+        self.offset = offset
+        self.data_fpath = "{}/{}.part".format(UPLOADS_DIR, upload_id)
+        self.info_fpath = "{}/{}.json".format(UPLOADS_DIR, upload_id)
+        # Incremental hash of data until offset. Lost on restart => recalculated at the end.
+        self.hasher = hashlib.sha256() if offset == 0 else None
+        self.busy = False
+        self.fd = None
+        self.chunk_hasher = None
+        self.chunk_checksum = None
+        self.chunk_start = None
+        self.saved_hasher = None
+
+    @classmethod
+    def create(cls, fname, length, dest_dpath, checksum=None):
+        upload = cls(uuid.uuid4().hex, fname, length, dest_dpath, checksum)
+        fd = os.open(upload.data_fpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            # Reserve the space, so the upload doesn't fail when almost done
+            if length > 0:
+                try:
+                    os.posix_fallocate(fd, 0, length)
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, length)
+        finally:
+            os.close(fd)
+        upload.save_info()
+        logging.info("Resumable upload {} created: '{}' ({} bytes)".format(upload.upload_id, fname, length))
+        return upload
+
+    @classmethod
+    def load(cls, upload_id):
+        try:
+            with open("{}/{}.json".format(UPLOADS_DIR, upload_id)) as f:
+                info = json.load(f)
+            return cls(upload_id, info['fname'], info['length'], info['dest_dpath'], info['checksum'], info['offset'])
+        except FileNotFoundError:
+            return None
+
+    def save_info(self):
+        info = {
+            'fname': self.fname,
+            'length': self.length,
+            'dest_dpath': self.dest_dpath,
+            'checksum': self.checksum,
+            'offset': self.offset
+        }
+        with open(self.info_fpath + ".tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(self.info_fpath + ".tmp", self.info_fpath)
+
+    @property
+    def complete(self):
+        return self.offset >= self.length
+
+    def begin(self, chunk_checksum=None):
+        """Start receiving a chunk at the current offset. With a checksum, the chunk is all or nothing."""
+        self.busy = True
+        self.fd = os.open(self.data_fpath, os.O_WRONLY)
+        self.chunk_start = self.offset
+        self.chunk_checksum = chunk_checksum
+        self.chunk_hasher = hashlib.sha256() if chunk_checksum else None
+        self.saved_hasher = self.hasher.copy() if self.hasher is not None else None
+
+    def write(self, data):
+        if self.offset + len(data) > self.length:
+            raise ResumableUploadError("Upload exceeds its length")
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(self.fd, view, self.offset)
+            self.offset += n
+            view = view[n:]
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.chunk_hasher is not None:
+            self.chunk_hasher.update(data)
+
+    def end(self, aborted=False):
+        """Finish receiving a chunk. Returns False if it was rejected & the offset restored."""
+        accepted = True
+        if self.chunk_hasher is not None and (aborted or self.chunk_hasher.digest() != self.chunk_checksum):
+            accepted = False
+            self.offset = self.chunk_start
+            self.hasher = self.saved_hasher
+        try:
+            if accepted:
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.save_info()
+        finally:
+            self.fd = None
+            self.chunk_hasher = None
+            self.saved_hasher = None
+            self.busy = False
+        return accepted
+
+    def finish(self):
+        """Check the whole file checksum & move it to its destination. Returns (destination path, sha256)."""
+        if self.hasher is None:
+            self.hasher = hashlib.sha256()
+            with open(self.data_fpath, "rb") as f:
+                for data in iter(lambda: f.read(1024 * 1024), b""):
+                    self.hasher.update(data)
+        digest = self.hasher.hexdigest()
+        if self.checksum and digest != self.checksum.lower():
+            self.remove()
+            raise ResumableUploadError("Checksum mismatch: {} != {}".format(digest, self.checksum))
+        dest_fpath = os.path.join(self.dest_dpath, self.fname)
+        # Renamed if it's in the same filesystem, copied otherwise
+        shutil.move(self.data_fpath, dest_fpath)
+        self.remove()
+        logging.info("Resumable upload {} done: '{}' (sha256 {})".format(self.upload_id, dest_fpath, digest))
+        return dest_fpath, digest
+
+    def remove(self):
+        for fpath in (self.data_fpath, self.info_fpath):
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+
+
+class ResumableUploads(object):
+    """Uploads in progress, by id. Uploads not resumed for a day are removed."""
+
+    EXPIRE_TIME = 24 * 3600
+
+    def __init__(self):
+        self.uploads = {}
+
+    def get(self, upload_id):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            upload = ResumableUpload.load(upload_id)
+            if upload:
+                self.uploads[upload_id] = upload
+        return upload
+
+    def create(self, fname, length, dest_dpath, checksum=None):
+        self.expire()
+        upload = ResumableUpload.create(fname, length, dest_dpath, checksum)
+        self.uploads[upload.upload_id] = upload
+        return upload
+
+    def remove(self, upload):
+        upload.remove()
+        self.uploads.pop(upload.upload_id, None)
+
+    def expire(self):
+        now = time.time()
+        with os.scandir(UPLOADS_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".json"):
+                    continue
+                upload_id = entry.name[:-5]
+                upload = self.uploads.get(upload_id)
+                if upload and upload.busy:
+                    continue
+                try:
+                    if now - entry.stat().st_mtime > self.EXPIRE_TIME:
+                        logging.info("Resumable upload {} expired".format(upload_id))
+                        self.remove(upload or ResumableUpload(upload_id, None, 0, None))
+                except OSError:
+                    pass
+
+
+resumable_uploads = ResumableUploads()
+
+# ------------------------------------------------------------------------------
+# Resumable Upload Handler
+# ------------------------------------------------------------------------------
+
+
+@tornado.web.stream_request_body
+class ResumableUploadHandler(tornado.web.RequestHandler):
+    """
+    Chunked & resumable uploads, following the tus protocol (creation, termination & checksum):
+      POST /upload/resumable => create an upload. Headers: Upload-Length & Upload-Metadata
+        (filename & optional sha256 of the whole file, base64 encoded). Query: destinationPath.
+        Returns the upload URL in the Location header.
+      HEAD /upload/resumable/<id> => current offset, in the Upload-Offset header.
+      PATCH /upload/resumable/<id> => write a chunk at Upload-Offset, with an optional
+        "Upload-Checksum: sha256 <base64>" header. The chunk that completes the upload returns
+        the destination path in the body & its SHA-256 in the Upload-Checksum header.
+      DELETE /upload/resumable/<id> => cancel an upload.
+    """
+
+    TUS_VERSION = "1.0.0"
+    METADATA_RE = re.compile(r"^([\w.-]+)(?: ([A-Za-z0-9+/=]*))?$")
+
+    def get_current_user(self):
+        return self.get_secure_cookie("user")
+
+    def prepare(self):
+        self.upload = None
+        # Request bodies are streamed before calling the method => check the user here
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+        self.set_header("Tus-Resumable", self.TUS_VERSION)
+        if self.request.method == "PATCH":
+            self.request.connection.set_max_body_size(MAX_STREAMED_SIZE)
+            upload = self.get_upload(self.path_args[0] if self.path_args else None)
+            if upload.busy:
+                raise tornado.web.HTTPError(409, "Upload {} is receiving another chunk or finishing".format(upload.upload_id))
+            try:
+                offset = int(self.request.headers.get("Upload-Offset"))
+                length = int(self.request.headers.get("Content-Length", "0"))
+            except (TypeError, ValueError):
+                raise tornado.web.HTTPError(400, "Wrong Upload-Offset")
+            if offset != upload.offset:
+                raise tornado.web.HTTPError(409, "Wrong offset {}, expected {}".format(offset, upload.offset))
+            if offset + length > upload.length:
+                raise tornado.web.HTTPError(413)
+            upload.begin(self.get_chunk_checksum())
+            self.upload = upload
+
+    def get_upload(self, upload_id):
+        upload = resumable_uploads.get(upload_id) if upload_id else None
+        if upload is None:
+            raise tornado.web.HTTPError(404)
+        return upload
+
+    def get_chunk_checksum(self):
+        checksum = self.request.headers.get("Upload-Checksum")
+        if not checksum:
+            return None
+        try:
+            algorithm, value = checksum.split(" ", 1)
+            if algorithm != "sha256":
+                raise ValueError(algorithm)
+            return base64.b64decode(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Unsupported checksum '{}'".format(checksum))
+
+    def get_metadata(self):
+        metadata = {}
+        for item in self.request.headers.get("Upload-Metadata", "").split(","):
+            m = self.METADATA_RE.match(item.strip())
+            if m:
+                metadata[m.group(1)] = base64.b64decode(m.group(2) or "").decode("utf-8")
+        return metadata
+
+    def data_received(self, chunk):
+        if self.upload:
+            self.upload.write(chunk)
+
+    def options(self, upload_id=None):
+        self.set_header("Tus-Version", self.TUS_VERSION)
+        self.set_header("Tus-Extension", "creation,termination,checksum")
+        self.set_header("Tus-Checksum-Algorithm", "sha256")
+        self.set_header("Tus-Max-Size", str(MAX_STREAMED_SIZE))
+        self.set_status(204)
+
+    def post(self, upload_id=None):
+        metadata = self.get_metadata()
+        fname = os.path.basename(metadata.get('filename', ""))
+        try:
+            length = int(self.request.headers.get("Upload-Length"))
+        except (TypeError, ValueError):
+            length = -1
+        if not fname or not 0 <= length <= MAX_STREAMED_SIZE:
+            raise tornado.web.HTTPError(400, "Wrong upload filename or length")
+        dest_dpath = self.get_argument("destinationPath", TMP_DIR)
+        upload = resumable_uploads.create(fname, length, dest_dpath, metadata.get('sha256'))
+        self.set_status(201)
+        self.set_header("Location", "{}/{}".format(self.request.path.rstrip("/"), upload.upload_id))
+        self.set_header("Upload-Offset", "0")
+
+    def head(self, upload_id=None):
+        upload = self.get_upload(upload_id)
+        self.set_header("Upload-Offset", str(upload.offset))
+        self.set_header("Upload-Length", str(upload.length))
+        self.set_header("Cache-Control", "no-store")
+
+    async def patch(self, upload_id=None):
+        upload = self.upload
+        self.upload = None
+        if not upload.end():
+            raise tornado.web.HTTPError(460, reason="Checksum Mismatch")
+        self.set_header("Upload-Offset", str(upload.offset))
+        if not upload.complete:
+            self.set_status(204)
+            return
+        # Busy until finished, so retried requests get a 409 instead of finishing it again
+        upload.busy = True
+        try:
+            # Hashing a big file could be needed after a restart => don't block
+            dest_fpath, digest = await asyncio.get_running_loop().run_in_executor(None, upload.finish)
+        except ResumableUploadError as e:
+            logging.error("Resumable upload {} failed: {}".format(upload.upload_id, e))
+            resumable_uploads.remove(upload)
+            raise tornado.web.HTTPError(460, reason="Checksum Mismatch")
+        finally:
+            upload.busy = False
+        resumable_uploads.remove(upload)
+        self.set_header("Upload-Checksum", "sha256 " + base64.b64encode(bytes.fromhex(digest)).decode())
+        self.write(dest_fpath)
+
+    def delete(self, upload_id=None):
+        upload = self.get_upload(upload_id)
+        if upload.busy:
+            raise tornado.web.HTTPError(409)
+        resumable_uploads.remove(upload)
+        self.set_status(204)
+
+    def on_connection_close(self):
+        # Chunk interrupted => keep the received data, unless it has a checksum
+        if self.upload:
+            self.upload.end(aborted=True)
+            self.upload = None
+
+    def on_finish(self):
+        # Chunk failed while receiving it
+        self.on_connection_close()
+
+# ------------------------------------------------------------------------------
@@ -27,8 +27,8 @@ import re
 import PAM
 import logging
 import tornado.web
-from subprocess import check_output
 
+from lib.command_runner import command_runner
 from lib.zynthian_config_handler import ZynthianConfigHandler
 
 # ------------------------------------------------------------------------------
@@ -84,18 +84,18 @@ class SecurityConfigHandler(ZynthianConfigHandler):
         super().get("Security/Access", config, errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         params = tornado.escape.recursive_unicode(self.request.arguments)
         logging.debug(f"COMMAND: {params['_command'][0]}")
         if params['_command'][0] == "REGENERATE_KEYS":
             cmd = os.environ.get('ZYNTHIAN_SYS_DIR') + "/sbin/regenerate_keys.sh"
-            check_output(cmd, shell=True)
+            await command_runner.run(cmd, timeout=None)
             self.redirect('/sys-reboot')
         else:
-            errors = self.update_system_config(params)
+            errors = await self.update_system_config(params)
             self.get(errors)
 
-    def update_system_config(self, config):
+    async def update_system_config(self, config):
         # PAM service callback
         def pam_conv(auth, query_list, userData):
             resp = []
@@ -148,14 +148,14 @@ class SecurityConfigHandler(ZynthianConfigHandler):
 
             # Change VNC password
             try:
-                check_output(f"echo \"{config['PASSWORD'][0]}\" | vncpasswd -f > /root/.vnc/passwd; chmod go-r /root/.vnc/passwd", shell=True)
+                await command_runner.run(f"echo \"{config['PASSWORD'][0]}\" | vncpasswd -f > /root/.vnc/passwd; chmod go-r /root/.vnc/passwd")
             except Exception as e:
                 logging.error(f"Can't set new password for VNC Server! => {e}")
                 return {'REPEAT_PASSWORD': "Can't set new password for VNC Server!"}
 
             # Change WIFI password
             try:
-                check_output(f"nmcli con modify zynthian-ap wifi-sec.psk \"{config['PASSWORD'][0]}\"", shell=True)
+                await command_runner.run(["nmcli", "con", "modify", "zynthian-ap", "wifi-sec.psk", config['PASSWORD'][0]])
             except Exception as e:
                 logging.error(f"Can't set new password for WIFI HotSpot! => {e}")
                 return {'REPEAT_PASSWORD': "Can't set new password for WIFI HotSpot!"}
@@ -184,10 +184,10 @@ class SecurityConfigHandler(ZynthianConfigHandler):
                 f.write(contents)
                 f.close()
 
-            check_output(["hostnamectl", "set-hostname", newHostname])
+            await command_runner.run(["hostnamectl", "set-hostname", newHostname])
 
             try:
-                check_output(f"nmcli con modify zynthian-ap wifi.ssid \"{newHostname}\"", shell=True)
+                await command_runner.run(["nmcli", "con", "modify", "zynthian-ap", "wifi.ssid", newHostname])
             except Exception as e:
                 logging.error(f"Can't set WIFI HotSpot name! => {e}")
                 return {'HOSTNAME': "Can't set WIFI HotSpot name!"}
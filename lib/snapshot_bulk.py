@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Snapshot Bulk: transactional bulk operations on snapshot files
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import ExitStack
+
+from lib.snapshot_patch import SnapshotPatch
+
+# ------------------------------------------------------------------------------
+# Snapshot Bulk Transaction
+# ------------------------------------------------------------------------------
+
+
+class SnapshotBulkError(Exception):
+    pass
+
+
+class SnapshotBulkTransaction(object):
+    """
+    Run a list of actions on snapshot files & banks, all or none.
+
+    Actions are dicts, applied in order, so a source path is the path after previous actions:
+      {"action": "move", "src": path, "bank": bank path, "prog_num": n} => move and/or renumber
+      {"action": "renumber", "src": path, "prog_num": n} => change the program number
+      {"action": "copy", "src": path, "bank": bank path, "prog_num": n}
+      {"action": "delete", "src": path} => remove a snapshot or a whole bank
+    bank & prog_num are optional for move & copy. Default is the same bank & number.
+
+    Deleted files are moved into a staging directory until the transaction is done,
+    so every action can be rolled back if a later one fails.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, root, actions):
+        self.root = os.path.normpath(root)
+        self.actions = actions
+        # Executed steps: (action, src, dst)
+        self.journal = []
+        self.trash_dpath = None
+
+    def run(self):
+        if not isinstance(self.actions, list) or not self.actions:
+            raise SnapshotBulkError("Actions must be a non empty list")
+        with self.lock, ExitStack() as stack:
+            # Hold the patch locks of the involved files, so they are not edited meanwhile
+            srcs = sorted(set(self.check_path(action.get('src')) for action in self.actions if isinstance(action, dict)))
+            for src in srcs:
+                stack.enter_context(SnapshotPatch.get_lock(src))
+            try:
+                for action in self.actions:
+                    self.run_action(action)
+            except Exception as e:
+                logging.error("Snapshot bulk action failed, rolling back: {}".format(e))
+                self.rollback()
+                raise
+            finally:
+                self.remove_trash()
+        logging.info("Snapshot bulk transaction done: {} actions".format(len(self.actions)))
+
+    def check_path(self, path):
+        if not isinstance(path, str):
+            raise SnapshotBulkError("Wrong path '{}'".format(path))
+        path = os.path.normpath(path)
+        if not path.startswith(self.root + "/"):
+            raise SnapshotBulkError("Wrong path '{}'".format(path))
+        return path
+
+    def run_action(self, action):
+        try:
+            name = action['action']
+            src = self.check_path(action['src'])
+        except (KeyError, TypeError):
+            raise SnapshotBulkError("Wrong action: {}".format(action))
+        if not os.path.exists(src):
+            raise SnapshotBulkError("'{}' not found".format(src))
+
+        if name == 'delete':
+            self.delete(src)
+            return
+        if name not in ('move', 'renumber', 'copy'):
+            raise SnapshotBulkError("Unknown action '{}'".format(name))
+        if os.path.isdir(src):
+            raise SnapshotBulkError("Can't {} a bank: '{}'".format(name, src))
+
+        dst = self.get_dst_fpath(src, action.get('bank') if name != 'renumber' else None, action.get('prog_num'))
+        if dst == src:
+            return
+        if os.path.exists(dst):
+            raise SnapshotBulkError("This bank/program combination is already used: {}".format(dst))
+        if name == 'copy':
+            shutil.copyfile(src, dst)
+        else:
+            os.rename(src, dst)
+        self.journal.append((name, src, dst))
+
+    def get_dst_fpath(self, src, bank=None, prog_num=None):
+        dpath, fname = os.path.split(src)
+        if bank:
+            dpath = self.check_path(bank)
+            if os.path.dirname(dpath) != self.root or not os.path.isdir(dpath):
+                raise SnapshotBulkError("Bank '{}' doesn't exist".format(bank))
+        if prog_num is not None and prog_num != "":
+            try:
+                num = int(prog_num)
+            except (TypeError, ValueError):
+                num = -1
+            if not 0 <= num < 128:
+                raise SnapshotBulkError("Wrong program number '{}'".format(prog_num))
+            # Replace the program number prefix, keeping the name
+            parts = fname[:-4].split("-", 1)
+            if parts[0].isdigit():
+                parts = parts[1:]
+            fname = "-".join([str(num).zfill(3)] + parts) + ".zss"
+        return os.path.join(dpath, fname)
+
+    def delete(self, src):
+        if self.trash_dpath is None:
+            # Same filesystem as snapshots, so files are just renamed
+            self.trash_dpath = tempfile.mkdtemp(prefix=".snapshots_trash_", dir=os.path.dirname(self.root))
+        dst = os.path.join(self.trash_dpath, str(len(self.journal)))
+        os.rename(src, dst)
+        self.journal.append(('delete', src, dst))
+
+    def rollback(self):
+        for name, src, dst in reversed(self.journal):
+            try:
+                if name == 'copy':
+                    os.remove(dst)
+                else:
+                    os.rename(dst, src)
+            except Exception as e:
+                logging.error("Can't roll back {} '{}' => '{}': {}".format(name, src, dst, e))
+        self.journal = []
+
+    def remove_trash(self):
+        if self.trash_dpath:
+            shutil.rmtree(self.trash_dpath, ignore_errors=True)
+            self.trash_dpath = None
+
+# ------------------------------------------------------------------------------
@@ -23,17 +23,19 @@
 # ********************************************************************
 
 import os
-import re
 import json
 import base64
 import shutil
 import base64
+import asyncio
 import logging
 import tornado.web
 from collections import OrderedDict
 
+from lib.snapshot_index import snapshot_index
+from lib.snapshot_bulk import SnapshotBulkTransaction
+from lib.snapshot_patch import SnapshotPatch, SnapshotPatchError
 from lib.zynthian_config_handler import ZynthianBasicHandler
-from zyngine.zynthian_legacy_snapshot import zynthian_legacy_snapshot
 
 # ------------------------------------------------------------------------------
 # Snapshot Config Handler
@@ -53,10 +55,10 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
     def get(self, errors=None):
         config = OrderedDict([])
 
-        ssdata = self.get_snapshots_data()
-        # logging.debug(snapshot)
+        # Banks only. The tree is loaded lazily from SnapshotTreeHandler
+        ssdata = self.list_nodes(self.SNAPSHOTS_DIRECTORY)
+        snapshot_index.commit()
 
-        config['SNAPSHOTS'] = json.dumps(ssdata)
         config['BANKS'] = self.get_existing_banks(ssdata, True)
         config['NEXT_BANK_NUM'] = self.calculate_next_bank(
             self.get_existing_banks(ssdata, False))
@@ -67,7 +69,7 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
         config['ZYNTHIAN_UPLOAD_MULTIPLE'] = True
 
         # Try to maintain selection after a POST action...
-        config['SEL_NODE_ID'] = self.get_selected_node_id(ssdata)
+        config['SEL_FULLPATH'] = self.get_selected_fullpath(ssdata)
 
         super().get("snapshots.html", "Snapshots", config, errors)
 
@@ -83,9 +85,9 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
                 'save_as_last_state': lambda: self.do_save_as_last_state()
             }[action]()
 
-        ssdata = self.get_snapshots_data()
-        result['SNAPSHOTS'] = ssdata
-        result['SEL_NODE_ID'] = self.get_selected_node_id(ssdata)
+        # Without details, as the page reloads the tree lazily
+        ssdata = self.get_snapshots_data(False)
+        result['SEL_FULLPATH'] = self.get_selected_fullpath(ssdata)
         result['BANKS'] = self.get_existing_banks(ssdata, True)
         result['NEXT_BANK_NUM'] = self.calculate_next_bank(
             self.get_existing_banks(ssdata, False))
@@ -98,7 +100,7 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
     def do_new_bank(self):
         result = {}
         existing_banks = self.get_existing_banks(
-            self.get_snapshots_data(), False)
+            self.list_nodes(self.SNAPSHOTS_DIRECTORY), False)
         new_bank_dname = self.get_argument('NEW_BANK_NUM', str(
             self.calculate_next_bank(existing_banks))).zfill(3)
         if new_bank_dname in existing_banks:
@@ -200,7 +202,8 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
         shutil.copyfile(src, dest)
         return result
 
-    def get_existing_banks(self, snapshot_data, incl_name):
+    @staticmethod
+    def get_existing_banks(snapshot_data, incl_name):
         existing_banks = []
 
         for item in snapshot_data:
@@ -213,7 +216,8 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
         # logging.info("existingbanks: " + str(existing_banks))
         return sorted(existing_banks)
 
-    def get_snapshot_warning(self, snapshot_data):
+    @staticmethod
+    def get_snapshot_warning(snapshot_data):
         duplicate_prog_nums = ''
         for item in snapshot_data:
             if 'nodes' in item:
@@ -229,111 +233,136 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
         else:
             return ''
 
-    def calculate_next_bank(self, existing_banks):
+    @staticmethod
+    def calculate_next_bank(existing_banks):
         for i in range(0, 128):
             if str(i).zfill(3) not in existing_banks:
                 return i
         return ''
 
-    def get_snapshots_data(self):
-        return self.walk_directory(SnapshotConfigHandler.SNAPSHOTS_DIRECTORY)
+    def get_snapshots_data(self, details=True):
+        ssdata = self.walk_directory(SnapshotConfigHandler.SNAPSHOTS_DIRECTORY, details=details)
+        snapshot_index.commit()
+        return ssdata
 
-    def walk_directory(self, directory, idx=0, _bank_num=None, _bank_name=None):
+    @classmethod
+    def walk_directory(cls, directory, idx=0, _bank_num=None, _bank_name=None, details=True):
         snapshots = []
-        file_list = sorted(os.listdir(directory))
-        for f in file_list:
-            fullpath = os.path.join(directory, f)
-            state = {}
-            if os.path.isdir(fullpath):
-                node_type = "BANK"
-                parts = f.split("-", 1)
-                if f[0] == ".":
-                    state["expanded"] = False
-                bank_num = parts[0]
-                if len(parts) == 2:
-                    bank_name = parts[1]
-                else:
-                    bank_name = ""
-                prog_name = ""
-                prog_num = ""
-                prog_details = ""
-                name = bank_name
-            else:
-                fname = f[:-4]
-                fext = f[-4:]
-                if fext == ".zss":
-                    node_type = "SNAPSHOT"
-                    if _bank_num is not None:
-                        bank_num = _bank_num.zfill(3)
-                        bank_name = _bank_name
-                        parts = fname.split("-", 1)
-                        prog_num = parts[0]
-                        if len(parts) == 2:
-                            prog_name = fname[len(prog_num)+1:]
-                        else:
-                            prog_name = ""
-                    else:
-                        bank_num = ''
-                        bank_name = ''
-                        prog_num = ''
-                        prog_name = fname
-                    name = prog_name
-
-                    with open(fullpath) as ssfile:
-                        try:
-                            prog_details = zynthian_legacy_snapshot().convert_state(json.load(ssfile))
-                        except:
-                            pass
-                        ssfile.close()
-                else:
-                    continue
-
-            snapshot = {
-                'id': idx,
-                'text': f,
-                'name': name,
-                'state': state,
-                'fullpath': fullpath,
-                'node_type': node_type,
-                'bank_num': bank_num,
-                'bank_name': bank_name,
-                'prog_num': prog_num,
-                'prog_name': prog_name,
-                'prog_details': prog_details
-            }
+        for entry in cls.list_directory(directory):
+            snapshot = cls.create_node(entry.name, entry.path, entry.is_dir(), idx, _bank_num, _bank_name, details)
+            if snapshot is None:
+                continue
 
             idx += 1
-            if os.path.isdir(fullpath):
-                snapshot['nodes'] = self.walk_directory(
-                    fullpath, idx, bank_num, bank_name)
+            if snapshot['node_type'] == "BANK":
+                snapshot['nodes'] = cls.walk_directory(
+                    entry.path, idx, snapshot['bank_num'], snapshot['bank_name'], details)
                 idx += len(snapshot['nodes'])
 
             snapshots.append(snapshot)
 
         return snapshots
 
-    def get_selected_node_id(self, ssdata):
-        selected_node = 0
+    @classmethod
+    def list_nodes(cls, directory, _bank_num=None, _bank_name=None, details=False):
+        """Get the nodes of a directory, without their children."""
+        nodes = []
+        for entry in cls.list_directory(directory):
+            node = cls.create_node(entry.name, entry.path, entry.is_dir(), len(nodes), _bank_num, _bank_name, details)
+            if node:
+                nodes.append(node)
+        return nodes
+
+    @staticmethod
+    def list_directory(directory):
+        """Get the sorted entries of a directory. Index entries of missing files are dropped."""
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        snapshot_index.prune_dir(directory, [entry.name for entry in entries])
+        return entries
+
+    @staticmethod
+    def create_node(f, fullpath, is_dir, idx=0, _bank_num=None, _bank_name=None, details=True):
+        """Create the tree node of a bank directory or snapshot file. Returns None for other files."""
+        state = {}
+        if is_dir:
+            node_type = "BANK"
+            parts = f.split("-", 1)
+            if f[0] == ".":
+                state["expanded"] = False
+            bank_num = parts[0]
+            if len(parts) == 2:
+                bank_name = parts[1]
+            else:
+                bank_name = ""
+            prog_name = ""
+            prog_num = ""
+            prog_details = ""
+            name = bank_name
+        else:
+            fname = f[:-4]
+            fext = f[-4:]
+            if fext == ".zss":
+                node_type = "SNAPSHOT"
+                if _bank_num is not None:
+                    bank_num = _bank_num.zfill(3)
+                    bank_name = _bank_name
+                    parts = fname.split("-", 1)
+                    prog_num = parts[0]
+                    if len(parts) == 2:
+                        prog_name = fname[len(prog_num)+1:]
+                    else:
+                        prog_name = ""
+                else:
+                    bank_num = ''
+                    bank_name = ''
+                    prog_num = ''
+                    prog_name = fname
+                name = prog_name
+                if details:
+                    # Parsed only if the file changed since last time
+                    prog_details = snapshot_index.get_details(fullpath)
+                else:
+                    prog_details = ""
+            else:
+                return None
+
+        return {
+            'id': idx,
+            'text': f,
+            'name': name,
+            'state': state,
+            'fullpath': fullpath,
+            'node_type': node_type,
+            'bank_num': bank_num,
+            'bank_name': bank_name,
+            'prog_num': prog_num,
+            'prog_name': prog_name,
+            'prog_details': prog_details
+        }
+
+    def get_selected_fullpath(self, ssdata):
+        selected_node = ''
         try:
             for ssbank in ssdata:
                 try:
                     if int(ssbank['bank_num']) == int(self.get_argument('SEL_BANK_NUM')):
                         if not selected_node:
-                            selected_node = ssbank['id']
+                            selected_node = ssbank['fullpath']
 
                     if ssbank['nodes']:
                         for ssprog in ssbank['nodes']:
                             try:
                                 if int(ssprog['prog_num']) == int(self.get_argument('SEL_PROG_NUM')):
-                                    selected_node = ssprog['id']
+                                    selected_node = ssprog['fullpath']
                             except:
                                 pass
                 except:
                     action = self.get_argument('ACTION', '')
                     if action == 'SAVE_AS_DEFAULT' and ssbank['name'] == 'default':
-                        selected_node = ssbank['id']
+                        selected_node = ssbank['fullpath']
                     elif action == 'SAVE_AS_LAST_STATE' and ssbank['name'] == 'last_state':
-                        selected_node = ssbank['id']
+                        selected_node = ssbank['fullpath']
 
         except Exception as e:
             logging.error("ERROR:" + str(e))
@@ -349,58 +378,148 @@ class SnapshotConfigHandler(ZynthianBasicHandler):
         shutil.move(fpath, destination)
 
 
-class SnapshotRemoveChainHandler(tornado.web.RequestHandler):
+class SnapshotTreeHandler(tornado.web.RequestHandler):
+    """
+    Lazy snapshot tree. Returns the nodes of a directory, one page at a time:
+      path => bank full path. Default is the snapshots root directory.
+      cursor => name (text) of the last node of the previous page
+      limit => max number of nodes in the page
+      fields => comma separated list of node fields. Default is all but prog_details.
+      details=1 => include snapshot details (prog_details)
+    If path is a snapshot file, its node is returned with details.
+    """
+
+    DEFAULT_LIMIT = 128
+    MAX_LIMIT = 1024
 
     def get_current_user(self):
         return self.get_secure_cookie("user")
 
     @tornado.web.authenticated
-    def post(self, snapshot_file_b64, chain):
-        result = {}
-        snapshot_file = str(base64.b64decode(snapshot_file_b64), 'utf-8')
+    def get(self):
+        root = SnapshotConfigHandler.SNAPSHOTS_DIRECTORY
+        path = os.path.normpath(self.get_argument('path', None) or root)
+        if path != root and not path.startswith(root + "/"):
+            raise tornado.web.HTTPError(403)
         try:
-            logging.info("Removing chain {} in {}".format(
-                chain, snapshot_file))
-            data = []
-            with open(snapshot_file, "r") as fp:
-                data = json.load(fp)
-                del data['chains'][chain]
+            limit = min(max(int(self.get_argument('limit', self.DEFAULT_LIMIT)), 1), self.MAX_LIMIT)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        details = self.get_argument('details', '0') == '1'
+        fields = self.get_argument('fields', None)
+        if fields:
+            fields = fields.split(",")
+
+        if os.path.isfile(path):
+            bank_num, bank_name = self.get_bank(os.path.dirname(path))
+            node = SnapshotConfigHandler.create_node(os.path.basename(path), path, False, 0, bank_num, bank_name, True)
+            snapshot_index.commit()
+            if node is None:
+                raise tornado.web.HTTPError(404)
+            self.write({'node': self.select_fields(node, fields)})
+            return
+        if not os.path.isdir(path):
+            raise tornado.web.HTTPError(404)
+
+        bank_num, bank_name = self.get_bank(path)
+        cursor = self.get_argument('cursor', None)
+        nodes = []
+        next_cursor = None
+        for entry in SnapshotConfigHandler.list_directory(path):
+            if cursor is not None and entry.name <= cursor:
+                continue
+            node = SnapshotConfigHandler.create_node(entry.name, entry.path, entry.is_dir(), 0, bank_num, bank_name, details)
+            if node is None:
+                continue
+            if len(nodes) == limit:
+                next_cursor = nodes[-1]['text']
+                break
+            nodes.append(node)
+        snapshot_index.commit()
+
+        if not fields and not details:
+            fields = [key for key in nodes[0] if key != 'prog_details'] if nodes else None
+        self.write({
+            'nodes': [self.select_fields(node, fields) for node in nodes],
+            'next_cursor': next_cursor
+        })
+
+    @staticmethod
+    def get_bank(dpath):
+        """Get bank number & name of the nodes in a directory."""
+        if dpath == SnapshotConfigHandler.SNAPSHOTS_DIRECTORY:
+            return None, None
+        bank = SnapshotConfigHandler.create_node(os.path.basename(dpath), dpath, True)
+        return bank['bank_num'], bank['bank_name']
+
+    @staticmethod
+    def select_fields(node, fields):
+        if not fields:
+            return node
+        return {key: node[key] for key in fields if key in node}
+
+
+class SnapshotBulkHandler(tornado.web.RequestHandler):
+    """
+    Run a list of actions (move, renumber, copy, delete) as one transaction (see SnapshotBulkTransaction).
+    Body: JSON list of actions. Returns the updated tree (without details), banks & warnings.
+    """
 
-            with open(snapshot_file, "w") as fp:
-                json.dump(data, fp)
-
-            result = data
+    def get_current_user(self):
+        return self.get_secure_cookie("user")
 
+    @tornado.web.authenticated
+    async def post(self):
+        result = {}
+        try:
+            actions = json.loads(self.request.body)
+            transaction = SnapshotBulkTransaction(SnapshotConfigHandler.SNAPSHOTS_DIRECTORY, actions)
+            await asyncio.get_running_loop().run_in_executor(None, transaction.run)
         except Exception as err:
             result['errors'] = str(err)
             logging.error(err)
 
-        # JSON Ouput
-        if result:
-            self.write(result)
+        # Tree & checks, once for all the actions
+        ssdata = SnapshotConfigHandler.walk_directory(SnapshotConfigHandler.SNAPSHOTS_DIRECTORY, details=False)
+        snapshot_index.commit()
+        result['SNAPSHOTS'] = ssdata
+        result['BANKS'] = SnapshotConfigHandler.get_existing_banks(ssdata, True)
+        result['NEXT_BANK_NUM'] = SnapshotConfigHandler.calculate_next_bank(
+            SnapshotConfigHandler.get_existing_banks(ssdata, False))
+        snapshot_warning = SnapshotConfigHandler.get_snapshot_warning(ssdata)
+        if snapshot_warning:
+            result['errors'] = result['errors'] + "\n" + snapshot_warning if 'errors' in result else snapshot_warning
+
+        self.write(result)
 
 
-class SnapshotRemoveOptionHandler(tornado.web.RequestHandler):
+class SnapshotPatchHandler(tornado.web.RequestHandler):
+    """
+    Apply a batch of edit operations (see SnapshotPatch) to a snapshot file.
+    Body: JSON list of operations. Returns the new snapshot data, or errors.
+    """
 
     def get_current_user(self):
         return self.get_secure_cookie("user")
 
     @tornado.web.authenticated
-    def post(self, snapshot_file_b64, remove_option_key):
-        result = {}
-        snapshot_file = str(base64.b64decode(snapshot_file_b64), 'utf-8')
+    async def post(self, snapshot_file_b64):
         try:
-            logging.info("Removing option {} in {}".format(
-                remove_option_key, snapshot_file))
-            data = []
-            with open(snapshot_file, "r") as fp:
-                data = json.load(fp)
-                del data['midi_profile_state'][remove_option_key]
-
-            with open(snapshot_file, "w") as fp:
-                json.dump(data, fp)
+            operations = json.loads(self.request.body)
+        except ValueError as err:
+            operations = None
+            logging.error(err)
+        await self.patch(snapshot_file_b64, operations)
 
-            result = data
+    async def patch(self, snapshot_file_b64, operations):
+        result = {}
+        try:
+            snapshot_file = str(base64.b64decode(snapshot_file_b64), 'utf-8')
+            snapshot_file = os.path.normpath(snapshot_file)
+            if not snapshot_file.startswith(SnapshotConfigHandler.SNAPSHOTS_DIRECTORY + "/"):
+                raise SnapshotPatchError("Wrong snapshot file '{}'".format(snapshot_file))
+            patch = SnapshotPatch(snapshot_file, operations, SnapshotConfigHandler.PROFILES_DIRECTORY)
+            result = await asyncio.get_running_loop().run_in_executor(None, patch.apply)
 
         except Exception as err:
             result['errors'] = str(err)
@@ -410,56 +529,38 @@ class SnapshotRemoveOptionHandler(tornado.web.RequestHandler):
         if result:
             self.write(result)
 
+    @staticmethod
+    def escape_key(key):
+        return key.replace("~", "~0").replace("/", "~1")
 
-class SnapshotAddOptionsHandler(tornado.web.RequestHandler):
-    PROFILES_DIRECTORY = "%s/midi-profiles" % os.environ.get(
-        "ZYNTHIAN_CONFIG_DIR")
 
-    def get_current_user(self):
-        return self.get_secure_cookie("user")
+class SnapshotRemoveChainHandler(SnapshotPatchHandler):
 
     @tornado.web.authenticated
-    def post(self, snapshot_file_b64, midi_profile_script_b64):
-        result = {}
+    async def post(self, snapshot_file_b64, chain):
+        logging.info("Removing chain {}".format(chain))
+        await self.patch(snapshot_file_b64, [{'op': 'remove', 'path': '/chains/' + self.escape_key(chain)}])
 
-        try:
-            snapshot_file = str(base64.b64decode(snapshot_file_b64), 'utf-8')
-            midi_profile_script = str(base64.b64decode(
-                midi_profile_script_b64), 'utf-8')
-            logging.info("Add option values of {} into {}".format(
-                midi_profile_script, snapshot_file))
-            data = []
-            with open(snapshot_file, "r") as fp:
-                data = json.load(fp)
-                fp.close()
-
-            p = re.compile("export ZYNTHIAN_MIDI_(\w*)=\"(.*)\"")
-            profile_values = {}
-            with open(midi_profile_script, "r") as midi_fp:
-                for line in midi_fp:
-                    if line[0] == '#':
-                        continue
-                    m = p.match(line)
-                    if m:
-                        profile_values[m.group(1)] = m.group(2)
-                midi_fp.close()
-
-            for profile_value in profile_values:
-                data['midi_profile_state'][profile_value] = profile_values[profile_value]
-
-            with open(snapshot_file, "w") as fp:
-                json.dump(data, fp)
-                fp.close()
-
-            result = data
 
-        except Exception as err:
-            result['errors'] = str(err)
-            logging.error(err)
+class SnapshotRemoveOptionHandler(SnapshotPatchHandler):
 
-        # JSON Ouput
-        if result:
-            self.write(result)
+    @tornado.web.authenticated
+    async def post(self, snapshot_file_b64, remove_option_key):
+        logging.info("Removing option {}".format(remove_option_key))
+        await self.patch(snapshot_file_b64, [{'op': 'remove', 'path': '/midi_profile_state/' + self.escape_key(remove_option_key)}])
+
+
+class SnapshotAddOptionsHandler(SnapshotPatchHandler):
+
+    @tornado.web.authenticated
+    async def post(self, snapshot_file_b64, midi_profile_script_b64):
+        try:
+            midi_profile_script = str(base64.b64decode(midi_profile_script_b64), 'utf-8')
+        except ValueError as err:
+            self.write({'errors': str(err)})
+            return
+        logging.info("Add option values of {}".format(midi_profile_script))
+        await self.patch(snapshot_file_b64, [{'op': 'merge_midi_profile', 'path': '/midi_profile_state', 'value': midi_profile_script}])
 
 
 class SnapshotDownloadHandler(tornado.web.RequestHandler):
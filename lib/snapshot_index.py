@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Snapshot Index: cached snapshot details
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import json
+import logging
+import threading
+
+from lib.upload_handler import CACHE_DIR
+from zyngine.zynthian_legacy_snapshot import zynthian_legacy_snapshot
+
+# ------------------------------------------------------------------------------
+# Snapshot Index
+# ------------------------------------------------------------------------------
+
+
+class SnapshotIndex(object):
+    """
+    Details (converted state) of every snapshot file, keyed by path, persisted to disk.
+
+    A snapshot file is only parsed again when its size or mtime changes. Entries
+    of files not found when listing a directory are dropped, looking only at the
+    direct children of that directory.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        # fullpath => [size, mtime_ns, details]
+        self.files = {}
+        # directory => names of its indexed files & subdirectories, for pruning
+        self.dirs = {}
+        self.changed = False
+        self.load()
+        for fpath in self.files:
+            self.add_path(fpath)
+
+    def load(self):
+        try:
+            with open(self.fpath) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning("Can't load snapshot index '{}': {}".format(self.fpath, e))
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+            with open(self.fpath + ".tmp", "w") as f:
+                json.dump({'version': self.VERSION, 'files': self.files}, f)
+            os.replace(self.fpath + ".tmp", self.fpath)
+        except Exception as e:
+            logging.error("Can't save snapshot index '{}': {}".format(self.fpath, e))
+
+    def get_details(self, fpath, st=None):
+        """Get the details of a snapshot file, parsing it only if it changed."""
+        fpath = os.path.normpath(fpath)
+        with self.lock:
+            try:
+                if st is None:
+                    st = os.stat(fpath)
+            except OSError:
+                return ""
+            entry = self.files.get(fpath)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                return entry[2]
+            details = self.parse(fpath)
+            if entry is None:
+                self.add_path(fpath)
+            self.files[fpath] = [st.st_size, st.st_mtime_ns, details]
+            self.changed = True
+            return details
+
+    @staticmethod
+    def parse(fpath):
+        try:
+            with open(fpath) as ssfile:
+                return zynthian_legacy_snapshot().convert_state(json.load(ssfile))
+        except Exception as e:
+            logging.warning("Can't parse snapshot '{}': {}".format(fpath, e))
+            return ""
+
+    def add_path(self, fpath):
+        """Register a path & its parent directories in the directory map."""
+        path = os.path.normpath(fpath)
+        while True:
+            dpath, name = os.path.split(path)
+            if not name:
+                break
+            children = self.dirs.setdefault(dpath, set())
+            if name in children:
+                break
+            children.add(name)
+            path = dpath
+
+    def remove_path(self, path):
+        """Drop the entry of a file, or the entries of everything under a directory."""
+        if self.files.pop(path, None) is not None:
+            self.changed = True
+        for name in self.dirs.pop(path, ()):
+            self.remove_path(os.path.join(path, name))
+
+    def prune_dir(self, dpath, names):
+        """Drop the entries of files & subdirectories of dpath not in names."""
+        dpath = os.path.normpath(dpath)
+        with self.lock:
+            children = self.dirs.get(dpath)
+            if not children:
+                return
+            for name in children.difference(names):
+                children.discard(name)
+                self.remove_path(os.path.join(dpath, name))
+
+    def commit(self):
+        """Save the index if it changed."""
+        with self.lock:
+            if self.changed:
+                self.changed = False
+                self.save()
+
+
+snapshot_index = SnapshotIndex(CACHE_DIR + "/snapshot_index.json")
+
+# ------------------------------------------------------------------------------
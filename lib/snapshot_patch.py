@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Snapshot Patch: batched edition of snapshot files
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import re
+import json
+import logging
+import threading
+from functools import lru_cache
+
+# ------------------------------------------------------------------------------
+# MIDI profiles
+# ------------------------------------------------------------------------------
+
+MIDI_PROFILE_RE = re.compile(r"export ZYNTHIAN_MIDI_(\w*)=\"(.*)\"")
+
+
+def get_midi_profile_values(fpath):
+    """Get the variables of a MIDI profile script. Parsed only if it changed."""
+    st = os.stat(fpath)
+    return dict(parse_midi_profile(fpath, st.st_size, st.st_mtime_ns))
+
+
+@lru_cache(maxsize=32)
+def parse_midi_profile(fpath, size, mtime):
+    profile_values = {}
+    with open(fpath, "r") as midi_fp:
+        for line in midi_fp:
+            if line[0] == '#':
+                continue
+            m = MIDI_PROFILE_RE.match(line)
+            if m:
+                profile_values[m.group(1)] = m.group(2)
+    return tuple(profile_values.items())
+
+
+# ------------------------------------------------------------------------------
+# Snapshot Patch
+# ------------------------------------------------------------------------------
+
+class SnapshotPatchError(Exception):
+    pass
+
+
+class SnapshotPatch(object):
+    """
+    Apply a list of edit operations to a snapshot file, with a single parse & write.
+
+    Operations are JSON-patch like dicts: {"op": ..., "path": "/chains/01", "value": ...}
+      add, replace => set the value at path
+      remove => delete the value at path
+      test => fail if the value at path is not equal to value
+      merge_midi_profile => set the variables of the MIDI profile script (value) into path
+
+    All operations are applied or none. The file is written to a temporary file & renamed,
+    holding a per-file lock, so concurrent patches of the same file are serialised.
+    """
+
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def __init__(self, fpath, operations, profiles_dir=None):
+        self.fpath = fpath
+        self.operations = operations
+        self.profiles_dir = profiles_dir
+
+    @classmethod
+    def get_lock(cls, fpath):
+        with cls.locks_lock:
+            lock = cls.locks.get(fpath)
+            if lock is None:
+                lock = cls.locks[fpath] = threading.Lock()
+            return lock
+
+    def apply(self):
+        """Patch the file. Returns the new snapshot data."""
+        if not isinstance(self.operations, list):
+            raise SnapshotPatchError("Operations must be a list")
+        with self.get_lock(self.fpath):
+            with open(self.fpath, "r") as fp:
+                data = json.load(fp)
+            for operation in self.operations:
+                self.apply_operation(data, operation)
+            self.write(data)
+        logging.info("Snapshot {} patched: {} operations".format(self.fpath, len(self.operations)))
+        return data
+
+    def write(self, data):
+        tmp_fpath = "{}/.{}.tmp".format(*os.path.split(self.fpath))
+        try:
+            with open(tmp_fpath, "w") as fp:
+                json.dump(data, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_fpath, self.fpath)
+        except Exception:
+            try:
+                os.remove(tmp_fpath)
+            except OSError:
+                pass
+            raise
+
+    def apply_operation(self, data, operation):
+        try:
+            op = operation['op']
+            keys = self.parse_path(operation['path'])
+        except (KeyError, TypeError):
+            raise SnapshotPatchError("Wrong operation: {}".format(operation))
+        if not keys:
+            raise SnapshotPatchError("Can't {} the whole snapshot".format(op))
+        parent = self.resolve(data, keys[:-1], op in ('add', 'merge_midi_profile'))
+        key = keys[-1]
+        if op in ('add', 'replace'):
+            if 'value' not in operation:
+                raise SnapshotPatchError("Missing value: {}".format(operation))
+            if op == 'replace' and key not in parent:
+                raise SnapshotPatchError("Path not found: {}".format(operation['path']))
+            parent[key] = operation['value']
+        elif op == 'remove':
+            if key not in parent:
+                raise SnapshotPatchError("Path not found: {}".format(operation['path']))
+            del parent[key]
+        elif op == 'test':
+            if parent.get(key) != operation.get('value'):
+                raise SnapshotPatchError("Test failed: {}".format(operation['path']))
+        elif op == 'merge_midi_profile':
+            parent.setdefault(key, {}).update(get_midi_profile_values(self.get_profile_fpath(operation.get('value'))))
+        else:
+            raise SnapshotPatchError("Unknown operation '{}'".format(op))
+
+    @staticmethod
+    def parse_path(path):
+        """Split a JSON pointer into keys"""
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise SnapshotPatchError("Wrong path '{}'".format(path))
+        return [key.replace("~1", "/").replace("~0", "~") for key in path[1:].split("/")]
+
+    @staticmethod
+    def resolve(data, keys, create=False):
+        for key in keys:
+            if not isinstance(data, dict):
+                raise SnapshotPatchError("Path not found: /{}".format("/".join(keys)))
+            if key not in data:
+                if not create:
+                    raise SnapshotPatchError("Path not found: /{}".format("/".join(keys)))
+                data[key] = {}
+            data = data[key]
+        if not isinstance(data, dict):
+            raise SnapshotPatchError("Path not found: /{}".format("/".join(keys)))
+        return data
+
+    def get_profile_fpath(self, fpath):
+        if not isinstance(fpath, str):
+            raise SnapshotPatchError("Wrong MIDI profile '{}'".format(fpath))
+        if self.profiles_dir and os.path.dirname(os.path.realpath(fpath)) != os.path.realpath(self.profiles_dir):
+            raise SnapshotPatchError("Wrong MIDI profile '{}'".format(fpath))
+        return fpath
+
+# ------------------------------------------------------------------------------
@@ -29,6 +29,7 @@ import tornado.websocket
 from collections import OrderedDict
 import subprocess
 import jsonpickle
+from lib.command_runner import command_runner
 from lib.zynthian_config_handler import ZynthianBasicHandler
 from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
@@ -59,13 +60,20 @@ class SoftwareUpdateMessageHandler(ZynthianWebSocketMessageHandler):
         return handler_name == 'SoftwareUpdateMessageHandler'
 
     def on_websocket_message(self, update_command):
-        p = subprocess.Popen(
-            UPDATE_COMMANDS[update_command], shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-        for line in p.stdout:
-            logging.info(line.decode())
-            message = ZynthianWebSocketMessage(
-                'SoftwareUpdateMessageHandler', line.decode())
-            self.websocket.write_message(jsonpickle.encode(message))
+        command_runner.spawn(self.run_update_command(update_command))
+
+    def send_output_line(self, line):
+        logging.info(line)
+        message = ZynthianWebSocketMessage(
+            'SoftwareUpdateMessageHandler', line)
+        self.websocket.write_message(jsonpickle.encode(message))
+
+    async def run_update_command(self, update_command):
+        try:
+            await command_runner.run(UPDATE_COMMANDS[update_command], stderr=subprocess.STDOUT,
+                                     timeout=None, check=False, on_output=self.send_output_line)
+        except Exception as e:
+            logging.error("Software update failed: {}".format(e))
 
         message = ZynthianWebSocketMessage(
             'SoftwareUpdateMessageHandler', "EOCOMMAND")
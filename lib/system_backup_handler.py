@@ -23,18 +23,120 @@
 # ********************************************************************
 
 import os
+import re
+import json
 import time
+import shutil
+import asyncio
 import logging
 import zipfile
+import threading
 import jsonpickle
 import tornado.web
-from io import BytesIO
-from pathlib import Path
+from functools import lru_cache
 
+from lib.command_runner import command_runner
+from lib.zip_stream import ZipStreamWriter
+from lib.backup_manifest import BackupManifest
 from lib.zynthian_config_handler import ZynthianBasicHandler
 from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
 
+# ------------------------------------------------------------------------------
+# Backup items matcher
+# ------------------------------------------------------------------------------
+class BackupItemMatcher(object):
+    """
+    Backup items compiled once: included dirs (bdirs) & excluded patterns ("^" prefixed items).
+
+    Excluded patterns are combined into a single regex, with the same semantics as Path.match.
+    A path is excluded if it, or any of its parent dirs, matches. When walking, excluded
+    dirs are pruned, so they are never descended into.
+    """
+
+    def __init__(self, backup_items):
+        self.bdirs = []
+        xpats = []
+        for bitem in backup_items:
+            if bitem.startswith("^"):
+                xpats.append(bitem[1:])
+            elif bitem:
+                self.bdirs.append(bitem.rstrip("/") or "/")
+        if xpats:
+            self.xpats_re = re.compile("|".join("(?:{})".format(self.translate_path_pattern(xpat)) for xpat in xpats))
+        else:
+            self.xpats_re = None
+
+    def is_excluded(self, path):
+        return self.xpats_re is not None and self.xpats_re.search(path) is not None
+
+    def is_excluded_tree(self, path):
+        """Check the path & all its parents. O(depth)."""
+        if self.xpats_re is None:
+            return False
+        while True:
+            if self.xpats_re.search(path):
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def is_valid(self, path):
+        """True if the path is inside some bdir & it's not excluded."""
+        path = os.path.normpath("/" + path.lstrip("/"))
+        for bdir in self.bdirs:
+            if path == bdir or path.startswith(bdir + "/") or bdir == "/":
+                return not self.is_excluded_tree(path)
+        return False
+
+    def walk(self):
+        for bdir in self.bdirs:
+            if self.is_excluded_tree(bdir):
+                continue
+            if os.path.isfile(bdir):
+                yield os.path.dirname(bdir), [], [os.path.basename(bdir)]
+                continue
+            for dirname, subdirs, files in os.walk(bdir):
+                # Prune excluded subdirs in-place, so os.walk doesn't enter them
+                subdirs[:] = [d for d in subdirs if not self.is_excluded(os.path.join(dirname, d))]
+                files = [f for f in files if not self.is_excluded(os.path.join(dirname, f))]
+                yield dirname, subdirs, files
+
+    @staticmethod
+    def translate_path_pattern(pattern):
+        """
+        Translate a glob pattern into a regex with the same semantics as Path.match:
+        relative patterns match the path from the right, absolute ones the whole path.
+        Wildcards don't match "/".
+        """
+        pattern = pattern.rstrip("/") or "/"
+        res = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            i += 1
+            if c == "*":
+                res.append("[^/]*")
+            elif c == "?":
+                res.append("[^/]")
+            elif c == "[":
+                j = pattern.find("]", i + 1 if pattern[i:i + 1] in ("!", "]") else i)
+                if j < 0:
+                    res.append("\\[")
+                else:
+                    chars = pattern[i:j].replace("\\", "\\\\")
+                    if chars.startswith("!"):
+                        chars = "^/" + chars[1:]
+                    res.append("[" + chars + "]")
+                    i = j + 1
+            else:
+                res.append(re.escape(c))
+        if pattern.startswith("/"):
+            return "^" + "".join(res) + "$"
+        return "(?:^|/)" + "".join(res) + "$"
+
+
 # ------------------------------------------------------------------------------
 # Snapshot Config Handler
 # ------------------------------------------------------------------------------
@@ -114,7 +216,7 @@ class SystemBackupHandler(ZynthianBasicHandler):
         super().get("backup.html", "Backup / Restore", config, errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         command = self.get_argument('_command', '')
         logging.info("COMMAND = {}".format(command))
         if command:
@@ -123,8 +225,13 @@ class SystemBackupHandler(ZynthianBasicHandler):
                 'BACKUP_ALL': lambda: self.do_backup_all(),
                 'BACKUP_CONFIG': lambda: self.do_backup_config(),
                 'BACKUP_DATA': lambda: self.do_backup_data(),
+                'BACKUP_ALL_INCREMENTAL': lambda: self.do_backup_all(True),
+                'BACKUP_CONFIG_INCREMENTAL': lambda: self.do_backup_config(True),
+                'BACKUP_DATA_INCREMENTAL': lambda: self.do_backup_data(True),
                 'SAVE_BACKUP_CONFIG': lambda: self.do_save_backup_config()
             }[command]()
+            if asyncio.iscoroutine(errors):
+                errors = await errors
 
     def do_save_backup_config(self):
         # Save "Config" items
@@ -149,106 +256,244 @@ class SystemBackupHandler(ZynthianBasicHandler):
         active_tab = self.get_argument("ACTIVE_TAB", "BACKUP/RESTORE")
         self.do_get(active_tab)
 
-    def do_backup_all(self):
+    async def do_backup_all(self, incremental=False):
         backup_items = self.get_all_backup_items()
-        self.do_backup('zynthian_backup', backup_items)
+        await self.do_backup('zynthian_backup', backup_items, incremental)
 
-    def do_backup_config(self):
+    async def do_backup_config(self, incremental=False):
         backup_items = self.get_config_backup_items()
-        self.do_backup('zynthian_config_backup', backup_items)
+        await self.do_backup('zynthian_config_backup', backup_items, incremental)
 
-    def do_backup_data(self):
+    async def do_backup_data(self, incremental=False):
         backup_items = self.get_data_backup_items()
-        self.do_backup('zynthian_data_backup', backup_items)
-
-    def do_backup(self, fname_prefix, backup_items):
+        await self.do_backup('zynthian_data_backup', backup_items, incremental)
+
+    async def do_backup(self, fname_prefix, backup_items, incremental=False):
+        """
+        Stream a zip archive with the backup items into the response.
+        The archive is never fully kept in memory: every chunk is sent as soon as it's zipped.
+        Incremental backups only include the files changed since the last incremental backup.
+        """
+        if incremental:
+            fname_prefix += "_incremental"
         zipname = '{0}{1}.zip'.format(
             fname_prefix, time.strftime("%Y%m%d-%H%M%S"))
-        f = BytesIO()
-        zf = zipfile.ZipFile(f, "w")
-
-        def zip_backup_items(dirname, subdirs, files):
-            logging.info(dirname)
-            if dirname != '/':
-                zf.write(dirname)
-            for filename in files:
-                logging.info(filename)
-                zf.write(os.path.join(dirname, filename))
 
-        self.walk_backup_items(zip_backup_items, backup_items)
+        manifest = None
+        if incremental:
+            fpaths = await asyncio.get_running_loop().run_in_executor(None, self.list_backup_files, backup_items)
+            manifest, fpaths = await BackupManifest.load(fname_prefix).get_changes(zipname, fpaths)
 
-        zf.close()
         self.set_header('Content-Type', 'application/zip')
         self.set_header('Content-Disposition',
                         'attachment; filename=%s' % zipname)
 
-        self.write(f.getvalue())
-        f.close()
-        self.finish()
+        zs = ZipStreamWriter(self)
+        if manifest:
+            for fpath in fpaths:
+                await self.zip_backup_file(zs, fpath)
+            zs.writestr(BackupManifest.MEMBER_NAME, manifest.to_json())
+        else:
+            for dirname, subdirs, files in self.iter_backup_items(backup_items):
+                logging.info(dirname)
+                if dirname != '/':
+                    zs.write_dir(dirname)
+                for filename in files:
+                    await self.zip_backup_file(zs, os.path.join(dirname, filename))
+        await zs.close()
+        await self.finish()
+        # The next incremental backup is based on this one, once it has been sent
+        if manifest:
+            manifest.save()
+
+    @staticmethod
+    async def zip_backup_file(zs, fpath):
+        logging.info(fpath)
+        try:
+            await zs.write_file(fpath)
+        except OSError as e:
+            logging.error("Can't backup '{}': {}".format(fpath, e))
 
     def walk_backup_items(self, worker, backup_items):
-        valitem_info = self.get_valitem_info(backup_items)
-        for bdir in valitem_info["bdirs"]:
-            for dirname, subdirs, files in os.walk(bdir):
-                if not any(Path(dirname).match(xpat) for xpat in valitem_info["xpats"]):
-                    worker(dirname, subdirs, files)
+        for dirname, subdirs, files in self.iter_backup_items(backup_items):
+            worker(dirname, subdirs, files)
 
     @classmethod
-    def get_valitem_info(cls, backup_items=None):
-        xpats = []
-        bdirs = []
+    def list_backup_files(cls, backup_items):
+        fpaths = []
+        for dirname, subdirs, files in cls.iter_backup_items(backup_items):
+            fpaths += [os.path.join(dirname, filename) for filename in files]
+        return fpaths
+
+    @classmethod
+    def iter_backup_items(cls, backup_items):
+        return cls.get_backup_matcher(backup_items).walk()
+
+    @classmethod
+    def get_backup_matcher(cls, backup_items=None):
         if not backup_items:
             backup_items = cls.get_all_backup_items()
-        for bitem in backup_items:
-            bitem = os.path.expandvars(bitem)
-            if bitem.startswith("^"):
-                xpats.append(bitem[1:])
-            else:
-                bdirs.append(bitem)
-        return {
-            "xpats": xpats,
-            "bdirs": bdirs
-        }
+        return cls.compile_backup_matcher(tuple(os.path.expandvars(bitem) for bitem in backup_items))
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def compile_backup_matcher(backup_items):
+        return BackupItemMatcher(backup_items)
 
 
 class RestoreMessageHandler(ZynthianWebSocketMessageHandler):
+    """
+    Restore a backup archive, in a worker thread so the IOLoop is not blocked.
+
+    Members are validated before extracting anything and extracted in chunks.
+    Progress & log lines are sent in batches, at most every PROGRESS_INTERVAL seconds.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+    PROGRESS_INTERVAL = 0.5
 
     @classmethod
     def is_registered_for(cls, handler_name):
         return handler_name == 'RestoreMessageHandler'
 
     def is_valid_restore_item(self, restore_item):
-        restore_item = "/" + restore_item
-        for xpat in self.valitem_info["xpats"]:
-            if Path(restore_item).match(xpat):
-                return False
-        for bdir in self.valitem_info["bdirs"]:
-            if str(restore_item).startswith(bdir):
-                return True
-        return False
+        return self.backup_matcher.is_valid(restore_item)
+
+    def send_message(self, data):
+        message = ZynthianWebSocketMessage('RestoreMessageHandler', data)
+        self.websocket.write_message(jsonpickle.encode(message))
 
     def on_websocket_message(self, restore_file):
         # fileinfo = self.request.files['ZYNTHIAN_RESTORE_FILE'][0]
         # restore_file = fileinfo['filename']
-        with open(restore_file, "rb") as f:
-            self.valitem_info = SystemBackupHandler.get_valitem_info()
-            with zipfile.ZipFile(f, 'r') as restoreZip:
-                for member in restoreZip.namelist():
-                    if self.is_valid_restore_item(member):
-                        log_message = "Restored: " + member
-                        restoreZip.extract(member, "/")
-                        logging.debug(log_message)
-                        message = ZynthianWebSocketMessage(
-                            'RestoreMessageHandler', log_message)
-                        self.websocket.write_message(
-                            jsonpickle.encode(message))
+        command_runner.spawn(self.do_restore(restore_file))
+
+    async def do_restore(self, restore_file):
+        # Lines are added by the worker thread & sent from the IOLoop
+        self.log_lines = []
+        self.log_lock = threading.Lock()
+        self.last_progress = 0
+        try:
+            await self.ioloop.run_in_executor(None, self.restore, restore_file)
+        except Exception as e:
+            logging.error("Restore failed: {}".format(e))
+            with self.log_lock:
+                self.log_lines.append("ERROR: {}".format(e))
+        self.flush_log()
+        self.send_message('EOCOMMAND')
+
+    def restore(self, restore_file):
+        """Run in a worker thread. Messages are sent from the IOLoop."""
+        try:
+            self.backup_matcher = SystemBackupHandler.get_backup_matcher()
+            with zipfile.ZipFile(restore_file, 'r') as restoreZip:
+                members = []
+                manifest_data = None
+                for zinfo in restoreZip.infolist():
+                    if zinfo.filename == BackupManifest.MEMBER_NAME:
+                        manifest_data = restoreZip.read(zinfo)
+                    elif self.is_valid_restore_item(zinfo.filename):
+                        members.append(zinfo)
                     else:
-                        logging.warning(
-                            "Restore of " + member + " not allowed")
-                restoreZip.close()
-            f.close()
-        os.remove(restore_file)
+                        logging.warning("Restore of " + zinfo.filename + " not allowed")
+
+                progress = {
+                    'files': 0,
+                    'total_files': len(members),
+                    'bytes': 0,
+                    'total_bytes': sum(zinfo.file_size for zinfo in members)
+                }
+                restored = set()
+                for zinfo in members:
+                    restored.add(self.extract_member(restoreZip, zinfo, progress))
+                    progress['files'] += 1
+                    self.log("Restored: " + zinfo.filename, progress)
+                if manifest_data:
+                    self.apply_manifest(manifest_data, restored)
+                self.log("Restored {} files ({} bytes)".format(progress['files'], progress['bytes']), progress, True)
+        finally:
+            os.remove(restore_file)
         SystemBackupHandler.update_sys()
-        message = ZynthianWebSocketMessage(
-            'RestoreMessageHandler', 'EOCOMMAND')
-        self.websocket.write_message(jsonpickle.encode(message))
+
+    def extract_member(self, restoreZip, zinfo, progress):
+        """Extract a member into its absolute path. Returns the path."""
+        fpath = os.path.normpath("/" + zinfo.filename.lstrip("/"))
+        if zinfo.is_dir():
+            os.makedirs(fpath, exist_ok=True)
+            return fpath
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        with restoreZip.open(zinfo) as src, open(fpath, "wb") as dst:
+            while True:
+                data = src.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+                progress['bytes'] += len(data)
+                self.log(None, progress)
+        return fpath
+
+    def is_valid_link_source(self, manifest, fpath, src_fpath, restored):
+        """
+        The source of a link must be restorable too & be a file of this archive,
+        or a file of the backup chain with the same content as the link.
+        """
+        if not isinstance(src_fpath, str) or os.path.normpath(src_fpath) != src_fpath:
+            return False
+        if not self.is_valid_restore_item(src_fpath):
+            return False
+        if src_fpath in restored:
+            return True
+        src_info = manifest.files.get(src_fpath)
+        info = manifest.files.get(fpath)
+        return bool(src_info and info and src_info[2] == info[2])
+
+    def log(self, log_message, progress=None, force=False):
+        """Called from the worker thread. Lines & progress are sent in batches."""
+        if log_message:
+            logging.debug(log_message)
+            with self.log_lock:
+                self.log_lines.append(log_message)
+        now = time.monotonic()
+        if force or now - self.last_progress >= self.PROGRESS_INTERVAL:
+            self.last_progress = now
+            self.ioloop.call_soon_threadsafe(self.flush_log, dict(progress) if progress else None)
+
+    def flush_log(self, progress=None):
+        with self.log_lock:
+            lines = self.log_lines
+            self.log_lines = []
+        if lines:
+            self.send_message("<br />".join(lines))
+        if progress:
+            total = progress['total_bytes']
+            progress['percent'] = int(100 * progress['bytes'] / total) if total else 100
+            self.send_message(progress)
+
+    def apply_manifest(self, data, restored):
+        """
+        Incremental backups don't include files already restored from previous
+        backups in the chain: copy them from the file with the same content.
+        Also remove the files deleted since the previous backup.
+        restored: paths extracted from this archive.
+        """
+        manifest = BackupManifest.from_dict(None, json.loads(data))
+        for fpath, src_fpath in manifest.links.items():
+            if self.is_valid_restore_item(fpath):
+                if not self.is_valid_link_source(manifest, fpath, src_fpath, restored):
+                    logging.warning("Restore of " + fpath + " from " + str(src_fpath) + " not allowed")
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                    shutil.copy2(src_fpath, fpath)
+                    self.log("Restored: " + fpath)
+                except OSError as e:
+                    logging.error("Can't restore '{}' from '{}': {}".format(fpath, src_fpath, e))
+        for fpath in manifest.deleted:
+            if self.is_valid_restore_item(fpath):
+                try:
+                    os.remove(fpath)
+                    self.log("Deleted: " + fpath)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error("Can't delete '{}': {}".format(fpath, e))
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# System Metrics: background sampled system info for the dashboard
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import math
+import time
+import socket
+import psutil
+import asyncio
+import logging
+
+import zynconf
+from lib.command_runner import command_runner
+from lib.file_count_index import library_index
+
+# ------------------------------------------------------------------------------
+# System Metrics
+# ------------------------------------------------------------------------------
+
+
+class ZynthianSystemMetrics(object):
+    """
+    Sample system info in background, on the IOLoop, and keep the latest values.
+
+    Cheap values (memory, temperature, disk usage, network, services) are read
+    every "interval" seconds, mostly from /proc, /sys & statvfs, forking only one
+    systemctl. They are only sampled while there are listeners or the dashboard
+    has been requested in the last IDLE_TIMEOUT seconds. Expensive values that rarely change (git info, I2C chips, OS info) are
+    refreshed every "slow_interval" seconds. Library stats are taken from the
+    file count index, that is updated on the fast schedule if inotify is
+    available, or on the slow schedule otherwise.
+    """
+
+    GIT_REPOS = ["zyncoder", "zynthian-ui", "zynthian-sys", "zynthian-webconf", "zynthian-data"]
+    SERVICES = ["touchosc2midi", "jacknetumpd", "jackrtpmidid", "qmidinet"]
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, interval=None, slow_interval=None):
+        if interval is None:
+            interval = float(os.environ.get('ZYNTHIAN_WEBCONF_METRICS_INTERVAL', 5))
+        if slow_interval is None:
+            slow_interval = float(os.environ.get('ZYNTHIAN_WEBCONF_METRICS_SLOW_INTERVAL', 900))
+        self.interval = interval
+        self.slow_interval = slow_interval
+        # Values are defined before being sampled, in case sampling fails
+        self.data = self.get_defaults()
+        self.tasks = []
+        self.listeners = []
+        self.fast_ready = None
+        self.slow_ready = None
+        self.wanted = None
+        self.last_request = None
+        self.last_sample = None
+
+    def start(self):
+        if self.tasks:
+            return
+        self.fast_ready = asyncio.Event()
+        self.slow_ready = asyncio.Event()
+        self.wanted = asyncio.Event()
+        self.tasks = [
+            asyncio.ensure_future(self.sample_loop(self.sample_fast, self.interval, self.fast_ready, True)),
+            asyncio.ensure_future(self.sample_loop(self.sample_slow, self.slow_interval, self.slow_ready))
+        ]
+        logging.info("System metrics sampling started (every {}s / {}s)".format(self.interval, self.slow_interval))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def add_listener(self, callback):
+        """Register a callback, called with the metrics data after every sample."""
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+        if self.wanted:
+            self.wanted.set()
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify_listeners(self):
+        # Only notify when everything has been sampled at least once
+        if not (self.fast_ready.is_set() and self.slow_ready.is_set()):
+            return
+        for callback in list(self.listeners):
+            try:
+                callback(self.data)
+            except Exception as e:
+                logging.error("System metrics listener failed: {}".format(e))
+
+    def is_idle(self):
+        if self.listeners:
+            return False
+        return self.last_request is None or time.monotonic() - self.last_request > self.IDLE_TIMEOUT
+
+    async def sample_loop(self, sample, interval, ready, on_demand=False):
+        while True:
+            if on_demand and self.is_idle():
+                # Nobody is looking at the values => wait until requested
+                self.wanted.clear()
+                await self.wanted.wait()
+            try:
+                self.data.update(await sample())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Can't sample system metrics: {}".format(e))
+            if on_demand:
+                self.last_sample = time.monotonic()
+            ready.set()
+            self.notify_listeners()
+            await asyncio.sleep(interval)
+
+    async def get_snapshot(self):
+        """Return the latest sampled values. Only waits on the first call & after being idle."""
+        self.start()
+        # When sampling was paused, wait for fresh values
+        if self.last_sample is None or time.monotonic() - self.last_sample > 2 * self.interval:
+            self.fast_ready.clear()
+        self.last_request = time.monotonic()
+        self.wanted.set()
+        await self.fast_ready.wait()
+        await self.slow_ready.wait()
+        return self.data
+
+    async def refresh_slow(self):
+        """Force refreshing the slow values, i.e. after changing a git branch."""
+        self.data.update(await self.sample_slow())
+        if self.tasks:
+            self.notify_listeners()
+
+    async def sample_fast(self):
+        t0 = time.monotonic()
+        data = {
+            'ram': self.get_ram_info(),
+            'sd': self.get_volume_info("/"),
+            'temperature': self.get_temperature(),
+            'ip': self.get_ip(),
+            'host_name': self.get_host_name(),
+            'media': self.get_media_info(),
+            'wifi': await asyncio.get_running_loop().run_in_executor(None, zynconf.get_nwdev_status_string, "wlan0")
+        }
+        data['services'] = await self.get_services()
+        # Library stats are cheap to update when changes are notified by inotify
+        if library_index.watching:
+            await self.update_library_index()
+        data['library'] = self.get_library_info()
+        data['fast_timestamp'] = time.time()
+        logging.debug("Fast system metrics sampled in {:.1f} ms".format(1000 * (time.monotonic() - t0)))
+        return data
+
+    async def sample_slow(self):
+        t0 = time.monotonic()
+        zynthian_dir = os.environ.get('ZYNTHIAN_DIR', "/zynthian")
+        git_infos = await asyncio.gather(*[self.get_git_info(zynthian_dir + "/" + repo) for repo in self.GIT_REPOS],
+                                         return_exceptions=True)
+        data = {
+            'git': {},
+            'i2c_chips': await self.get_i2c_chips(),
+            'os_info': self.get_os_info(),
+            'build_info': self.get_build_info()
+        }
+        for repo, git_info in zip(self.GIT_REPOS, git_infos):
+            if isinstance(git_info, Exception):
+                logging.error("Can't get git info for '{}': {}".format(repo, git_info))
+                git_info = {"branch": "???", "gitid": "", "update": None}
+            data['git'][repo] = git_info
+        # Without inotify, library index update needs walking the data trees
+        if not library_index.watching:
+            await self.update_library_index()
+        data['slow_timestamp'] = time.time()
+        logging.debug("Slow system metrics sampled in {:.1f} ms".format(1000 * (time.monotonic() - t0)))
+        return data
+
+    @classmethod
+    def get_defaults(cls):
+        na = {'total': 'NA', 'used': 'NA', 'free': 'NA', 'usage': 'NA'}
+        return {
+            'ram': dict(na),
+            'sd': dict(na),
+            'temperature': "???",
+            'ip': "",
+            'host_name': "",
+            'media': {},
+            'wifi': "???",
+            'services': {service: False for service in cls.SERVICES},
+            'library': {"snapshots": 0, "presets": 0, "soundfonts": 0, "audio_captures": 0, "midi_captures": 0},
+            'fast_timestamp': 0,
+            'git': {repo: {"branch": "???", "gitid": "", "update": None} for repo in cls.GIT_REPOS},
+            'i2c_chips': [],
+            'os_info': "???",
+            'build_info': {'Timestamp': '???'},
+            'slow_timestamp': 0
+        }
+
+    # --------------------------------------------------------------------------
+    # Fast metrics
+    # --------------------------------------------------------------------------
+
+    @staticmethod
+    def get_ram_info():
+        meminfo = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                parts = line.split()
+                meminfo[parts[0].rstrip(":")] = int(parts[1])
+        total = meminfo['MemTotal'] // 1024
+        used = total - meminfo.get('MemAvailable', meminfo['MemFree']) // 1024
+        return {
+            'total': "{}M".format(total),
+            'used': "{}M".format(used),
+            'free': "{}M".format(meminfo['MemFree'] // 1024),
+            'usage': "{}%".format(int(100 * used / total))
+        }
+
+    @staticmethod
+    def get_temperature():
+        try:
+            with open("/sys/class/thermal/thermal_zone0/temp") as f:
+                return "{:.1f}ºC".format(int(f.read()) / 1000)
+        except:
+            return "???"
+
+    @staticmethod
+    def human_size(nbytes):
+        # Same format as "df -h"
+        for unit in ("", "K", "M", "G", "T"):
+            if nbytes < 1024 or unit == "T":
+                break
+            nbytes /= 1024
+        if nbytes < 10 and unit:
+            return "{:.1f}{}".format(math.ceil(nbytes * 10) / 10, unit)
+        return "{}{}".format(math.ceil(nbytes), unit)
+
+    @classmethod
+    def get_volume_info(cls, mpath):
+        try:
+            st = os.statvfs(mpath)
+            total = st.f_blocks * st.f_frsize
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            free = st.f_bavail * st.f_frsize
+            return {
+                'total': cls.human_size(total),
+                'used': cls.human_size(used),
+                'free': cls.human_size(free),
+                'usage': "{}%".format(math.ceil(100 * used / (used + free)) if used + free else 0)
+            }
+        except:
+            return {'total': 'NA', 'used': 'NA', 'free': 'NA', 'usage': 'NA'}
+
+    @classmethod
+    def get_media_info(cls):
+        res = {}
+        ex_data_basedir = os.environ.get('ZYNTHIAN_EX_DATA_DIR', "/media/root")
+        for exdir in zynconf.get_external_storage_dirs(ex_data_basedir):
+            if os.path.ismount(exdir):
+                res[os.path.basename(exdir)] = cls.get_volume_info(exdir)
+        return res
+
+    @staticmethod
+    def get_ip():
+        ips = []
+        for ifname, addrs in psutil.net_if_addrs().items():
+            for addr in addrs:
+                # Filter ip6 & loopback addresses
+                if addr.family == socket.AF_INET and not addr.address.startswith("127."):
+                    ips.append(addr.address)
+        return " ".join(ips)
+
+    @staticmethod
+    def get_host_name():
+        with open("/etc/hostname") as f:
+            hostname = f.readline()
+            return hostname
+
+    @classmethod
+    async def get_services(cls):
+        # A single systemctl for every service, printing a line per service.
+        # Exit code is non-zero when some service is not active.
+        try:
+            states = (await command_runner.run(["systemctl", "is-active"] + cls.SERVICES, check=False)).split("\n")
+        except Exception as e:
+            logging.error("Can't get services status: {}".format(e))
+            states = []
+        states += [""] * (len(cls.SERVICES) - len(states))
+        return {service: state.strip() == 'active' for service, state in zip(cls.SERVICES, states)}
+
+    # --------------------------------------------------------------------------
+    # Slow metrics
+    # --------------------------------------------------------------------------
+
+    @staticmethod
+    async def get_git_info(path, check_updates=False):
+        branch = (await command_runner.run("git branch | grep '*'", cwd=path))[2:-1]
+        gitid = (await command_runner.run(["git", "rev-parse", "HEAD"], cwd=path))[:-1]
+        if check_updates:
+            update = await command_runner.run(
+                "git remote update; git status --porcelain -bs | grep behind | wc -l", cwd=path, timeout=None)
+        else:
+            update = None
+        return {"branch": branch, "gitid": gitid, "update": update}
+
+    @staticmethod
+    def get_os_info():
+        try:
+            with open("/etc/os-release") as f:
+                for line in f:
+                    if line.startswith("PRETTY_NAME="):
+                        return line[12:].strip().strip('"')
+        except Exception as e:
+            logging.warning("Can't get OS info! => {}".format(e))
+        return "???"
+
+    @staticmethod
+    def get_build_info():
+        info = {}
+        try:
+            zynthian_dir = os.environ.get('ZYNTHIAN_DIR', "/zynthian")
+            with open(zynthian_dir + "/build_info.txt", 'r') as f:
+                rows = f.read().split("\n")
+                f.close()
+                for row in rows:
+                    try:
+                        k, v = row.split(": ")
+                        info[k] = v
+                        logging.debug("Build info => {}: {}".format(k, v))
+                    except:
+                        pass
+        except Exception as e:
+            logging.warning("Can't get build info! => {}".format(e))
+            info['Timestamp'] = '???'
+
+        return info
+
+    @staticmethod
+    async def get_i2c_chips():
+        res = []
+        try:
+            out = (await command_runner.run(["i2cdetect", "-y", "1"])).split("\n")
+        except Exception as e:
+            logging.warning("Can't detect I2C chips! => {}".format(e))
+            return res
+        if len(out) > 3:
+            for i in range(1, 8):
+                for adr in out[i][4:].split(" "):
+                    try:
+                        adr = int(adr, 16)
+                        if 0x20 <= adr <= 0x27:
+                            out1 = (await command_runner.run(["i2cget", "-y", "1", adr, "0x01"])).strip()
+                            out2 = (await command_runner.run(["i2cget", "-y", "1", adr, "0x10"])).strip()
+                            if out1 == '0x00' and out2 == '0x00':
+                                res.append("MCP23008@0x{:02X}".format(adr))
+                            else:
+                                res.append("MCP23017@0x{:02X}".format(adr))
+                        elif 0x48 <= adr <= 0x4B:
+                            res.append("ADS1115@0x{:02X}".format(adr))
+                        elif 0x61 <= adr <= 0x67:
+                            res.append("MCP4728@0x{:02X}".format(adr))
+                    except:
+                        pass
+        return res
+
+    @staticmethod
+    async def update_library_index():
+        try:
+            # Walking big data trees is slow => do it in a worker thread
+            await asyncio.get_running_loop().run_in_executor(None, library_index.update)
+        except Exception as e:
+            logging.error("Can't update library index: {}".format(e))
+
+    @staticmethod
+    def get_library_info():
+        counts = library_index.get_counts()
+        return {
+            "snapshots": counts.get("snapshots", 0),
+            "presets": sum(counts.get(k, 0) for k in ("presets_lv2", "presets_pianoteq", "presets_puredata", "presets_zynaddsubfx")),
+            "soundfonts": counts.get("soundfonts", 0),
+            "audio_captures": counts.get("audio_captures", 0),
+            "midi_captures": counts.get("midi_captures", 0)
+        }
+
+
+system_metrics = ZynthianSystemMetrics()
+
+# ------------------------------------------------------------------------------
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Transcode Queue: background audio conversion jobs
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import os
+import re
+import time
+import asyncio
+import logging
+import itertools
+import subprocess
+
+from lib.command_runner import command_runner
+
+# ------------------------------------------------------------------------------
+# Transcode Job
+# ------------------------------------------------------------------------------
+
+
+class TranscodeJob(object):
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job_id, src_fpath, fmt, quality=None):
+        self.job_id = job_id
+        self.src_fpath = src_fpath
+        self.dst_fpath = os.path.splitext(src_fpath)[0] + "." + fmt
+        self.fmt = fmt
+        self.quality = quality
+        self.state = self.QUEUED
+        self.progress = 0
+        self.error = None
+        self.task = None
+
+    @property
+    def finished(self):
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'src': os.path.basename(self.src_fpath),
+            'dst': os.path.basename(self.dst_fpath),
+            'format': self.fmt,
+            'quality': self.quality,
+            'state': self.state,
+            'progress': self.progress,
+            'error': self.error
+        }
+
+
+# ------------------------------------------------------------------------------
+# Transcode Queue
+# ------------------------------------------------------------------------------
+
+class ZynthianTranscodeQueue(object):
+    """
+    Convert audio files in background, with a bounded number of concurrent encoders.
+
+    Every job has an id and can be cancelled while queued or running. Listeners
+    are called with the job on every state change & progress update (throttled).
+    """
+
+    # format => (command builder, default quality, quality range)
+    ENCODERS = {
+        'ogg': (lambda src, dst, q: ["oggenc", "-q", q, src, "-o", dst], 5, (-1, 10)),
+        'flac': (lambda src, dst, q: ["flac", "-f", "-{}".format(q), src, "-o", dst], 5, (0, 8)),
+        'mp3': (lambda src, dst, q: ["lame", "-V", q, src, dst], 2, (0, 9))
+    }
+    PROGRESS_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*%")
+    PROGRESS_INTERVAL = 0.5
+    MAX_FINISHED_JOBS = 50
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('ZYNTHIAN_WEBCONF_TRANSCODE_WORKERS', 2))
+        self.max_workers = max_workers
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        self.queue = None
+        self.workers = []
+        self.listeners = []
+
+    def add_listener(self, callback):
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def notify(self, job):
+        for callback in list(self.listeners):
+            try:
+                callback(job)
+            except Exception as e:
+                logging.error("Transcode listener failed: {}".format(e))
+
+    def start(self):
+        if self.workers:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.ensure_future(self.worker()) for i in range(self.max_workers)]
+
+    def submit(self, src_fpath, fmt, quality=None):
+        """Queue a conversion job. Returns the job."""
+        if fmt not in self.ENCODERS:
+            raise ValueError("Unsupported format '{}'".format(fmt))
+        if src_fpath.lower().endswith("." + fmt):
+            raise ValueError("'{}' is already {}".format(os.path.basename(src_fpath), fmt))
+        build_cmd, default_quality, (qmin, qmax) = self.ENCODERS[fmt]
+        if quality is None or quality == "":
+            quality = default_quality
+        quality = min(max(int(quality), qmin), qmax)
+        self.start()
+        job = TranscodeJob(str(next(self.job_ids)), src_fpath, fmt, quality)
+        self.jobs[job.job_id] = job
+        self.queue.put_nowait(job)
+        self.purge()
+        logging.info("Transcode job {} queued: {} => {}".format(job.job_id, src_fpath, fmt))
+        self.notify(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if not job or job.finished:
+            return False
+        if job.task:
+            # Running => the encoder process is killed by the command runner
+            job.task.cancel()
+        else:
+            job.state = TranscodeJob.CANCELLED
+            self.notify(job)
+        return True
+
+    def get_jobs(self):
+        return [job.to_dict() for job in self.jobs.values()]
+
+    def purge(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:-self.MAX_FINISHED_JOBS]:
+            del self.jobs[job_id]
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.state != TranscodeJob.QUEUED:
+                continue
+            job.task = asyncio.ensure_future(self.run_job(job))
+            try:
+                await asyncio.shield(job.task)
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    # The worker itself is being cancelled
+                    job.task.cancel()
+                    raise
+            except Exception:
+                pass
+            job.task = None
+
+    async def run_job(self, job):
+        build_cmd = self.ENCODERS[job.fmt][0]
+        # Encode to a temporary file, so existing files are not lost if it fails
+        tmp_fpath = job.dst_fpath + ".part"
+        cmd = build_cmd(job.src_fpath, tmp_fpath, job.quality)
+        job.state = TranscodeJob.RUNNING
+        self.notify(job)
+        last_notify = [0]
+
+        def on_output(line):
+            m = self.PROGRESS_RE.search(line)
+            if m:
+                job.progress = min(int(float(m.group(1).replace(",", "."))), 100)
+                now = time.monotonic()
+                if now - last_notify[0] >= self.PROGRESS_INTERVAL:
+                    last_notify[0] = now
+                    self.notify(job)
+
+        try:
+            await command_runner.run(cmd, stderr=subprocess.STDOUT, timeout=None, on_output=on_output, split_cr=True)
+            os.replace(tmp_fpath, job.dst_fpath)
+            job.state = TranscodeJob.DONE
+            job.progress = 100
+        except asyncio.CancelledError:
+            job.state = TranscodeJob.CANCELLED
+            self.remove_file(tmp_fpath)
+            raise
+        except Exception as e:
+            job.state = TranscodeJob.FAILED
+            job.error = (getattr(e, 'output', None) or str(e)).strip().split("\n")[-1]
+            logging.error("Transcode job {} failed: {}".format(job.job_id, e))
+            self.remove_file(tmp_fpath)
+        finally:
+            logging.info("Transcode job {} {}".format(job.job_id, job.state))
+            self.notify(job)
+
+    @staticmethod
+    def remove_file(fpath):
+        try:
+            os.remove(fpath)
+        except OSError:
+            pass
+
+
+transcode_queue = ZynthianTranscodeQueue()
+
+# ------------------------------------------------------------------------------
@@ -24,14 +24,13 @@
 
 
 import logging
-import time
 import asyncio
 import subprocess
 import jsonpickle
 import tornado.web
 from collections import OrderedDict
 from multiprocessing import Queue
-from subprocess import check_output
+from lib.command_runner import command_runner
 from lib.tail_thread import TailThread, AsynchronousFileReader
 
 from lib.zynthian_config_handler import ZynthianBasicHandler
@@ -113,29 +112,27 @@ class UiLogMessageHandler(ZynthianWebSocketMessageHandler):
             self.websocket, loop, self.get_process_command(debug_level))
         UiLogMessageHandler.logging_thread.start()
 
-    def toggle_service(self, running_service, next_service):
-        check_output("(systemctl stop %s)&" % running_service, shell=True)
+    async def toggle_service(self, running_service, next_service):
+        await command_runner.run("(systemctl stop %s)&" % running_service)
 
         is_active = True
         max_trials = 20
         while is_active and max_trials > 0:
             logging.info("getting status of %s" % running_service)
             try:
-                check_output("systemctl status %s" %
-                             running_service, shell=True)
+                await command_runner.run(["systemctl", "status", running_service])
             except subprocess.CalledProcessError as e:
-                for byte_line in e.output.splitlines():
-                    line = byte_line.decode("utf-8")
+                for line in e.output.splitlines():
                     logging.info(line)
                     if "Active:" in line and ("inactive" in line or "inactive" in line):
                         is_active = False
 
-            time.sleep(1)
+            await asyncio.sleep(1)
             max_trials -= 1
 
-        check_output("(systemctl start %s)&" % next_service, shell=True)
+        await command_runner.run("(systemctl start %s)&" % next_service)
 
-    def do_start_debug_logging(self):
+    async def do_start_debug_logging(self):
         logging.info("start debug logging")
         message = ZynthianWebSocketMessage(
             'UiLogMessageHandler', 'Restarting UI in debug mode')
@@ -143,11 +140,11 @@ class UiLogMessageHandler(ZynthianWebSocketMessageHandler):
         if UiLogMessageHandler.logging_thread:
             UiLogMessageHandler.logging_thread.stop()
 
-        self.toggle_service("zynthian", "zynthian_debug")
+        await self.toggle_service("zynthian", "zynthian_debug")
 
         self.spawn_tail_thread(True)
 
-    def do_stop_debug_logging(self):
+    async def do_stop_debug_logging(self):
         logging.info("stop debug logging")
         message = ZynthianWebSocketMessage(
             'UiLogMessageHandler', 'Restarting UI in normal mode')
@@ -155,16 +152,16 @@ class UiLogMessageHandler(ZynthianWebSocketMessageHandler):
         if UiLogMessageHandler.logging_thread:
             UiLogMessageHandler.logging_thread.stop()
 
-        self.toggle_service("zynthian_debug", "zynthian")
+        await self.toggle_service("zynthian_debug", "zynthian")
 
         self.spawn_tail_thread(False)
 
     def on_websocket_message(self, action):
         logging.debug("action: %s " % action)
         if action == 'SHOW_DEBUG_LOGGING':
-            self.do_start_debug_logging()
+            command_runner.spawn(self.do_start_debug_logging())
         elif action == 'HIDE_DEBUG_LOGGING':
-            self.do_stop_debug_logging()
+            command_runner.spawn(self.do_stop_debug_logging())
         elif action == 'SHOW_DEFAULT':
             if UiLogMessageHandler.logging_thread:
                 UiLogMessageHandler.logging_thread.stop()
@@ -22,24 +22,39 @@
 #
 # ********************************************************************
 
+import time
+import asyncio
 import logging
 import os.path
 import shutil
+import tempfile
 import jsonpickle
+import tornado.ioloop
 import tornado.websocket
-from tornadostreamform.multipart_streamer import MultiPartStreamer, TemporaryFileStreamedPart
+from tornadostreamform.multipart_streamer import MultiPartStreamer, StreamedPart, TemporaryFileStreamedPart
 
+from lib.archive_stream import STAGING_PREFIX, StreamExtractor, get_tar_mode
 from lib.zynthian_websocket_handler import ZynthianWebSocketMessageHandler, ZynthianWebSocketMessage
 
 # ------------------------------------------------------------------------------
 # Upload Handling
 # ------------------------------------------------------------------------------
 
-TMP_DIR = "/zynthian/zynthian-webconf/tmp"
+WEBCONF_DIR = os.environ.get('ZYNTHIAN_DIR', "/zynthian") + "/zynthian-webconf"
+
+TMP_DIR = WEBCONF_DIR + "/tmp"
 if os.path.isdir(TMP_DIR):
     shutil.rmtree(TMP_DIR, ignore_errors=True)
 os.mkdir(TMP_DIR)
 
+# Persistent caches & indexes. Unlike TMP_DIR, it's kept across restarts.
+CACHE_DIR = WEBCONF_DIR + "/cache"
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Resumable uploads in progress. Kept across restarts, so they can be resumed.
+UPLOADS_DIR = WEBCONF_DIR + "/uploads"
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+
 MB = 1024 * 1024
 GB = 1024 * MB
 TB = 1024 * GB
@@ -58,38 +73,167 @@ class UploadStreamPart(TemporaryFileStreamedPart):
         self.f_out.close()
         shutil.move(self.f_out.name, file_path)
         self.is_moved = True
+        return file_path
+
+
+class UploadExtractStreamPart(StreamedPart):
+    """
+    Tar archive part, extracted while it's received into a staging directory,
+    named as the archive, so it can be installed with a single rename.
+    """
+
+    def __init__(self, streamer, headers, dpath, name, mode):
+        super().__init__(streamer, headers)
+        # The staging dir is created in the destination path, so it's in the same filesystem
+        self.staging_dpath = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=dpath)
+        self.extractor = StreamExtractor(os.path.join(self.staging_dpath, name), mode)
+        self.is_moved = False
+        self.error = None
+
+    def feed(self, data):
+        # The part size is updated by the streamer
+        self.extractor.feed(data)
+
+    def finalize(self):
+        try:
+            self.extractor.close()
+        finally:
+            super().finalize()
+
+    async def wait_extracted(self):
+        """Wait for the extraction thread, without blocking the IOLoop."""
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.extractor.finish)
+        except Exception as e:
+            logging.error("Can't extract uploaded file '{}': {}".format(self.get_filename(), e))
+            self.error = "Can't extract '{}': {}".format(self.get_filename(), e)
+            self.extractor = None
+
+    def move(self, file_path):
+        """The archive is already extracted. Returns the extracted dir, or None if extraction failed."""
+        if self.extractor is None:
+            return None
+        self.is_moved = True
+        return self.extractor.dpath
+
+    def release(self):
+        if not self.is_moved:
+            # Upload aborted or failed => remove the staging dir when the extraction thread ends
+            asyncio.get_event_loop().run_in_executor(None, self.remove_staging, self.extractor)
+
+    def remove_staging(self, extractor):
+        if extractor:
+            try:
+                extractor.finish()
+            except Exception:
+                pass
+        shutil.rmtree(self.staging_dpath, ignore_errors=True)
+
+
+class UploadProgressReporter(object):
+    """
+    Send upload progress to a websocket, from the IOLoop, at most every PROGRESS_INTERVAL.
+
+    update() only records the received bytes, so receiving data never waits for
+    encoding or sending messages. If the websocket is still sending the previous
+    message, intermediate updates are skipped. Messages are dicts with percent,
+    received & total bytes, instant (smoothed) & average rates in bytes/s and ETA in seconds.
+    """
+
+    PROGRESS_INTERVAL = 0.2
+    RATE_SMOOTHING = 0.3
+
+    def __init__(self, webSocketHandler):
+        self.webSocketHandler = webSocketHandler
+        self.received = 0
+        self.total = 0
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.last_received = 0
+        self.rate = None
+        self.timeout = None
+        self.write_future = None
+
+    def update(self, received, total):
+        self.received = received
+        self.total = total
+        if self.timeout is None:
+            delay = max(0, self.last_time + self.PROGRESS_INTERVAL - time.monotonic())
+            self.timeout = tornado.ioloop.IOLoop.current().call_later(delay, self.report)
+
+    def finish(self):
+        """Send the final progress now."""
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+        self.report(True)
+
+    def report(self, final=False):
+        self.timeout = None
+        now = time.monotonic()
+        if now > self.last_time:
+            rate = (self.received - self.last_received) / (now - self.last_time)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += self.RATE_SMOOTHING * (rate - self.rate)
+        self.last_time = now
+        self.last_received = self.received
+        if not final and self.write_future and not self.write_future.done():
+            return
+        avg_rate = self.received / (now - self.start_time) if now > self.start_time else 0
+        eta = None
+        if self.total and self.rate:
+            eta = round(max(0, self.total - self.received) / self.rate, 1)
+        progress = {
+            'percent': self.received * 100 // self.total if self.total else 0,
+            'received': self.received,
+            'total': self.total,
+            'rate': int(self.rate or 0),
+            'avg_rate': int(avg_rate),
+            'eta': eta
+        }
+        try:
+            message = ZynthianWebSocketMessage('UploadProgressHandler', progress)
+            self.write_future = self.webSocketHandler.websocket.write_message(jsonpickle.encode(message))
+        except Exception as e:
+            logging.warning("Can't send upload progress to websocket: {}".format(e))
 
 
 class UploadPostDataStreamer(MultiPartStreamer):
 
     percent = 0
 
-    def __init__(self, webSocketHandler, destinationPath, total):
+    def __init__(self, webSocketHandler, destinationPath, total, extract=False):
         self.webSocketHandler = webSocketHandler
+        self.progress_reporter = UploadProgressReporter(webSocketHandler) if webSocketHandler else None
         self.destinationPath = destinationPath
+        # Extract tar archives while uploading. Zip archives need the whole file.
+        self.extract = extract
+        self.part_files = []
+        self.extract_parts = []
+        self.errors = []
         super().__init__(total)
         # super().__init__(total, tmp_dir=TMP_DIR)
 
     def create_part(self, headers):
+        if self.extract:
+            part = StreamedPart(self, headers)
+            fname = part.get_filename()
+            if fname:
+                name, mode = get_tar_mode(os.path.basename(fname))
+                if mode:
+                    part = UploadExtractStreamPart(self, headers, self.destinationPath, name, mode)
+                    self.extract_parts.append(part)
+                    return part
         return UploadStreamPart(self, headers, tmp_dir=TMP_DIR)
 
     def on_progress(self, received, total):
         """Override this function to handle progress of receiving data."""
         if total:
-            new_percent = received*100//total
-            if new_percent != self.percent:
-                self.percent = new_percent
-                logging.debug(
-                    f"Upload progress: {new_percent}, received: {received}, total: {total}")
-                if self.webSocketHandler:
-                    try:
-                        message = ZynthianWebSocketMessage(
-                            'UploadProgressHandler', str(new_percent))
-                        self.webSocketHandler.websocket.write_message(
-                            jsonpickle.encode(message))
-                    except:
-                        logging.warning(
-                            f"Can't send upload progress to websocket: {new_percent}")
+            self.percent = received*100//total
+        # Progress is sent later from the IOLoop, throttled
+        if self.progress_reporter:
+            self.progress_reporter.update(received, total)
 
     def examine(self):
         print("============= structure =============")
@@ -112,14 +256,31 @@ class UploadPostDataStreamer(MultiPartStreamer):
             else:
                 print("        PAYLOAD:", "<too long...>")
 
+    async def wait_ready(self):
+        """Wait until the extraction threads can take more data."""
+        for part in self.extract_parts:
+            if part.extractor:
+                await part.extractor.wait_ready()
+
     def data_complete(self):
         super().data_complete()
+        if self.progress_reporter:
+            self.progress_reporter.finish()
+
+    async def move_parts(self):
+        for part in self.extract_parts:
+            if part.extractor:
+                await part.wait_extracted()
+            if part.error:
+                self.errors.append(part.error)
         for part in self.parts:
             if part.get_size() > 0:
                 destinationFilename = part.get_filename()
                 logging.info(part.get_name())
                 logging.info("destinationPath: " + self.destinationPath)
-                part.move(self.destinationPath + "/" + destinationFilename)
+                fpath = part.move(self.destinationPath + "/" + destinationFilename)
+                if fpath:
+                    self.part_files.append(fpath)
 
 
 class UploadProgressHandler(ZynthianWebSocketMessageHandler):
@@ -154,21 +315,21 @@ class UploadHandler(tornado.web.RequestHandler):
             # logging.info("reporting percent: " + self.ps.percent)
             self.write(self.ps.percent)
 
-    def post(self):
+    async def post(self):
+        response = ''
         try:
             # self.fout.close()
             self.ps.data_complete()
+            await self.ps.move_parts()
             # Use parts here!
             response = ''
             try:
-                destinationPath = self.get_argument("destinationPath", TMP_DIR)
-                part_files = []
-                for part in self.ps.parts:
-                    if part.get_size() > 0:
-                        part_files.append(destinationPath +
-                                          "/" + part.get_filename())
-
-                response = ",".join(part_files)
+                if self.ps.errors:
+                    # Some archive couldn't be extracted
+                    self.set_status(422)
+                    response = "\n".join(self.ps.errors)
+                else:
+                    response = ",".join(self.ps.part_files)
 
             except Exception as e:
                 logging.error("Copying uploaded files failed: %s" % e)
@@ -189,16 +350,25 @@ class UploadHandler(tornado.web.RequestHandler):
             total = int(self.request.headers.get("Content-Length", "0"))
             client_id = self.get_argument("clientId")
             destinationPath = self.get_argument("destinationPath", TMP_DIR)
+            extract = self.get_argument("extract", "0") == "1"
         except Exception as e:
             logging.error("prepare failed: %s" % e)
             total = 0
             client_id = '1'
+            extract = False
 
         upload_progress_handler = None
         if client_id in self.application.settings['upload_progress_handler']:
             upload_progress_handler = self.application.settings['upload_progress_handler'][client_id]
         self.ps = UploadPostDataStreamer(
-            upload_progress_handler,  destinationPath, total)
+            upload_progress_handler,  destinationPath, total, extract)
 
-    def data_received(self, chunk):
+    async def data_received(self, chunk):
         self.ps.data_received(chunk)
+        if self.ps.extract:
+            # Flow control: don't read more data until the extraction can take it
+            await self.ps.wait_ready()
+
+    def on_connection_close(self):
+        # Upload aborted => release temporary files & staging dirs
+        self.ps.release_parts()
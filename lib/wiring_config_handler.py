@@ -24,14 +24,15 @@
 
 import os
 import re
+import asyncio
 import logging
 import tornado.web
-from subprocess import check_output
 
 from zyngui.zynthian_gui import zynthian_gui
 from zynconf import CustomSwitchActionType, ZynSensorActionType
 
-from lib.dashboard_handler import DashboardHandler
+from lib.command_runner import command_runner
+from lib.system_metrics import ZynthianSystemMetrics
 from lib.zynthian_config_handler import ZynthianConfigHandler
 
 
@@ -43,7 +44,8 @@ from lib.zynthian_config_handler import ZynthianConfigHandler
 ADS1115_I2C_ADDRESS = ""
 MCP4728_I2C_ADDRESS = ""
 
-for i2chip in DashboardHandler.get_i2c_chips():
+# Run before the IOLoop starts, when this module is imported
+for i2chip in asyncio.run(ZynthianSystemMetrics.get_i2c_chips()):
     parts = i2chip.split('@')
     if parts[0] == 'ADS1115':
         ADS1115_I2C_ADDRESS = parts[1]
@@ -1089,7 +1091,7 @@ class WiringConfigHandler(ZynthianConfigHandler):
         super().get("Wiring", config, errors)
 
     @tornado.web.authenticated
-    def post(self):
+    async def post(self):
         command = self.get_argument('_command', '')
         logging.info("COMMAND = {}".format(command))
         self.request_data = self.get_request_data()
@@ -1126,6 +1128,8 @@ class WiringConfigHandler(ZynthianConfigHandler):
             self.config_env(self.request_data)
         else:
             errors = self.update_config(self.request_data)
+            if self.restart_ui_flag:
+                await self.rebuild_zyncoder()
 
         self.get(errors)
 
@@ -1173,9 +1177,8 @@ class WiringConfigHandler(ZynthianConfigHandler):
 
         errors = super().update_config(data)
 
-        if self.restart_ui_flag:
-            self.rebuild_zyncoder()
-        else:
+        # If restarting UI is needed, zyncoder library is rebuilt by the caller
+        if not self.restart_ui_flag:
             self.reload_wiring_layout_flag = True
 
         if self.reboot_flag:
@@ -1345,11 +1348,11 @@ class WiringConfigHandler(ZynthianConfigHandler):
                 "Can't delete wiring custom profile '{}': {}".format(fpath, e))
 
     @classmethod
-    def rebuild_zyncoder(cls):
+    async def rebuild_zyncoder(cls):
         try:
             cmd = "cd %s/zyncoder/build;cmake ..;make" % os.environ.get(
                 'ZYNTHIAN_DIR')
-            check_output(cmd, shell=True)
+            await command_runner.run(cmd, timeout=None)
         except Exception as e:
             logging.error("Rebuilding Zyncoder Library: %s" % e)
 
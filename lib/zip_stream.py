@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Zip Stream: write zip archives on the fly into an HTTP response
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import zipfile
+
+# ------------------------------------------------------------------------------
+# Zip streaming buffer
+# ------------------------------------------------------------------------------
+
+
+class ZipStreamBuffer(object):
+    """
+    Non-seekable file-like object for writing a zip archive on the fly.
+    Data written by zipfile is kept until popped, so it can be sent in chunks.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        n = len(data)
+        if n:
+            self.chunks.append(bytes(data))
+            self.size += n
+            self.position += n
+        return n
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+# ------------------------------------------------------------------------------
+# Zip stream writer
+# ------------------------------------------------------------------------------
+
+class ZipStreamWriter(object):
+    """
+    Write a zip archive into the response of a RequestHandler, as it's built.
+
+    Files are read in chunks and zipped data is sent every CHUNK_SIZE bytes,
+    waiting for the client to get it, so memory usage is bounded whatever the
+    archive size. Already compressed formats are stored without recompression.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+    STORED_EXTENSIONS = (".ogg", ".mp3", ".flac", ".sf2", ".sf3", ".zip", ".gz", ".xz", ".bz2", ".7z",
+                         ".jpg", ".jpeg", ".png", ".mp4")
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.buffer = ZipStreamBuffer()
+        self.zf = zipfile.ZipFile(self.buffer, "w", zipfile.ZIP_DEFLATED)
+
+    async def write_file(self, fpath, arcname=None):
+        zinfo = zipfile.ZipInfo.from_file(fpath, arcname)
+        if fpath.lower().endswith(self.STORED_EXTENSIONS):
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with open(fpath, "rb") as src, self.zf.open(zinfo, "w") as dst:
+            while True:
+                data = src.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+                await self.flush()
+        await self.flush()
+
+    def write_dir(self, dpath, arcname=None):
+        self.zf.write(dpath, arcname)
+
+    def writestr(self, arcname, data):
+        self.zf.writestr(arcname, data)
+
+    async def flush(self, min_size=CHUNK_SIZE):
+        if self.buffer.size and self.buffer.size >= min_size:
+            self.handler.write(self.buffer.pop())
+            # Wait until data is sent, so the buffer doesn't grow if the client is slower than us
+            await self.handler.flush()
+
+    async def close(self):
+        """Write the zip central directory & send the remaining data."""
+        self.zf.close()
+        await self.flush(0)
+
+# ------------------------------------------------------------------------------
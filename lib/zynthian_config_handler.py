@@ -24,13 +24,15 @@
 
 import os
 import liblo
+import asyncio
 import logging
 import tornado.web
-from time import sleep
-from subprocess import check_output
+from pathlib import Path
 
 import zynconf
 import zyngine.zynthian_lv2 as zynthian_lv2
+from lib.config_cache import config_cache
+from lib.command_runner import command_runner
 
 # Avoid unwanted debug messages from zynconf module
 zynconf_logger = logging.getLogger('zynconf')
@@ -64,10 +66,8 @@ class ZynthianBasicHandler(tornado.web.RequestHandler):
         return self.get_secure_cookie("user", max_age_days=5200)
 
     def prepare(self):
-        zynconf.load_config()
-        zynconf.load_midi_config()
-
-        zynthian_lv2.load_engines()
+        # Reload envars, MIDI profile & engines only if they changed on disk
+        config_cache.refresh()
         # zynthian_lv2.sanitize_engines()
 
         self.read_reboot_flag()
@@ -83,7 +83,7 @@ class ZynthianBasicHandler(tornado.web.RequestHandler):
 
     def on_finish(self):
         if self.restart_webconf_flag:
-            self.restart_webconf()
+            command_runner.spawn(self.restart_webconf())
 
     def render(self, tpl, **kwargs):
         info = {
@@ -131,7 +131,7 @@ class ZynthianBasicHandler(tornado.web.RequestHandler):
             self.persist_reboot_flag()
 
         if self.restart_ui_flag:
-            self.restart_ui()
+            command_runner.spawn(self.restart_ui())
         else:
             if self.reload_wiring_layout_flag:
                 self.reload_wiring_layout()
@@ -150,39 +150,39 @@ class ZynthianBasicHandler(tornado.web.RequestHandler):
     def is_service_active(self, service):
         return zynconf.is_service_active(service)
 
-    def power_off(self):
+    async def power_off(self):
         try:
             if self.is_service_active("zynthian"):
                 liblo.send(zynthian_ui_osc_addr, "/CUIA/POWER_OFF", ("s", "CONFIRM"))
-                sleep(5)
-            check_output("killall -SIGQUIT zynthian_gui.py; sleep 5; poweroff", shell=True)
+                await asyncio.sleep(5)
+            await command_runner.run("killall -SIGQUIT zynthian_gui.py; sleep 5; poweroff")
         except Exception as e:
             logging.error("Power Off: {}".format(e))
 
-    def reboot(self):
+    async def reboot(self):
         try:
             self.reboot_flag = False
             if os.path.isfile(self.reboot_flag_fpath):
                 os.remove(self.reboot_flag_fpath)
             if self.is_service_active("zynthian"):
                 liblo.send(zynthian_ui_osc_addr, "/CUIA/REBOOT", ("s", "CONFIRM"))
-                sleep(5)
-            check_output("killall -SIGINT zynthian_gui.py; sleep 5; reboot", shell=True)
+                await asyncio.sleep(5)
+            await command_runner.run("killall -SIGINT zynthian_gui.py; sleep 5; reboot")
         except Exception as e:
             logging.error("Reboot: {}".format(e))
 
-    def restart_ui(self):
+    async def restart_ui(self):
         try:
-            check_output("systemctl restart zynthian", shell=True)
+            await command_runner.run(["systemctl", "restart", "zynthian"])
             self.restart_ui_flag = False
             if os.path.isfile(self.restart_ui_flag_fpath):
                 os.remove(self.restart_ui_flag_fpath)
         except Exception as e:
             logging.error("Restarting UI: %s" % e)
 
-    def restart_webconf(self):
+    async def restart_webconf(self):
         try:
-            check_output("systemctl restart zynthian-webconf", shell=True)
+            await command_runner.run(["systemctl", "restart", "zynthian-webconf"])
             self.restart_webconf_flag = False
             if os.path.isfile(self.restart_webconf_flag_fpath):
                 os.remove(self.restart_webconf_flag_fpath)
@@ -202,10 +202,10 @@ class ZynthianBasicHandler(tornado.web.RequestHandler):
         self.reload_key_binding_flag = False
 
     def persist_update_sys_flag(self):
-        check_output("touch /zynthian_update_sys", shell=True)
+        Path("/zynthian_update_sys").touch()
 
     def persist_reboot_flag(self):
-        check_output(f"touch {self.reboot_flag_fpath}", shell=True)
+        Path(self.reboot_flag_fpath).touch()
 
     def read_reboot_flag(self):
         self.reboot_flag = os.path.exists(self.reboot_flag_fpath)
@@ -243,3 +243,5 @@ class ZynthianConfigHandler(ZynthianBasicHandler):
         for vn in config:
             if vn[0] != '_':
                 os.environ[vn] = config[vn][0]
+        # Unsaved values must not leak into next requests
+        config_cache.invalidate('envars')
@@ -78,7 +78,10 @@ class ZynthianWebSocketMessage(object):
 
 
 class ZynthianWebSocketHandler(tornado.websocket.WebSocketHandler):
-    handlers = []
+
+    def initialize(self):
+        # Message handlers of this connection only
+        self.handlers = []
 
     def check_origin(self, origin):
         return True
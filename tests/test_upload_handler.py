@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# ********************************************************************
+# ZYNTHIAN PROJECT: Zynthian Web Configurator
+#
+# Upload Handler Tests
+#
+# Copyright (C) 2024 Fernando Moyano <jofemodo@zynthian.org>
+#
+# ********************************************************************
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of
+# the License, or any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# For a full copy of the GNU General Public License see the LICENSE.txt file.
+#
+# ********************************************************************
+
+import io
+import os
+import sys
+import asyncio
+import tarfile
+import tempfile
+import unittest
+
+# Webconf dirs are created when importing the upload handler
+ZYNTHIAN_DIR = tempfile.mkdtemp(prefix="zynthian_")
+os.makedirs(ZYNTHIAN_DIR + "/zynthian-webconf")
+os.environ['ZYNTHIAN_DIR'] = ZYNTHIAN_DIR
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.archive_stream import STAGING_PREFIX
+from lib.upload_handler import UploadPostDataStreamer
+
+# ------------------------------------------------------------------------------
+# Upload Handler Tests
+# ------------------------------------------------------------------------------
+
+BOUNDARY = b"----zynthianboundary"
+
+
+def make_tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def make_multipart(fname, data):
+    return (b"--" + BOUNDARY + b"\r\n" +
+            b'Content-Disposition: form-data; name="files"; filename="' + fname.encode() + b'"\r\n' +
+            b"Content-Type: application/octet-stream\r\n\r\n" +
+            data + b"\r\n--" + BOUNDARY + b"--\r\n")
+
+
+class UploadExtractTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dpath = tempfile.mkdtemp(dir=ZYNTHIAN_DIR)
+
+    async def upload(self, body, chunk_size=1000):
+        ps = UploadPostDataStreamer(None, self.dpath, len(body), extract=True)
+        try:
+            for i in range(0, len(body), chunk_size):
+                ps.data_received(body[i:i + chunk_size])
+                await ps.wait_ready()
+            ps.data_complete()
+            await ps.move_parts()
+        finally:
+            ps.release_parts()
+        return ps
+
+    def test_extract_tar(self):
+        files = {
+            "mybank/preset1.xiz": os.urandom(50000),
+            "mybank/sub/preset2.xiz": b"preset2"
+        }
+        body = make_multipart("mybank.tar.gz", make_tar(files))
+        ps = asyncio.run(self.upload(body))
+        self.assertEqual(ps.errors, [])
+        self.assertEqual(len(ps.part_files), 1)
+        dpath = ps.part_files[0]
+        # Extracted into a staging dir, named as the archive & unrolled
+        self.assertEqual(os.path.basename(dpath), "mybank")
+        self.assertTrue(os.path.basename(os.path.dirname(dpath)).startswith(STAGING_PREFIX))
+        for name, data in files.items():
+            with open(os.path.join(dpath, name[len("mybank/"):]), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_extract_error(self):
+        body = make_multipart("broken.tar.gz", b"this is not a tar archive" * 100)
+        ps = asyncio.run(self.upload(body))
+        self.assertEqual(ps.part_files, [])
+        self.assertEqual(len(ps.errors), 1)
+        self.assertIn("broken.tar.gz", ps.errors[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
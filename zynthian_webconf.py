@@ -46,7 +46,7 @@ from lib.repository_handler import RepositoryHandler
 from lib.midi_log_handler import MidiLogHandler
 from lib.ui_log_handler import UiLogHandler
 from lib.engines_handler import EnginesHandler
-from lib.captures_config_handler import CapturesConfigHandler
+from lib.captures_config_handler import CapturesConfigHandler, CaptureStreamHandler, CapturePeaksHandler
 from lib.pianoteq_handler import PianoteqHandler
 from lib.dsp56300_handler import dsp56300Handler
 from lib.zynthian_websocket_handler import ZynthianWebSocketHandler
@@ -54,8 +54,9 @@ from lib.presets_config_handler import PresetsConfigHandler
 from lib.software_update_handler import SoftwareUpdateHandler
 from lib.system_backup_handler import SystemBackupHandler
 from lib.upload_handler import UploadHandler
+from lib.resumable_upload import ResumableUploadHandler
 from lib.midi_config_handler import MidiConfigHandler
-from lib.snapshot_config_handler import SnapshotConfigHandler, SnapshotRemoveOptionHandler, SnapshotAddOptionsHandler, SnapshotDownloadHandler, SnapshotRemoveChainHandler
+from lib.snapshot_config_handler import SnapshotConfigHandler, SnapshotRemoveOptionHandler, SnapshotAddOptionsHandler, SnapshotDownloadHandler, SnapshotRemoveChainHandler, SnapshotTreeHandler, SnapshotPatchHandler, SnapshotBulkHandler
 from lib.wifi_config_handler import WifiConfigHandler
 from lib.hwoptions_config_handler import HWOptionsConfigHandler
 from lib.wiring_config_handler import WiringConfigHandler
@@ -70,6 +71,7 @@ from lib.display_config_handler import DisplayConfigHandler
 from lib.audio_config_handler import AudioConfigHandler
 from lib.dashboard_handler import DashboardHandler
 from lib.login_handler import LoginHandler, LogoutHandler
+from lib.system_metrics import system_metrics
 # autopep8: on
 
 # ------------------------------------------------------------------------------
@@ -167,6 +169,9 @@ def make_app():
         (r"/logout", LogoutHandler),
         (r"/lib-snapshot$", SnapshotConfigHandler),
         (r"/lib-snapshot/ajax/(.*)$", SnapshotConfigHandler),
+        (r"/lib-snapshot/tree$", SnapshotTreeHandler),
+        (r"/lib-snapshot/patch/(.*)$", SnapshotPatchHandler),
+        (r"/lib-snapshot/bulk$", SnapshotBulkHandler),
         (r"/lib-snapshot/download/(.*)$", SnapshotDownloadHandler),
         (r"/lib-snapshot/remove/(.*)/(.*)$", SnapshotRemoveOptionHandler),
         (r"/lib-snapshot/remove-chain/(.*)/(.*)$", SnapshotRemoveChainHandler),
@@ -175,6 +180,8 @@ def make_app():
         (r"/lib-presets/(.*)$", PresetsConfigHandler),
         (r"/lib-presets/(.*)/(.*)$", PresetsConfigHandler),
         (r"/lib-captures$", CapturesConfigHandler),
+        (r"/lib-captures/stream/(.*)$", CaptureStreamHandler),
+        (r"/lib-captures/peaks/(.*)$", CapturePeaksHandler),
         (r"/hw-kit$", KitConfigHandler),
         (r"/hw-audio$", AudioConfigHandler),
         (r"/hw-audio-mixer$", AudioMixerHandler),
@@ -199,6 +206,8 @@ def make_app():
         (r"/sys-reboot/confirmed$", RebootConfirmedHandler),
         (r"/sys-poweroff$", PoweroffHandler),
         (r'/upload$', UploadHandler),
+        (r'/upload/resumable$', ResumableUploadHandler),
+        (r'/upload/resumable/([0-9a-f]{32})$', ResumableUploadHandler),
         (r"/ws$", ZynthianWebSocketHandler),
         (r"/zynterm", ZyntermHandler),
         (r"/zynterm_ws", TermSocket, {'term_manager': term_manager}),
@@ -215,6 +224,8 @@ async def amain():
         "certfile": "cert/cert.pem",
         "keyfile": "cert/key.pem"
     })
+    # Sample dashboard info in background
+    system_metrics.start()
     await asyncio.Event().wait()
 
 